@@ -1,4 +1,4 @@
-import time, sys
+import time, sys, os, json, hashlib
 
 import numpy as np
 import matplotlib.pyplot as plt
@@ -30,6 +30,14 @@ attractor_params['include_bridge'] = True
 
 
 
+### Density grids built by build_3d_array() are cached here, and
+### evaluated in slabs of at most this many cells
+density_cache_dir = os.path.join(os.path.expanduser('~'), '.cache', \
+                                 'opt_lev_analysis', 'attractor_density')
+slab_size = 2**22
+
+
+
 ##################################################################
 ##################################################################
 ##################################################################
@@ -55,17 +63,18 @@ def density_symmetric(x, y, z):
        they represent centers of rectangular volume elements with size
        given by dx x dy x dz. Currently, edges are exclusive, such 
        that the total mass of the attractor would be under-estimated,
-       rather than over-estimated.'''
+       rather than over-estimated.
+
+       The coordinates can be scalars or arrays, which are broadcast
+       against each other (e.g. x[:,None,None], y[None,:,None] and 
+       z[None,None,:] for a whole grid). Returns a float for scalars,
+       otherwise an array with the broadcast shape.'''
+
+    scalar = all(np.ndim(val) == 0 for val in (x, y, z))
+    x, y, z = np.broadcast_arrays(x, y, z)
 
-    ### Establish the easy cases first, returning the appropriate value
-    ### and hopefully decreasing runtime
     h = attractor_params['height']
     wtot = attractor_params['total_width']
-    within_x = x < 0
-    within_z = np.abs(z) < 0.5 * h
-    within_y = np.abs(y) < 0.5 * wtot
-    if not (within_x and within_y and within_z):
-        return 0.0
 
     rhog = attractor_params['rho_gold']
     rhos = attractor_params['rho_silicon']
@@ -77,61 +86,123 @@ def density_symmetric(x, y, z):
     b = attractor_params['silicon_bridge']
     b_bool = attractor_params['include_bridge']
 
-    ### Boolean flags for various locations 
-    central_finger = (np.abs(y) < 0.5 * wg)
-    back_bar = ( np.abs(x) < (l + b*b_bool + wg)) \
-                and ( np.abs(x) > (l + b*b_bool))
-    bridge = b_bool and (x < 0) and (np.abs(x) < b)
-    outer = (np.abs(y) > (0.5 * wtot - wo))
-    silicon_bulk = np.abs(x) > (l + wg + b*b_bool)
+    absx = np.abs(x)
+    absy = np.abs(y)
+
+    ### Everything outside of the attractor is empty
+    inside = (x < 0) & (np.abs(z) < 0.5 * h) & (absy < 0.5 * wtot)
+
+    ### Boolean masks for various locations 
+    central_finger = absy < 0.5 * wg
+    back_bar = (absx < (l + b*b_bool + wg)) & (absx > (l + b*b_bool))
+    bridge = b_bool & (x < 0) & (absx < b)
+    outer = absy > (0.5 * wtot - wo)
+    silicon_bulk = absx > (l + wg + b*b_bool)
 
-    #### Return the right density value baed on the boolean flags
-    if (central_finger and not bridge) or (back_bar and not outer):
-        return rhog
-    elif bridge or outer or silicon_bulk:
-        return rhos
+    #### The density baed on the masks, in order of precedence
+    gold = (central_finger & ~bridge) | (back_bar & ~outer)
+    silicon = ~gold & (bridge | outer | silicon_bulk)
 
     ### Hardest cases, assuming above aren't true. Naturally assumes a 
     ### symmetric attractor with a gold finger in the center, but that
     ### should be reasonably easy to change
-    extra_y = np.abs(y) - 0.5 * wg   ### assumption that n_finger is odd
-    extra_y_unit = extra_y % (wg + ws)
-    if extra_y_unit > ws:
-        return rhog
-    elif extra_y_unit < ws:
-        return rhos
-    else:
-        ### Failure case, so the function at least returns a number
+    fingers = inside & ~gold & ~silicon
+    extra_y = absy - 0.5 * wg   ### assumption that n_finger is odd
+    extra_y_unit = np.mod(extra_y, wg + ws)
+    gold |= fingers & (extra_y_unit > ws)
+    silicon |= fingers & (extra_y_unit < ws)
+
+    ### Failure case (exactly on the edge of a finger), so the density 
+    ### is at least a number
+    if np.any(fingers & (extra_y_unit == ws)):
         print('No valid condition met, check some shit')
-        return 0.0
+
+    rho = np.zeros(x.shape)
+    rho[inside & gold] = rhog
+    rho[inside & silicon] = rhos
+
+    if scalar:
+        return float(rho)
+    return rho
+
+
+
+def get_density_cache_path(grid_params, cache_dir=''):
+    '''Path of the cached density grid for the current attractor_params
+       and the given grid, named from a hash of both.'''
+    if not len(cache_dir):
+        cache_dir = density_cache_dir
+    key = json.dumps({'attractor_params': attractor_params, \
+                      'grid': grid_params}, sort_keys=True)
+    name = 'density_' + hashlib.sha1(key.encode()).hexdigest() + '.npy'
+    return os.path.join(cache_dir, name)
 
 
 
 def build_3d_array(x_range=(-199.5e-6, 0e-6), dx=1.0e-6, \
                     y_range=(-249.5e-6, 250e-6), dy=1.0e-6, \
                     z_range=(-4.5e-6, 5e-6), dz=1.0e-6, \
-                    verbose=False):
+                    verbose=False, cache=True, cache_dir=''):
     '''Build a 3D array of unit cells with coordinates defining
        the center of each unit cell. Grid values are the densities
        of those unit cells, assumed to be entirely one material.
 
        Default arguments setup 1 um unit cells, spanning most of the
        attractor and a little empty space to either side. Endpoints
-       in the {x,y,z}_range arguments need to be chosen carefully.'''
+       in the {x,y,z}_range arguments need to be chosen carefully.
+
+       The density is evaluated over whole slabs of the grid at once,
+       and the grid is saved as a .npy file named from a hash of the
+       attractor_params and the grid arguments, so building the same 
+       grid again (e.g. in every process of a parallel simulation, or 
+       over and over in a convergence study) is just a load.'''
 
     start = time.time() ### A timer
 
-    ### Build the x, y, and z arrays, and a zero array for the output
+    ### Build the x, y, and z arrays
     xx = np.arange(x_range[0], x_range[1], dx)
     yy = np.arange(y_range[0], y_range[1], dy)
     zz = np.arange(z_range[0], z_range[1], dz)
-    rho_grid = np.zeros((len(xx), len(yy), len(zz)))
+    shape = (len(xx), len(yy), len(zz))
+
+    grid_params = {'x_range': list(x_range), 'dx': dx, \
+                   'y_range': list(y_range), 'dy': dy, \
+                   'z_range': list(z_range), 'dz': dz}
+    cache_path = get_density_cache_path(grid_params, cache_dir=cache_dir)
+
+    rho_grid = None
+    if cache and os.path.isfile(cache_path):
+        try:
+            rho_grid = np.load(cache_path)
+            if rho_grid.shape != shape:
+                rho_grid = None
+        except Exception:
+            print("Couldn't load cached density grid: ", cache_path)
+            rho_grid = None
+
+    if rho_grid is None:
+        ### Slabs of constant x, so the temporary masks stay small
+        ### for fine grids
+        rho_grid = np.zeros(shape)
+        nslab = max(1, slab_size // max(1, len(yy)*len(zz)))
+        for lower in range(0, len(xx), nslab):
+            upper = min(lower + nslab, len(xx))
+            rho_grid[lower:upper] = \
+                density_symmetric(xx[lower:upper,np.newaxis,np.newaxis], \
+                                  yy[np.newaxis,:,np.newaxis], \
+                                  zz[np.newaxis,np.newaxis,:])
+
+        if cache:
+            try:
+                os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+                ### Write then rename, so other processes never see partial files
+                tmp_path = cache_path + '.{:d}.tmp'.format(os.getpid())
+                with open(tmp_path, 'wb') as f:
+                    np.save(f, rho_grid)
+                os.replace(tmp_path, cache_path)
+            except (IOError, OSError):
+                print("Couldn't save density grid to cache: ", cache_path)
 
-    ### Shitty for loop over the values chosen
-    for i, x in enumerate(xx):
-        for j, y in enumerate(yy):
-            for k, z in enumerate(zz):
-                rho_grid[i,j,k] = density_symmetric(x,y,z)
     stop = time.time() ### stop the timer
     deltat = stop - start
 
@@ -156,13 +227,7 @@ def plot_xy_density(zpos=0.0, x_range=(-599.5e-6, 10.0e-6), dx=1.0e-6, \
     ### Build the x and y arrays for plotting
     xx = np.arange(x_range[0], x_range[1], dx)
     yy = np.arange(y_range[0], y_range[1], dy)
-    rho_grid = np.zeros((xpts, ypts))
-
-    ### Shitty slow for loops. The density function is hard to vectorize
-    ### given the somewhat complex structure of the attractor
-    for i, x in enumerate(xx):
-        for j, y in enumerate(yy):
-            rho_grid[i,j] = density_symmetric(x, y, zpos)
+    rho_grid = density_symmetric(xx[:,np.newaxis], yy[np.newaxis,:], zpos)
 
     ### Some timing
     stop = time.time()
@@ -7,11 +7,13 @@ import matplotlib.pyplot as plt
 import dill as pickle
 
 import bead_util as bu
+import sim_store
 
 
 parent = str( Path(os.path.abspath(__file__)).parents[1] )
 
 raw_path = os.path.join(parent, 'raw_results')
+store_path = os.path.join(raw_path, 'force_store')
 out_path = os.path.join(parent, 'results')
 
 out_subdir = '4_6um-gbead_1um-unit-cells/'
@@ -30,98 +32,139 @@ def rbead_cond(rbead):
 test_filename = os.path.join(out_path, 'test.p')
 bu.make_all_pardirs(test_filename)
 
-raw_filenames, _ = bu.find_all_fnames(raw_path, ext='.p')
+def collect_from_pickles():
+    '''Assembles the force arrays from the per-point pickles written by
+       older versions of the simulation.'''
+
+    raw_filenames, _ = bu.find_all_fnames(raw_path, ext='.p')
+
+    ### Loop over all the simulation outut files and extract the 
+    ### simulation parameters used in that file (rbead, sep, height, etc)
+    seps = []
+    heights = []
+    posvec = []
+    nfiles = len(raw_filenames)
+    for fil_ind, fil in enumerate(raw_filenames):
+        ### Display percent completion
+        bu.progress_bar(fil_ind, nfiles, suffix='finding seps/heights')
+
+        sim_out = pickle.load( open(fil, 'rb') )
+        keys = list(sim_out.keys())
+
+        ### Avoids the dictionary key that's a string
+        for key in keys:
+            if type(key) == str:
+                continue
+            else:
+                rbead = key
+                break
+        if not rbead_cond(rbead):
+            continue
+
+        ### Should probably check if there is more than one key
+        cseps = list(sim_out[rbead].keys())
+        sep = cseps[0]
+        cheights = list(sim_out[rbead][sep].keys())
+        height = cheights[0]
+
+        ### Define the arrays that are consant for all simulation 
+        ### parameters, i.e. the yukawa lambdas and bead positions
+        if not len(posvec):
+            posvec = sim_out['posvec']
+            lambdas = list(sim_out[rbead][sep][height].keys())
+            attractor_params = sim_out['attractor_params']
+            rhobead = sim_out['rhobead']
+        else:
+            assert np.sum(posvec - sim_out['posvec']) == 0.0
+
+        seps.append(sep)
+        heights.append(height)
+
+
+
+    ### Select unique values of simulation parameters and construct
+    ### sorted arrays of those values
+    lambdas = np.sort(np.array(lambdas))
+
+    seps = np.sort(np.unique(seps))
+    heights = np.sort(np.unique(heights))
+
+    grid_check = np.zeros((len(seps), len(heights)))
+
+    ### Build up the 3D array of Newtonian and Yukawa-modified forces
+    ### for each of the positions simulated
+    Goutarr = np.zeros((len(seps), len(posvec), len(heights), 3))
+    yukoutarr = np.zeros((len(lambdas), len(seps), len(posvec), len(heights), 3))
+
+    for fil_ind, fil in enumerate(raw_filenames):
 
-### Loop over all the simulation outut files and extract the 
-### simulation parameters used in that file (rbead, sep, height, etc)
-seps = []
-heights = []
-posvec = []
-nfiles = len(raw_filenames)
-for fil_ind, fil in enumerate(raw_filenames):
-    ### Display percent completion
-    bu.progress_bar(fil_ind, nfiles, suffix='finding seps/heights')
+        bu.progress_bar(fil_ind, nfiles, suffix='collecting sim data')
 
-    sim_out = pickle.load( open(fil, 'rb') )
-    keys = list(sim_out.keys())
+        sim_out = pickle.load( open(fil, 'rb') )
+        keys = list(sim_out.keys())
 
-    ### Avoids the dictionary key that's a string
-    for key in keys:
-        if type(key) == str:
+        ### Avoids the dictionary key that's a string
+        for key in keys:
+            if type(key) == str:
+                continue
+            else:
+                rbead = key
+                break
+        if not rbead_cond(rbead):
             continue
-        else:
-            rbead = key
-            break
-    if not rbead_cond(rbead):
-        continue
-
-    ### Should probably check if there is more than one key
-    cseps = list(sim_out[rbead].keys())
-    sep = cseps[0]
-    cheights = list(sim_out[rbead][sep].keys())
-    height = cheights[0]
-
-    ### Define the arrays that are consant for all simulation 
-    ### parameters, i.e. the yukawa lambdas and bead positions
-    if not len(posvec):
-        posvec = sim_out['posvec']
-        lambdas = list(sim_out[rbead][sep][height].keys())
-        attractor_params = sim_out['attractor_params']
-        rhobead = sim_out['rhobead']
-    else:
-        assert np.sum(posvec - sim_out['posvec']) == 0.0
 
-    seps.append(sep)
-    heights.append(height)
+        cseps = list(sim_out[rbead].keys())
+        sep = cseps[0]
+        cheights = list(sim_out[rbead][sep].keys())
+        height = cheights[0]
 
+        dat = sim_out[rbead][sep][height]
 
+        sepind = np.argmin( np.abs(seps - sep) )
+        heightind = np.argmin( np.abs(heights - height) )
+        grid_check[sepind, heightind] += 1.0
 
-### Select unique values of simulation parameters and construct
-### sorted arrays of those values
-lambdas = np.sort(np.array(lambdas))
+        for ind in [0,1,2]:
+            Goutarr[sepind,:,heightind,ind] = dat[lambdas[0]][ind]
+            for lambind, lamb in enumerate(lambdas):
+                yukoutarr[lambind,sepind,:,heightind,ind] = dat[lamb][ind+3]
 
-seps = np.sort(np.unique(seps))
-heights = np.sort(np.unique(heights))
 
-grid_check = np.zeros((len(seps), len(heights)))
+    return lambdas, seps, heights, posvec, rbead, rhobead, \
+            attractor_params, Goutarr, yukoutarr, grid_check
 
-### Build up the 3D array of Newtonian and Yukawa-modified forces
-### for each of the positions simulated
-Goutarr = np.zeros((len(seps), len(posvec), len(heights), 3))
-yukoutarr = np.zeros((len(lambdas), len(seps), len(posvec), len(heights), 3))
 
-for fil_ind, fil in enumerate(raw_filenames):
 
-    bu.progress_bar(fil_ind, nfiles, suffix='collecting sim data')
+def collect_from_store():
+    '''Reads the force arrays straight from the simulation store. The
+       arrays for a single bead radius are contiguous, so this is only
+       a sequential read, and points that haven't been simulated yet
+       are flagged by the completion bitmap.'''
 
-    sim_out = pickle.load( open(fil, 'rb') )
-    keys = list(sim_out.keys())
+    store = sim_store.SimStore(store_path)
+    grid = store.grid
 
-    ### Avoids the dictionary key that's a string
-    for key in keys:
-        if type(key) == str:
-            continue
-        else:
-            rbead = key
-            break
-    if not rbead_cond(rbead):
-        continue
-
-    cseps = list(sim_out[rbead].keys())
-    sep = cseps[0]
-    cheights = list(sim_out[rbead][sep].keys())
-    height = cheights[0]
-
-    dat = sim_out[rbead][sep][height]
-
-    sepind = np.argmin( np.abs(seps - sep) )
-    heightind = np.argmin( np.abs(heights - height) )
-    grid_check[sepind, heightind] += 1.0
-
-    for ind in [0,1,2]:
-        Goutarr[sepind,:,heightind,ind] = dat[lambdas[0]][ind]
-        for lambind, lamb in enumerate(lambdas):
-            yukoutarr[lambind,sepind,:,heightind,ind] = dat[lamb][ind+3]
+    rbeads = [rbead for rbead in grid['rbeads'] if rbead_cond(rbead)]
+    if len(rbeads) > 1:
+        print('More than one bead radius passes rbead_cond(), using the first')
+    rbead = rbeads[0]
+
+    Goutarr, yukoutarr, complete = store.get_data(rbead)
+    grid_check = complete.astype(float)
+
+    return grid['lambdas'], grid['seps'], grid['heights'], grid['posvec'], \
+            rbead, grid['rhobead'], grid['attractor_params'], \
+            Goutarr, yukoutarr, grid_check
+
+
+
+### Use the store written by the simulation if there is one
+if sim_store.SimStore(store_path).exists():
+    lambdas, seps, heights, posvec, rbead, rhobead, attractor_params, \
+        Goutarr, yukoutarr, grid_check = collect_from_store()
+else:
+    lambdas, seps, heights, posvec, rbead, rhobead, attractor_params, \
+        Goutarr, yukoutarr, grid_check = collect_from_pickles()
 
 print("Done!")
 print()
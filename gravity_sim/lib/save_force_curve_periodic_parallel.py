@@ -2,14 +2,15 @@
 
 import numpy as np
 import matplotlib.pyplot as plt
-import pickle as pickle
 
 import scipy.interpolate as interp
 import scipy.signal as signal
 import scipy.optimize as opti
+import scipy.sparse as sparse
 import scipy, sys, time, os, itertools
 
 import build_attractor_v2_density as density
+import sim_store
 import bead_util as bu
 
 from numba import jit
@@ -128,6 +129,10 @@ results_path = os.path.abspath('../raw_results/')
 test_filename = os.path.join(results_path, 'test.p')
 bu.make_all_pardirs(test_filename)
 
+### Every point of the parameter grid is written to a single preallocated
+### store (see sim_store.py), rather than to its own pickle
+store_path = os.path.join(results_path, 'force_store')
+
 ### Assuming n_goldfinger is an odd integer, this just sets up some indices
 ### of the fingers for use in the periodic sampling part
 finger_inds = np.linspace(-1.0 * int( 0.5*n_goldfinger ), \
@@ -137,13 +142,11 @@ finger_inds = np.linspace(-1.0 * int( 0.5*n_goldfinger ), \
 
 ### Function to determine which finger you're in front of, and then
 ### compute the equivalent coordinate assuming you're in front of the 
-### central finger. Part of the perdicity
+### central finger. Part of the perdicity. Works elementwise on arrays
 def find_ind(ypos):
-    if np.abs(ypos) <= 0.5*full_period:
-        ind = 0
-    else:
-        extrapos = np.abs(ypos) - 0.5*full_period
-        ind = np.sign(ypos) * (int(extrapos / full_period) + 1)
+    extrapos = np.abs(ypos) - 0.5*full_period
+    ind = np.where(extrapos <= 0, 0.0, \
+                   np.sign(ypos) * (np.floor(extrapos / full_period) + 1))
 
     newypos = ypos - ind * full_period
 
@@ -151,228 +154,207 @@ def find_ind(ypos):
 
 
 
-def simulation(params):
-    '''Simulation function taking one argument and returning one object,
-       for use with joblib parallelization.'''
-
-    ### Parse the parameters
-    rbead, sep, height = params
-
-    ### Build a filename from the parameters
-    filename = 'rbead_' + str(rbead)
-    filename += '_sep_' + str(sep)
-    filename += '_height_' + str(height)
-    filename += '.p'
-    full_filename = os.path.join(results_path, filename)
-
-    ### Instantiate a dictionary that will be populated with results
-    results_dic = {}
-    results_dic['order'] = 'Rbead, Sep, Height, Yuklambda'
-    results_dic[rbead] = {}
-    results_dic[rbead][sep] = {}
-    results_dic[rbead][sep][height] = {}
-
-    ### Some timing stuff
-    all_start = time.time()
-    calc_times = []
-
-    ### A thing that needs to be in every term (POSSIBLE SIGN AMBIGUITY)
+def point_mass_force_curves(bead_x, bead_ys, bead_z, rbead, \
+                            xx, yy, zz, m, lambdas, block_size=2**17):
+    '''Computes the Newtonian and Yukawa-modified forces on the bead from
+       a grid of point masses, for a whole line of bead positions along y
+       and every value of lambda at once.
+
+       The kernel only depends on the displacement between the bead and 
+       a point mass. Along y, both the bead positions and the point masses
+       sit on regular grids, so there are only about (Npos + Ny) distinct
+       y-displacements, rather than Npos * Ny. The kernel is evaluated once
+       for each distinct displacement and each (x, z) column of masses,
+       contracted with the masses in a single matrix product per lambda,
+       and finally gathered back to each bead position. The distinct
+       displacements are processed in blocks of about block_size kernel
+       values, so the temporaries for each lambda stay in cache.
+
+       INPUTS: bead_x, bead_z, position of the center of the bead [m]
+               bead_ys, array of bead positions along y [m]
+               rbead, radius of the bead [m]
+               xx, yy, zz, coordinates of the point masses [m]
+               m, (Nx, Ny, Nz) array of point masses [kg]
+               lambdas, array of Yukawa lambdas [m]
+               block_size, number of kernel values per block
+
+       OUTPUTS: Gforce, (3, Npos) array of Newtonian forces [N]
+                yukforce, (Nlambda, 3, Npos) array of Yukawa forces [N],
+                          for unit alpha'''
+
+    bead_ys = np.asarray(bead_ys)
+    lambdas = np.asarray(lambdas)
+
+    ### Masses as (x,z) columns by y, dropping the empty columns
+    nx, ny, nz = m.shape
+    mass = np.transpose(m, (0,2,1)).reshape(nx*nz, ny)
+    good = np.any(mass != 0, axis=1)
+    mass = mass[good]
+    dxs = (bead_x - np.repeat(xx, nz))[good]
+    dzs = (bead_z - np.tile(zz, nx))[good]
+
+    Gforce = np.zeros((3, len(bead_ys)))
+    yukforce = np.zeros((len(lambdas), 3, len(bead_ys)))
+    if not len(mass):
+        return Gforce, yukforce
+
+    ### Distinct y-displacements, grouped to within a picometer to absorb
+    ### the rounding errors of the grids, and where each (position, mass)
+    ### pair finds its displacement
+    ysep = bead_ys[:,np.newaxis] - yy[np.newaxis,:]
+    keys = np.round(ysep / 1.0e-12).astype(np.int64)
+    _, first, sep_inds = np.unique(keys, return_index=True, return_inverse=True)
+    dys = ysep.ravel()[first]
+    sep_inds = sep_inds.reshape(ysep.shape)
+
+    ### Separations between each column of masses and the bead, for every
+    ### distinct y-displacement. These don't depend on lambda
+    full_sep = np.sqrt(dxs[:,np.newaxis]**2 + dys[np.newaxis,:]**2 \
+                        + dzs[:,np.newaxis]**2)
+    inv_cube = 1.0 / full_sep**3
+
+    ### Refer to a soon-to-exist document expanding on Alex R's. The sign
+    ### and constant factors common to every term
+    prefac = -1.0 * (2. * G * rhobead * np.pi) / 3.
     Gterm = 2. * rbead**3
 
-    ### Loop over the long array of bead positions and compute the force from
-    ### only the central finger. This can be sampled and added up to build the
-    ### force curve from the entire attractor
-    Gforcecurves = [[], [], []]
-    for ind, ypos in enumerate(beadposvec2):
-        beadpos = [sep+rbead, ypos, height]
-
-        ### These are used to compute projections and thus need to maintain sign.
-        ### Use the xx2, yy2, and zz2 arrays which are a subselections of the full
-        ### attractor covering only a single period of the fingers
-        xsep, ysep, zsep = np.meshgrid(beadpos[0] - xx2, \
-                                       beadpos[1] - yy2, \
-                                       beadpos[2] - zz2, indexing='ij')
-
-        ### Compute the separation between each point mass and the center 
-        ### of the microsphere
-        full_sep = np.sqrt(xsep**2 + ysep**2 + zsep**2)
-
-        ### Refer to a soon-to-exist document expanding on Alex R's
-        prefac = -1.0 * ((2. * G * m2 * rhobead * np.pi) / (3. * full_sep**2))
-
-        ### Append the computed values for the force from a single finger
-        Gforcecurves[0].append( np.sum(prefac * Gterm * xsep / full_sep) )
-        Gforcecurves[1].append( np.sum(prefac * Gterm * ysep / full_sep) )
-        Gforcecurves[2].append( np.sum(prefac * Gterm * zsep / full_sep) )
-
-    Gforcecurves = np.array(Gforcecurves)
-
-    ### Build interpolating functions from the long position vector
-    ### and the force due to a single period of the fingers
-    GX = interp.interp1d(beadposvec2, Gforcecurves[0], kind='cubic')
-    GY = interp.interp1d(beadposvec2, Gforcecurves[1], kind='cubic')
-    GZ = interp.interp1d(beadposvec2, Gforcecurves[2], kind='cubic')
-
-
-    ### Loop over the actual array of desired bead positions, and compute the
-    ### force from the full attractor at that position
-    newGs = np.zeros((3, len(beadposvec)))
-    for ind, ypos in enumerate(beadposvec):
-        start = time.time()
-
-        ### Compute the contribution from the points external to the 
-        ### periodicity, if desired
-        if include_edge:
-
-            ### sep parameter is assumed to be face to face
-            beadpos = [sep+rbead, ypos, height]
-
-            ### These are used to compute projections and thus need to maintain sign
-            xsep, ysep, zsep = np.meshgrid(beadpos[0] - xx2, \
-                                           beadpos[1] - yy3, \
-                                           beadpos[2] - zz2, indexing='ij')
-            full_sep = np.sqrt(xsep**2 + ysep**2 + zsep**2)
-
-            prefac = -1.0 * ((2. * G * m3 * rhobead * np.pi) / (3. * full_sep**2))
-
-            newGs[0][ind] += np.sum(prefac * Gterm * xsep / full_sep) 
-            newGs[1][ind] += np.sum(prefac * Gterm * ysep / full_sep) 
-            newGs[2][ind] += np.sum(prefac * Gterm * zsep / full_sep)
-
-        ### Find the finger in which we're in front of, and compute an 
-        ### equivalent position as if we're in front of the center finger
-        finger_ind, newypos = find_ind(ypos)
-
-        ### Sample the interpolating functions we built before, with one sample
-        ### for each finger, properly displaced
-        newGs[0][ind] += np.sum(GX(newypos + (finger_inds+finger_ind) * full_period))
-        newGs[1][ind] += np.sum(GY(newypos + (finger_inds+finger_ind) * full_period))
-        newGs[2][ind] += np.sum(GZ(newypos + (finger_inds+finger_ind) * full_period))  
-        stop = time.time()
-        calc_times.append(stop - start)
-
-    if verbose:
-        print('Computed normal grav.')
-        print('Processing Yukawa modifications...')
-        sys.stdout.flush()
-
-
-    ### Loop over the desired values of the Yukawa lambda parameter, simulating
-    ### the force for each one
-    nlambda = len(lambdas)
+    ### Most (x, z) columns of the attractor have the same profile of
+    ### masses along y, so the contraction with the masses factors into
+    ### a sum over the columns sharing each profile, then a small product
+    ### with the distinct profiles. The projections on x and z only depend
+    ### on the column, so they're folded into the weights of those sums,
+    ### and the projection on y only depends on the displacement
+    profiles, groups = np.unique(mass, axis=0, return_inverse=True)
+    groups = groups.ravel()
+    nprofile = len(profiles)
+    membership = np.zeros((nprofile, len(mass)))
+    membership[groups,np.arange(len(mass))] = 1.0
+    weights = np.concatenate((membership * dxs[np.newaxis,:], membership, \
+                              membership * dzs[np.newaxis,:]))
+    profiles_T = np.ascontiguousarray(profiles.T)
+
+    def contract(kernel, lower, upper):
+        ### Radial (Ncolumn, Nblock) kernel to the (3, Ny, Nblock) force 
+        ### from each y-row of masses
+        summed = (weights @ kernel).reshape(3, nprofile, upper-lower)
+        summed[1] *= dys[np.newaxis,lower:upper]
+        return profiles_T @ summed
+
+    ### Summing the contributions of every y-row of masses for each bead
+    ### position is a sparse product, with a one for every (position, mass)
+    ### pair picking out its displacement
+    nsep = len(dys)
+    rows = np.repeat(np.arange(len(bead_ys)), len(yy))
+    cols = (np.arange(len(yy))[np.newaxis,:] * nsep + sep_inds).ravel()
+    selection = sparse.csr_matrix((np.ones(len(rows)), (rows, cols)), \
+                                  shape=(len(bead_ys), len(yy)*nsep))
+
+    def gather(contracted):
+        ### (3, Ny, Nsep) contracted kernel to the (3, Npos) force
+        return (selection @ contracted.reshape(3, -1).T).T
+
+    Gforce = prefac * Gterm * gather(contract(inv_cube, 0, nsep))
+
+    step = max(1, block_size // len(mass))
+    contracted = np.zeros((3, len(yy), nsep))
     for yukind, yuklambda in enumerate(lambdas):
-        if verbose:
-            bu.progress_bar(yukind, nlambda)
-
-        ### Refer to the non-existent LaTeX document in ../documents/ to explain this.
-        ### It's a term necessary for every position
-        func = np.exp(-2. * rbead / yuklambda) * (1. + rbead / yuklambda) + rbead / yuklambda - 1.
-
-        ### Loop over the long array of values computing the force from a single finger
-        yukforcecurves = [[], [], []]
-        for ind, ypos in enumerate(beadposvec2):
 
-            ### sep parameter is assumed to be face to face
-            beadpos = [sep+rbead, ypos, height]
+        ### Refer to the non-existent LaTeX document in ../documents/ to 
+        ### explain this. It's a term necessary for every position
+        func = np.exp(-2. * rbead / yuklambda) * (1. + rbead / yuklambda) \
+                    + rbead / yuklambda - 1.
 
-            #### These are used to compute projections and thus need to maintain sign
-            xsep, ysep, zsep = np.meshgrid(beadpos[0] - xx2, \
-                                           beadpos[1] - yy2, \
-                                           beadpos[2] - zz2, indexing='ij')
+        for lower in range(0, nsep, step):
+            upper = min(lower + step, nsep)
+            sep = full_sep[:,lower:upper]
 
-            ### This isn't the full sep this time, because the Yukawa term depends on 
-            ### the distance between the point mass and the surface of the MS
-            s = np.sqrt(xsep**2 + ysep**2 + zsep**2) - rbead
+            ### The Yukawa term depends on the distance between the point
+            ### mass and the surface of the MS
+            yukterm = 3 * yuklambda**2 * func * (sep + yuklambda) \
+                        * np.exp( (rbead - sep) / yuklambda )
 
-            ### Refer to the non-existent LaTeX document in ../documents/ to explain this.
-            ### Two position dependent terms
-            prefac = -1.0 * ((2. * G * m2 * rhobead * np.pi) / (3. * (s + rbead)**2))
-            yukterm = 3 * yuklambda**2 * (s + rbead + yuklambda) * func * np.exp( - s / yuklambda )
+            contracted[:,:,lower:upper] = \
+                    contract(yukterm * inv_cube[:,lower:upper], lower, upper)
 
-            ### Build up the force curve at this point in the bead's position
-            yukforcecurves[0].append( np.sum(prefac * yukterm * xsep / (s + rbead)) ) 
-            yukforcecurves[1].append( np.sum(prefac * yukterm * ysep / (s + rbead)) )
-            yukforcecurves[2].append( np.sum(prefac * yukterm * zsep / (s + rbead)) )
+        yukforce[yukind] = prefac * gather(contracted)
 
-        yukforcecurves = np.array(yukforcecurves)
+    return Gforce, yukforce
 
-        ### Construct interpolating functions for the yukawa modified force term 
-        ### from only the central finger
-        yukX = interp.interp1d(beadposvec2, yukforcecurves[0], kind='cubic')
-        yukY = interp.interp1d(beadposvec2, yukforcecurves[1], kind='cubic')
-        yukZ = interp.interp1d(beadposvec2, yukforcecurves[2], kind='cubic')
 
 
-        ### Loop over the actual array of desired bead positions, and compute the
-        ### force from the full attractor at that position
-        newyuks = np.zeros((3, len(beadposvec)))
-        for ind, ypos in enumerate(beadposvec):
-            start = time.time()
-
-            ### Compute the contribution from the points external to the 
-            ### periodicity, if desired
-            if include_edge:
-
-                beadpos = [sep+rbead, ypos, height]
+def simulation(params):
+    '''Simulation function taking one argument and returning one object,
+       for use with joblib parallelization. Writes the force curves
+       for one point of the grid directly to the store.'''
 
-                #### These are used to compute projections and thus need to maintain sign
-                xsep, ysep, zsep = np.meshgrid(beadpos[0] - xx2, \
-                                               beadpos[1] - yy3, \
-                                               beadpos[2] - zz2, indexing='ij')
+    ### Parse the parameters
+    rbead, sep, height = params
 
-                ### This isn't the full sep this time, because the Yukawa term depends on 
-                ### the distance between the point mass and the surface of the MS
-                s = np.sqrt(xsep**2 + ysep**2 + zsep**2) - rbead
+    ### Some timing stuff
+    all_start = time.time()
 
-                ### Refer to the non-existent LaTeX document in ../documents/ to explain this.
-                ### Two position dependent terms
-                prefac = -1.0 * ((2. * G * m3 * rhobead * np.pi) / (3. * (rbead + s)**2))
-                yukterm = 3 * yuklambda**2 * (rbead + s + yuklambda) * func * np.exp( - s / yuklambda )
+    ### Compute the force from only the central finger, along the long
+    ### array of bead positions. This can be sampled and added up to build 
+    ### the force curve from the entire attractor. The xx2, yy2, and zz2 
+    ### arrays are subselections of the full attractor covering only a 
+    ### single period of the fingers. sep parameter is assumed to be face 
+    ### to face
+    Gforcecurves, yukforcecurves = \
+            point_mass_force_curves(sep+rbead, beadposvec2, height, rbead, \
+                                    xx2, yy2, zz2, m2, lambdas)
 
-                newyuks[0][ind] += np.sum(prefac * yukterm * xsep / (s + rbead))
-                newyuks[1][ind] += np.sum(prefac * yukterm * ysep / (s + rbead)) 
-                newyuks[2][ind] += np.sum(prefac * yukterm * zsep / (s + rbead)) 
+    ### Build interpolating functions from the long position vector
+    ### and the force due to a single period of the fingers, for every
+    ### axis (and lambda) at once
+    Gfunc = interp.interp1d(beadposvec2, Gforcecurves, kind='cubic')
+    yukfunc = interp.interp1d(beadposvec2, yukforcecurves, kind='cubic')
+
+    ### Compute the contribution from the points external to the 
+    ### periodicity, if desired
+    if include_edge:
+        newGs, newyuks = \
+            point_mass_force_curves(sep+rbead, beadposvec, height, rbead, \
+                                    xx2, yy3, zz2, m3, lambdas)
+    else:
+        newGs = np.zeros((3, len(beadposvec)))
+        newyuks = np.zeros((len(lambdas), 3, len(beadposvec)))
 
-            ### Find the finger in which we're in front of, and compute an 
-            ### equivalent position as if we're in front of the center finger
-            finger_ind, newypos = find_ind(ypos)
+    ### Find the finger in which we're in front of, and compute an 
+    ### equivalent position as if we're in front of the center finger
+    finger_ind, newypos = find_ind(beadposvec)
 
-            ### Sample the interpolating functions we built before, with one sample 
-            ### for each finger, properly displaced
-            newyuks[0][ind] += np.sum(yukX(newypos + (finger_inds+finger_ind) * full_period))
-            newyuks[1][ind] += np.sum(yukY(newypos + (finger_inds+finger_ind) * full_period))
-            newyuks[2][ind] += np.sum(yukZ(newypos + (finger_inds+finger_ind) * full_period))
-            stop = time.time()
-            calc_times.append(stop - start)
+    ### Sample the interpolating functions we built before, with one sample
+    ### for each finger, properly displaced
+    samples = newypos[:,np.newaxis] \
+                + (finger_inds[np.newaxis,:] + finger_ind[:,np.newaxis]) * full_period
+    newGs += np.sum(Gfunc(samples), axis=-1)
+    newyuks += np.sum(yukfunc(samples), axis=-1)
 
-        results_dic[rbead][sep][height][yuklambda] = \
-                    (newGs[0], newGs[1], newGs[2], newyuks[0], newyuks[1], newyuks[2])
+    ### Write the results to this point of the store
+    store = sim_store.SimStore(store_path)
+    store.write(rbead, sep, height, newGs, newyuks, lambdas=lambdas)
 
     all_stop = time.time()
 
     if verbose:
-        print("100% Done!")
-        print( 'Mean: {:0.3g} ms, Std.: {:0.3g} ms    per bead-position'\
-                .format(np.mean(calc_times)*1e3, np.std(calc_times)*1e3) )
-        print()
         print('Total Computation Time: {:0.1f}'.format(all_stop-all_start))
 
-        # input()
+    ### Return the parameters to avoid building up too much shit when computing
+    ### thousands of different parameters with a joblib implementation
+    return params
 
 
-    ### Save the results to a unique filename
-    results_dic['posvec'] = beadposvec
-    results_dic['rhobead'] = rhobead
-    results_dic['attractor_params'] = density.attractor_params
-    try:
-        pickle.dump(results_dic, open(full_filename, 'wb') )
-    except:
-        print("Save didn't work! : ", full_filename)
 
-    ### Return the file name to avoid building up too much shit when computing
-    ### thousands of different parameters with a joblib implementation
-    return full_filename
+### Allocate the store, or keep the existing one if it was made for the
+### same grid, and only simulate the points that aren't done yet
+store = sim_store.SimStore(store_path)
+resumed = store.create(rbeads, seps, heights, lambdas, beadposvec, \
+                       rhobead=rhobead, attractor_params=density.attractor_params)
 
-### Do the sim, yo
 param_list = list(itertools.product(rbeads, seps, heights))
+if resumed:
+    param_list = [param for param in param_list if not store.is_complete(*param)]
+    print('Resuming simulation, {:d} points left'.format(len(param_list)))
+
+### Do the sim, yo
 results = Parallel(n_jobs=ncore)(delayed(simulation)(param) for param in tqdm(param_list))
\ No newline at end of file
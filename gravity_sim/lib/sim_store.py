@@ -0,0 +1,217 @@
+import os, json
+
+import numpy as np
+
+#######################################################
+# This module implements a preallocated on-disk store
+# for the output of the gravity simulation, as an
+# alternative to one pickle per (rbead, sep, height).
+#
+# The store is a directory of .npy files, memory-mapped
+# by every worker. The force arrays are allocated once
+# for the whole geometry grid, in the layout used by
+# Gravdata.npy and yukdata.npy, with an extra leading
+# axis for the bead radius:
+#
+#   Gravdata: (Nrbead, Nsep, Npos, Nheight, 3)
+#   yukdata:  (Nrbead, Nlambda, Nsep, Npos, Nheight, 3)
+#
+# Each worker writes its own slice of the grid and then
+# sets its flag in a completion bitmap, so workers never
+# touch the same bytes and a scan that was interrupted
+# can be used as is, or resumed by only simulating the
+# points that aren't flagged.
+#
+# The files are only shared safely between processes
+# on the same machine (or a filesystem with coherent
+# shared mappings), which is how joblib runs them.
+#######################################################
+
+
+grid_fname = 'grid.json'
+data_fnames = {'Gravdata': 'Gravdata.npy', \
+               'yukdata': 'yukdata.npy', \
+               'complete': 'complete.npy'}
+
+axis_keys = ['rbeads', 'seps', 'heights', 'lambdas', 'posvec']
+
+### Relative tolerance when looking up a simulation parameter on its axis
+axis_rtol = 1.0e-6
+
+
+
+
+class SimStore:
+    '''Preallocated force arrays for a grid of (rbead, sep, height), with
+       a completion bitmap. The axes of the grid and the properties common
+       to every point are kept in a small JSON file next to the arrays.'''
+
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        self.grid = {}
+        if self.exists():
+            self.load_grid()
+
+
+    def exists(self):
+        return os.path.isfile(os.path.join(self.path, grid_fname))
+
+
+    def load_grid(self):
+        with open(os.path.join(self.path, grid_fname), 'r') as f:
+            grid = json.load(f)
+        for key in axis_keys:
+            grid[key] = np.array(grid[key])
+        self.grid = grid
+
+
+    def shapes(self):
+        nrbead, nsep, nheight, nlambda, npos = \
+                [len(self.grid[key]) for key in axis_keys]
+        return {'Gravdata': (nrbead, nsep, npos, nheight, 3), \
+                'yukdata': (nrbead, nlambda, nsep, npos, nheight, 3), \
+                'complete': (nrbead, nsep, nheight)}
+
+
+    def create(self, rbeads, seps, heights, lambdas, posvec, \
+               rhobead=0.0, attractor_params={}, overwrite=False):
+        '''Allocates the store for a grid of simulation parameters. If a
+           store with the same grid already exists, it's kept as is so
+           the scan can be resumed.
+
+           INPUTS: rbeads, seps, heights, arrays of simulation parameters
+                   lambdas, array of Yukawa lambdas, stored sorted
+                   posvec, array of bead positions along y
+                   rhobead, density of the bead
+                   attractor_params, dictionary of attractor properties
+                   overwrite, boolean to reallocate the store even if it
+                              exists with a different grid
+
+           OUTPUTS: resumed, boolean, True if an existing store was kept'''
+
+        grid = {'rbeads': np.sort(np.asarray(rbeads, dtype=float)), \
+                'seps': np.sort(np.asarray(seps, dtype=float)), \
+                'heights': np.sort(np.asarray(heights, dtype=float)), \
+                'lambdas': np.sort(np.asarray(lambdas, dtype=float)), \
+                'posvec': np.asarray(posvec, dtype=float), \
+                'rhobead': float(rhobead), \
+                'attractor_params': attractor_params}
+
+        if self.exists():
+            same = all(np.array_equal(self.grid[key], grid[key]) \
+                            for key in axis_keys) \
+                    and (self.grid['rhobead'] == grid['rhobead']) \
+                    and (json.dumps(self.grid['attractor_params'], sort_keys=True) \
+                            == json.dumps(attractor_params, sort_keys=True))
+            if same:
+                return True
+            if not overwrite:
+                raise ValueError('Simulation store {:s} exists with a different grid'\
+                                    .format(self.path))
+
+        os.makedirs(self.path, exist_ok=True)
+        self.grid = grid
+
+        ### Allocate the arrays first, so a store that has a grid file
+        ### always has its arrays
+        for key, shape in self.shapes().items():
+            dtype = bool if key == 'complete' else np.float64
+            arr = np.lib.format.open_memmap(self.data_path(key), mode='w+', \
+                                            dtype=dtype, shape=shape)
+            del arr
+
+        json_grid = dict(grid)
+        for key in axis_keys:
+            json_grid[key] = grid[key].tolist()
+        with open(os.path.join(self.path, grid_fname), 'w') as f:
+            json.dump(json_grid, f)
+
+        return False
+
+
+    def data_path(self, key):
+        return os.path.join(self.path, data_fnames[key])
+
+
+    def open(self, key, mode='r'):
+        '''Memory-maps one of the arrays ('Gravdata', 'yukdata' or
+           'complete'). Mode 'r+' is used to write.'''
+        return np.load(self.data_path(key), mmap_mode=mode)
+
+
+    def find_index(self, key, val):
+        '''Index of val on one of the axes of the grid.'''
+        axis = self.grid[key]
+        ind = int(np.argmin(np.abs(axis - val)))
+        if not np.isclose(axis[ind], val, rtol=axis_rtol, atol=0.0):
+            raise ValueError('{:0.4g} is not on the {:s} axis of the store'\
+                                .format(val, key))
+        return ind
+
+
+    def point_index(self, rbead, sep, height):
+        return (self.find_index('rbeads', rbead), self.find_index('seps', sep), \
+                self.find_index('heights', height))
+
+
+    def write(self, rbead, sep, height, Gforce, yukforce, lambdas=None):
+        '''Writes the force curves for one point of the grid, then flags it
+           as complete.
+
+           INPUTS: rbead, sep, height, simulation parameters of the point
+                   Gforce, (3, Npos) array of Newtonian forces
+                   yukforce, (Nlambda, 3, Npos) array of Yukawa forces
+                   lambdas, lambdas of the rows of yukforce, if they're
+                            not in the (sorted) order of the store'''
+
+        rind, sind, hind = self.point_index(rbead, sep, height)
+
+        yukforce = np.asarray(yukforce)
+        if lambdas is not None:
+            order = [self.find_index('lambdas', lamb) for lamb in lambdas]
+            sorted_yuk = np.zeros_like(yukforce)
+            sorted_yuk[order] = yukforce
+            yukforce = sorted_yuk
+
+        Gdat = self.open('Gravdata', mode='r+')
+        Gdat[rind,sind,:,hind,:] = np.transpose(Gforce)
+        Gdat.flush()
+        del Gdat
+
+        yukdat = self.open('yukdata', mode='r+')
+        yukdat[rind,:,sind,:,hind,:] = np.transpose(yukforce, (0,2,1))
+        yukdat.flush()
+        del yukdat
+
+        ### Only flag the point once its data is on disk
+        complete = self.open('complete', mode='r+')
+        complete[rind,sind,hind] = True
+        complete.flush()
+        del complete
+
+
+    def is_complete(self, rbead, sep, height):
+        return bool(self.open('complete')[self.point_index(rbead, sep, height)])
+
+
+    def missing(self, rbead=None):
+        '''Lists the (rbead, sep, height) points that haven't been written,
+           for all bead radii or a single one.'''
+        complete = np.array(self.open('complete'))
+        points = []
+        for rind, sind, hind in zip(*np.where(~complete)):
+            if (rbead is not None) and (rind != self.find_index('rbeads', rbead)):
+                continue
+            points.append((self.grid['rbeads'][rind], self.grid['seps'][sind], \
+                           self.grid['heights'][hind]))
+        return points
+
+
+    def get_data(self, rbead):
+        '''Read-only maps of the force arrays for one bead radius, laid
+           out like Gravdata.npy and yukdata.npy, and the completion
+           bitmap as a (Nsep, Nheight) array. Nothing is read until the
+           arrays are used.'''
+        rind = self.find_index('rbeads', rbead)
+        return self.open('Gravdata')[rind], self.open('yukdata')[rind], \
+               np.array(self.open('complete')[rind])
@@ -0,0 +1,352 @@
+import os, json, hashlib
+
+import h5py
+import numpy as np
+
+#######################################################
+# This module implements a chunked, columnar on-disk
+# store for the per-file results of an AggregateData
+# object, as an alternative to pickling everything.
+#
+# The store is a single HDF5 file. Each per-file
+# quantity is one dataset, with one row per file:
+# scalars (time, stage positions, bias, drive frequency,
+# ...) form a small table that can be read on its own,
+# and arrays (complex FFTs at the harmonics, errors,
+# binned data, ...) are stacked along the first axis.
+#
+# All datasets are resizable and chunked along rows,
+# so newly processed files are appended without
+# rewriting the rest, and a subset of files selected
+# from the scalar table can be read without touching
+# the others.
+#######################################################
+
+
+store_ext = '.aggh5'
+
+### Dtypes of the scalar columns. Every other column is an array,
+### with its dtype and row shape fixed by the first rows appended
+scalar_dtypes = {'time': np.uint64, \
+                 'fsamp': np.float64, \
+                 'nsamp': np.int64, \
+                 'drive_freq': np.float64, \
+                 'fund_ind': np.int64, \
+                 'drive_ind': np.int64, \
+                 'meandrive': np.float64, \
+                 'cantbias': np.float64, \
+                 'ax0pos': np.float64, \
+                 'ax1pos': np.float64, \
+                 'ax2pos': np.float64}
+
+### Along with the 'mtime' column, the hash of the processing parameters
+### makes the store a manifest of processed files (see find_up_to_date())
+str_keys = ['fname', 'param_hash']
+
+row_chunk = 64
+
+### Group holding the files that couldn't be processed, separate from the
+### columns since those rows don't have any data
+failure_group = 'failures'
+failure_keys = ['fname', 'error', 'param_hash']
+
+
+
+def get_store_path(savepath):
+    '''Swaps the extension of savepath (e.g. .agg) for the store's.'''
+    return os.path.splitext(savepath)[0] + store_ext
+
+
+
+def get_param_hash(params):
+    '''SHA1 hash of a JSON serializable dictionary of processing 
+       parameters, independent of the order of the keys.'''
+    return hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest()
+
+
+
+
+class AggStore:
+    '''Columnar store of per-file results. Rows are dictionaries keyed by
+       column name, with scalar, string or array values. The file is
+       only opened for the duration of each operation.'''
+
+    def __init__(self, path):
+        self.path = path
+
+
+    def exists(self):
+        return os.path.isfile(self.path)
+
+
+    def nrows(self):
+        if not self.exists():
+            return 0
+        with h5py.File(self.path, 'r') as f:
+            if 'fname' not in f:
+                return 0
+            return f['fname'].shape[0]
+
+
+    def get_params(self):
+        '''Returns the dictionary of parameters common to all rows, stored
+           as JSON in the file attributes.'''
+        if not self.exists():
+            return {}
+        with h5py.File(self.path, 'r') as f:
+            return json.loads(f.attrs.get('params', '{}'))
+
+
+    def set_params(self, params):
+        with h5py.File(self.path, 'a') as f:
+            f.attrs['params'] = json.dumps(params)
+
+
+    def clear(self):
+        '''Deletes the store from disk, to start from scratch.'''
+        if self.exists():
+            os.remove(self.path)
+
+
+    def append(self, rows, params=None):
+        '''Appends rows to the store, creating it if needed. Every row needs
+           the same keys, and array values need the same shape and dtype
+           as the rows already stored.
+
+           INPUTS: rows, list of dictionaries
+                   params, optional dictionary of parameters common to
+                           all rows (JSON serializable), which replaces
+                           the stored one
+
+           OUTPUTS: inds, array of the row indices of the new rows'''
+
+        rows = list(rows)
+
+        with h5py.File(self.path, 'a') as f:
+            if params is not None:
+                f.attrs['params'] = json.dumps(params)
+
+            nold = f['fname'].shape[0] if 'fname' in f else 0
+            if not len(rows):
+                return np.arange(nold, nold)
+
+            nnew = len(rows)
+            cols = {key: self.stack_column([row[key] for row in rows], key) \
+                        for key in rows[0].keys()}
+
+            ### Check everything before writing, so a bad row can't leave
+            ### columns with different numbers of rows
+            if nold and (set(cols.keys()) != set(self.column_keys(f))):
+                raise ValueError('Columns of new rows do not match store {:s}'\
+                                    .format(self.path))
+
+            for key, col in cols.items():
+                if (key in f) and (f[key].shape[1:] != col.shape[1:]):
+                    raise ValueError('Shape {:s} of column {:s} does not match store {:s}'\
+                                        .format(str(col.shape[1:]), key, \
+                                                str(f[key].shape[1:])))
+
+            for key, col in cols.items():
+                if key not in f:
+                    chunks = (row_chunk,) + col.shape[1:]
+                    f.create_dataset(key, shape=(0,)+col.shape[1:], \
+                                     maxshape=(None,)+col.shape[1:], \
+                                     dtype=col.dtype, chunks=chunks)
+                dset = f[key]
+                dset.resize(nold + nnew, axis=0)
+                dset[nold:] = col
+
+        return np.arange(nold, nold + nnew)
+
+
+    def append_failures(self, records, param_hash=''):
+        '''Records files that couldn't be processed, with the reason.
+
+           INPUTS: records, list of dictionaries with 'fname' and 'error'
+                   param_hash, hash of the processing parameters used'''
+
+        if not len(records):
+            return
+
+        cols = {'fname': [str(record['fname']) for record in records], \
+                'error': [str(record['error']) for record in records], \
+                'param_hash': [param_hash for record in records]}
+
+        with h5py.File(self.path, 'a') as f:
+            group = f.require_group(failure_group)
+            for key in failure_keys:
+                if key not in group:
+                    group.create_dataset(key, shape=(0,), maxshape=(None,), \
+                                         dtype=h5py.string_dtype(), \
+                                         chunks=(row_chunk,))
+                dset = group[key]
+                nold = dset.shape[0]
+                dset.resize(nold + len(records), axis=0)
+                dset[nold:] = np.array(cols[key], dtype=h5py.string_dtype())
+
+
+    def get_failures(self):
+        '''Reads the failure records, as a list of dictionaries.'''
+        if not self.exists():
+            return []
+        with h5py.File(self.path, 'r') as f:
+            if failure_group not in f:
+                return []
+            cols = {key: f[failure_group][key].asstr()[()] for key in failure_keys}
+        return [dict(zip(failure_keys, vals)) for vals in zip(*cols.values())]
+
+
+    @staticmethod
+    def column_keys(f):
+        return [key for key in f.keys() if key != failure_group]
+
+
+    @staticmethod
+    def stack_column(vals, key):
+        if key in str_keys:
+            return np.array([str(val) for val in vals], \
+                            dtype=h5py.string_dtype())
+        if key in scalar_dtypes:
+            return np.array(vals, dtype=scalar_dtypes[key])
+        return np.array([np.asarray(val) for val in vals])
+
+
+    def get_table(self, keys=None):
+        '''Reads the scalar columns (and file names) of every row.
+
+           OUTPUTS: table, dictionary of 1D arrays keyed by column'''
+
+        if keys is None:
+            keys = str_keys + list(scalar_dtypes.keys())
+
+        table = {}
+        if not self.exists():
+            return table
+
+        with h5py.File(self.path, 'r') as f:
+            for key in keys:
+                if key not in f:
+                    continue
+                if key in str_keys:
+                    table[key] = f[key].asstr()[()]
+                else:
+                    table[key] = f[key][()]
+        return table
+
+
+    def select(self, time_range=None, positions=(None,None,None), pos_tol=0.5, \
+               bias=None, bias_tol=1e-3):
+        '''Selects rows from the scalar table, without reading any arrays.
+
+           INPUTS: time_range, (start, stop) in ns, UNIX epoch
+                   positions, (ax0pos, ax1pos, ax2pos) of the attractor. None
+                              for an axis means that axis isn't used
+                   pos_tol, allowed position difference
+                   bias, attractor DC bias in [V]
+                   bias_tol, allowed bias difference in [V]
+
+           OUTPUTS: inds, sorted array of selected row indices'''
+
+        table = self.get_table(keys=['time', 'ax0pos', 'ax1pos', \
+                                     'ax2pos', 'cantbias'])
+        if not len(table):
+            return np.array([], dtype=int)
+
+        ### Files processed again are appended, so only their latest row counts
+        mask = np.zeros(len(table['time']), dtype=bool)
+        mask[self.latest_rows()] = True
+
+        if time_range is not None:
+            mask *= (table['time'] >= time_range[0]) * (table['time'] <= time_range[1])
+
+        for axind, axval in enumerate(positions):
+            if axval is not None:
+                axkey = 'ax{:d}pos'.format(axind)
+                mask *= np.abs(table[axkey] - axval) < pos_tol
+
+        if bias is not None:
+            mask *= np.abs(table['cantbias'] - bias) < bias_tol
+
+        return np.arange(len(mask))[mask]
+
+
+    def latest_rows(self):
+        '''Indices of the last row of each file name.'''
+        fnames = self.get_table(keys=['fname']).get('fname', np.array([]))
+        _, rev_inds = np.unique(fnames[::-1], return_index=True)
+        return np.sort(len(fnames) - 1 - rev_inds)
+
+
+    def find_up_to_date(self, fnames, param_hash):
+        '''Finds the files whose latest row in the store was processed with
+           the same parameters and from the same version of the file, i.e.
+           with the same modification time.
+
+           INPUTS: fnames, list of file names
+                   param_hash, hash of the current processing parameters
+
+           OUTPUTS: found, dictionary of row indices keyed by file name'''
+
+        if not self.nrows():
+            return {}
+
+        inds = self.latest_rows()
+        columns = self.read_columns(inds=inds, keys=['fname', 'mtime', 'param_hash'])
+        manifest = dict(zip(columns['fname'], \
+                            zip(inds, columns['mtime'], columns['param_hash'])))
+
+        found = {}
+        for fname in fnames:
+            if fname not in manifest:
+                continue
+            ind, mtime, row_hash = manifest[fname]
+            try:
+                if (os.stat(fname).st_mtime == mtime) and (row_hash == param_hash):
+                    found[fname] = ind
+            except OSError:
+                continue
+
+        return found
+
+
+    def read_columns(self, inds=None, keys=None):
+        '''Reads whole columns for a subset of rows.
+
+           INPUTS: inds, row indices to read, all rows if None
+                   keys, list of columns to read, all columns if None
+
+           OUTPUTS: columns, dictionary of arrays with rows in the
+                             order of inds'''
+
+        columns = {}
+        if not self.exists():
+            return columns
+
+        with h5py.File(self.path, 'r') as f:
+            if keys is None:
+                keys = self.column_keys(f)
+
+            if inds is not None:
+                ### h5py needs increasing indices, so read sorted then reorder
+                inds = np.asarray(inds, dtype=int)
+                uinds, inverse = np.unique(inds, return_inverse=True)
+
+            for key in keys:
+                dset = f[key].asstr() if key in str_keys else f[key]
+                if inds is None:
+                    columns[key] = dset[()]
+                elif not len(uinds):
+                    columns[key] = np.zeros((0,)+f[key].shape[1:], dtype=f[key].dtype)
+                else:
+                    columns[key] = dset[uinds][inverse]
+
+        return columns
+
+
+    def read_rows(self, inds=None, keys=None):
+        '''Same as read_columns(), split into a list of row dictionaries.'''
+        columns = self.read_columns(inds=inds, keys=keys)
+        if not len(columns):
+            return []
+        nrows = len(next(iter(columns.values())))
+        return [{key: columns[key][ind] for key in columns} for ind in range(nrows)]
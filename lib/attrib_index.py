@@ -0,0 +1,314 @@
+import os, sys, fnmatch, traceback
+
+import numpy as np
+
+from lazy_import import lazy_callable
+Parallel = lazy_callable('joblib', 'Parallel')
+delayed = lazy_callable('joblib', 'delayed')
+
+import configuration
+
+from bead_data_funcs import get_hdf5_attribs
+
+#######################################################
+# This module builds and maintains a columnar index of
+# the attributes of every .h5 file in a data directory.
+# Only the HDF5 attributes (or the .attr XML sidecar)
+# are read, never the sample data, so sorting and
+# selecting thousands of files by time, DC stage position
+# or attractor bias is cheap.
+#
+# One index is kept per directory, saved as a .npz file
+# next to the data, with one row per file keyed by the
+# file path and its modification time. Files that are
+# new or have been modified since the last scan are the
+# only ones re-read when the index is updated.
+#######################################################
+
+
+index_fname = '.attrib_index.npz'
+
+### Columns of the index, in addition to 'fname' and 'mtime'. The stage
+### settings are uncalibrated, exactly as they're stored in the attributes
+stage_keys = sorted(configuration.stage_inds.keys(), \
+                    key=lambda key: configuration.stage_inds[key])
+float_keys = ['fsamp', 'bias'] + stage_keys
+
+### Process-wide memo of loaded indices, keyed by directory
+_loaded_indices = {}
+
+
+
+def scan_file_attribs(fname):
+    '''Reads the attributes of a single file and reduces them to a row
+       of the index. Missing values are NaN (or 0 for the time).'''
+
+    row = {'time': np.uint64(0)}
+    for key in float_keys:
+        row[key] = np.nan
+
+    try:
+        attribs = get_hdf5_attribs(fname)
+    except Exception:
+        print("Couldn't load attributes for: ", fname)
+        return row
+
+    try:
+        row['time'] = np.uint64(attribs['time'])
+    except Exception:
+        pass
+
+    for key, attr_key in [('fsamp', 'Fsamp'), ('fsamp', 'fsamp')]:
+        if attr_key in attribs:
+            row[key] = float(attribs[attr_key])
+
+    try:
+        stage_settings = attribs['stage_settings']
+        for key in stage_keys:
+            row[key] = float(stage_settings[configuration.stage_inds[key]])
+    except Exception:
+        pass
+
+    ### Reproduce the logic of DataFile.load_monitor_data() for the DC value
+    ### on the attractor: if it's driven, the DC value is stored elsewhere
+    try:
+        bias = float(attribs['electrode_dc_vals'][0])
+        elec_settings = np.array(attribs['electrode_settings'])
+        driven = elec_settings[configuration.electrode_settings['driven'][0]]
+        dcval2 = elec_settings[configuration.electrode_settings['dc_vals2'][0]]
+        if driven == 1. and dcval2 != 0:
+            bias = float(dcval2)
+        row['bias'] = bias
+    except Exception:
+        pass
+
+    return row
+
+
+
+
+class AttribIndex:
+    '''Columnar table of file attributes for a single directory. Columns
+       are numpy arrays stored in self.columns, with aligned rows.'''
+
+    def __init__(self, dirname, load=True):
+        self.dirname = os.path.abspath(dirname)
+        self.path = os.path.join(self.dirname, index_fname)
+        self.columns = self.empty_columns()
+        self.rows = {}
+
+        if load:
+            self.load()
+
+
+    @staticmethod
+    def empty_columns():
+        columns = {'fname': np.array([], dtype=str), \
+                   'mtime': np.array([], dtype=np.float64), \
+                   'time': np.array([], dtype=np.uint64)}
+        for key in float_keys:
+            columns[key] = np.array([], dtype=np.float64)
+        return columns
+
+
+    def load(self):
+        '''Loads a previously saved index, if it exists.'''
+        if not os.path.isfile(self.path):
+            return
+        try:
+            with np.load(self.path) as npz:
+                columns = {key: npz[key] for key in npz.files}
+        except Exception:
+            print("Couldn't load attribute index: ", self.path)
+            traceback.print_exc()
+            return
+        if set(columns.keys()) != set(self.empty_columns().keys()):
+            # Index was written with different columns, start from scratch
+            return
+        self.columns = columns
+        self.rows = {fname: ind for ind, fname in enumerate(columns['fname'])}
+
+
+    def save(self, verbose=False):
+        '''Saves the index next to the data. Data directories aren't always
+           writeable, in which case the index only lives in memory.'''
+        try:
+            with open(self.path, 'wb') as f:
+                np.savez(f, **self.columns)
+        except (IOError, OSError):
+            if verbose:
+                print("Couldn't save attribute index: ", self.path)
+
+
+    def update(self, fnames=None, ncore=1, save=True, verbose=False):
+        '''Scans every file that's not in the index or has been modified
+           since it was indexed, then adds/replaces their rows.
+
+           INPUTS: fnames, list of files in this directory. If None, all
+                           of the (non-fpga) .h5 files are used
+                   ncore, number of jobs for the parallel scan
+                   save, boolean to write the updated index to disk
+
+           OUTPUTS: nscanned, number of files that were (re-)read'''
+
+        if fnames is None:
+            fnames = [os.path.join(self.dirname, fname) for fname in \
+                        fnmatch.filter(os.listdir(self.dirname), '*.h5') \
+                        if '_fpga.h5' not in fname]
+
+        fnames = [os.path.abspath(fname) for fname in fnames]
+
+        mtimes = {}
+        stale = []
+        for fname in fnames:
+            try:
+                mtime = os.stat(fname).st_mtime
+            except OSError:
+                continue
+            mtimes[fname] = mtime
+            ind = self.rows.get(fname, None)
+            if (ind is None) or (self.columns['mtime'][ind] != mtime):
+                stale.append(fname)
+
+        if not len(stale):
+            return 0
+
+        if verbose:
+            print('Indexing attributes of {:d} files in: {:s}'\
+                        .format(len(stale), self.dirname))
+            sys.stdout.flush()
+
+        new_rows = Parallel(n_jobs=ncore)(delayed(scan_file_attribs)(fname) \
+                                            for fname in stale)
+
+        ### Drop the old rows for re-scanned files, then append
+        keep = np.ones(len(self.columns['fname']), dtype=bool)
+        for fname in stale:
+            if fname in self.rows:
+                keep[self.rows[fname]] = False
+
+        columns = {key: self.columns[key][keep] for key in self.columns}
+        columns['fname'] = np.concatenate((columns['fname'], np.array(stale)))
+        columns['mtime'] = np.concatenate((columns['mtime'], \
+                                np.array([mtimes[fname] for fname in stale])))
+        for key in ['time'] + float_keys:
+            new_col = np.array([row[key] for row in new_rows], \
+                                dtype=self.columns[key].dtype)
+            columns[key] = np.concatenate((columns[key], new_col))
+
+        self.columns = columns
+        self.rows = {fname: ind for ind, fname in enumerate(columns['fname'])}
+
+        if save:
+            self.save(verbose=verbose)
+
+        return len(stale)
+
+
+    def lookup(self, fnames, key):
+        '''Returns the column 'key' for the given files, in order.'''
+        inds = [self.rows[os.path.abspath(fname)] for fname in fnames]
+        return self.columns[key][inds]
+
+
+
+
+def get_index(dirname, load=True):
+    '''Returns the (memoized) AttribIndex of a directory.'''
+    dirname = os.path.abspath(dirname)
+    if dirname not in _loaded_indices:
+        _loaded_indices[dirname] = AttribIndex(dirname, load=load)
+    return _loaded_indices[dirname]
+
+
+
+def get_file_attribs(fnames, keys=['time'], ncore=1, save=True, verbose=False):
+    '''Looks up indexed attributes for a list of files that can span many
+       directories, updating each directory's index as necessary.
+
+       INPUTS: fnames, list of .h5 file names
+               keys, list of index columns to return
+               ncore, number of jobs for scanning new/modified files
+               save, boolean to write updated indices to disk
+
+       OUTPUTS: outdic, dictionary of arrays aligned with fnames,
+                        keyed by column name'''
+
+    fnames = [os.path.abspath(fname) for fname in fnames]
+
+    by_dir = {}
+    for ind, fname in enumerate(fnames):
+        by_dir.setdefault(os.path.dirname(fname), []).append(ind)
+
+    outdic = {}
+    for key in keys:
+        outdic[key] = np.zeros(len(fnames), \
+                               dtype=AttribIndex.empty_columns()[key].dtype)
+
+    for dirname, inds in by_dir.items():
+        index = get_index(dirname)
+        dir_fnames = [fnames[ind] for ind in inds]
+        index.update(dir_fnames, ncore=ncore, save=save, verbose=verbose)
+        for key in keys:
+            outdic[key][inds] = index.lookup(dir_fnames, key)
+
+    return outdic
+
+
+
+def get_stage_positions(fnames, new_trap=False, ncore=1, save=True):
+    '''Returns the calibrated DC stage positions [um] and attractor
+       bias of a list of files, from the attribute index. With save=False
+       the index is only read, new entries aren't written to the data
+       directories (see get_file_attribs()).
+
+       OUTPUTS: positions, (3, Nfile) array of x, y and z DC positions
+                bias, (Nfile,) array of attractor DC bias'''
+
+    attribs = get_file_attribs(fnames, keys=['x DC', 'y DC', 'z DC', 'bias'], \
+                               ncore=ncore, save=save)
+    positions = np.array([attribs['x DC'], attribs['y DC'], attribs['z DC']])
+
+    ### Same as DataFile.calibrate_stage_position(), which only applies
+    ### the calibration to the stage settings for the old trap
+    if not new_trap:
+        positions *= configuration.stage_cal
+
+    return positions, attribs['bias']
+
+
+
+def select_files(fnames, time_range=None, positions=(None,None,None), \
+                 pos_tol=0.5, bias=None, bias_tol=1e-3, new_trap=False, \
+                 ncore=1):
+    '''Selects files by time, calibrated DC stage position and attractor
+       bias, without opening any of the sample data.
+
+       INPUTS: fnames, list of .h5 file names
+               time_range, (start, stop) in ns, UNIX epoch
+               positions, (x, y, z) DC stage positions in [um]. None for
+                          an axis means that axis isn't used to select
+               pos_tol, allowed position difference in [um]
+               bias, attractor DC bias in [V]
+               bias_tol, allowed bias difference in [V]
+
+       OUTPUTS: selected, list of file names matching all criteria'''
+
+    if not len(fnames):
+        return []
+
+    pos, biases = get_stage_positions(fnames, new_trap=new_trap, ncore=ncore)
+    mask = np.ones(len(fnames), dtype=bool)
+
+    if time_range is not None:
+        times = get_file_attribs(fnames, keys=['time'], ncore=ncore)['time']
+        mask *= (times >= time_range[0]) * (times <= time_range[1])
+
+    for axind, axval in enumerate(positions):
+        if axval is not None:
+            mask *= np.abs(pos[axind] - axval) < pos_tol
+
+    if bias is not None:
+        mask *= np.abs(biases - bias) < bias_tol
+
+    return [fname for fname, good in zip(fnames, mask) if good]
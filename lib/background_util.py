@@ -10,6 +10,7 @@ import matplotlib.pyplot as plt
 import matplotlib.mlab as mlab
 
 import bead_util as bu
+import attrib_index
 import configuration as config
 
 
@@ -55,28 +56,50 @@ class Background:
         self.temps = 'Temperatures not loaded'
 
 
-    def find_stage_positions(self, find_again=False):
+    def find_stage_positions(self, find_again=False, ncore=1, use_attrib_index=False):
         '''Loops over a list of file names, loads the attributes of each file, 
-           then extracts the DC stage position to sort through data.'''
+           then extracts the DC stage position to sort through data.
+
+           With use_attrib_index, the positions come from the attribute index
+           (see attrib_index.py), which only reads new or modified files. This
+           writes the index into the data directories, so it's off by default.'''
 
         axvecs = [{}, {}, {}]
-        nfiles = len(self.allfiles)
-        for fil_ind, fil in enumerate(self.allfiles):
-            bu.progress_bar(fil_ind, nfiles, suffix='sorting by stage pos')
 
-            df = bu.DataFile()
-            df.load_only_attribs(fil)
+        if use_attrib_index:
+            print('Sorting by stage pos...')
+            sys.stdout.flush()
+            positions, _ = attrib_index.get_stage_positions(self.allfiles, ncore=ncore)
+
+            for fil_ind, fil in enumerate(self.allfiles):
+                if np.isnan(positions[:,fil_ind]).any():
+                    continue
 
-            if df.badfile:
-                continue
+                for axind in [0,1,2]:
+                    axpos = positions[axind,fil_ind]
+                    if axpos not in list(axvecs[axind].keys()):
+                        axvecs[axind][axpos] = []
+                    axvecs[axind][axpos].append(fil)
 
-            df.calibrate_stage_position()
+        else:
+            nfiles = len(self.allfiles)
+            for fil_ind, fil in enumerate(self.allfiles):
+                bu.progress_bar(fil_ind, nfiles, suffix='sorting by stage pos')
+
+                df = bu.DataFile()
+                df.load_only_attribs(fil)
+
+                if df.badfile:
+                    continue
+
+                df.calibrate_stage_position()
+
+                for axind, axstr in enumerate(['x', 'y', 'z']):
+                    axpos = df.stage_settings[axstr + ' DC']
+                    if axpos not in list(axvecs[axind].keys()):
+                        axvecs[axind][axpos] = []
+                    axvecs[axind][axpos].append(fil)
 
-            for axind, axstr in enumerate(['x', 'y', 'z']):
-                axpos = df.stage_settings[axstr + ' DC']
-                if axpos not in list(axvecs[axind].keys()):
-                    axvecs[axind][axpos] = []
-                axvecs[axind][axpos].append(fil)
         pickle.dump(axvecs, open('/backgrounds/axvecs/' + self.bead + '_' + \
                                  self.parent_dir + '_axvecs.p', 'wb'))
 
@@ -1,19 +1,23 @@
 import h5py, os, re, glob, time, sys, fnmatch, inspect
-import subprocess, math, xmltodict, traceback
+import subprocess, math, traceback, threading
+import xml.etree.ElementTree as ElementTree
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import datetime as dt
 import dill as pickle 
 
-import matplotlib.pyplot as plt
-import matplotlib.cm as cmx
-import matplotlib.colors as colors
-import matplotlib.mlab as mlab
+from lazy_import import lazy_module
 
-import scipy.interpolate as interp
-import scipy.optimize as optimize
-import scipy.signal as signal
-import scipy.stats as stats
-import scipy.constants as constants
+plt = lazy_module('matplotlib.pyplot')
+cmx = lazy_module('matplotlib.cm')
+colors = lazy_module('matplotlib.colors')
+mlab = lazy_module('matplotlib.mlab')
+
+interp = lazy_module('scipy.interpolate')
+optimize = lazy_module('scipy.optimize')
+signal = lazy_module('scipy.signal')
+stats = lazy_module('scipy.stats')
+constants = lazy_module('scipy.constants')
 import scipy
 
 import configuration
@@ -150,20 +154,52 @@ def getdata_new(fname, gain_error=1.0, verbose=False):
 
 
 
-def get_hdf5_time(fname):
+def memmap_hdf5_dataset(fname, key):
+    '''Maps an HDF5 dataset straight from the file into a numpy array,
+       so nothing is read until it's used. This only works if the dataset
+       is stored contiguously and uncompressed (the LabVIEW default), 
+       otherwise the dataset is read into memory. The map is copy-on-write,
+       so the output can be modified without touching the file.'''
+
+    with h5py.File(fname, 'r') as f:
+        dset = f[key]
+        offset = dset.id.get_offset()
+        if (dset.chunks is None) and (dset.compression is None) \
+                and (offset is not None) and dset.size:
+            return np.memmap(fname, mode='c', dtype=dset.dtype, \
+                             shape=dset.shape, offset=offset)
+        else:
+            return dset[()]
+
+
+
+
+def get_hdf5_attribs(fname):
+    '''Loads only the attributes of a .h5 file, without touching any
+       of the sample data. Looks at the attributes of the old-style
+       dataset first, then at the file attributes, and finally at the 
+       XML sidecar (.attr) written by later versions of LabVIEW.'''
+
+    attribs = {}
     try:
-        try:
-            f = h5py.File(fname,'r')
-            attribs = copy_attribs(f.attrs)
-            f.close()
-        except:
-            attribs = {}
-            print('HDF5 file has no attributes object...')
+        with h5py.File(fname, 'r') as f:
+            if 'beads/data/pos_data' in f:
+                attribs = copy_attribs(f['beads/data/pos_data'].attrs)
+            if attribs == {}:
+                attribs = copy_attribs(f.attrs)
+    except Exception:
+        print('HDF5 file has no attributes object...')
+
+    if attribs == {}:
+        attribs = load_xml_attribs(fname)
+
+    return attribs
 
-        if attribs == {}:
-            attribs = load_xml_attribs(fname)
-        
 
+
+def get_hdf5_time(fname):
+    try:
+        attribs = get_hdf5_attribs(fname)
     except Exception:
         traceback.print_exc()
         # print "Warning, got no keys for: ", fname
@@ -180,138 +216,267 @@ def get_hdf5_time(fname):
 
 
 
-def load_xml_attribs(fname, types=['DBL', 'Array', 'Boolean', 'String']):
-    """LabVIEW Live HDF5 stopped saving datasets with attributes at some point.
-    To get around this, the attribute cluster is saved to an XML string and 
-    parsed into a dictionary here."""
+### Process-wide cache of parsed .attr sidecars. One dictionary per
+### directory, keyed by file name, holding the modification time and size
+### of the sidecar when it was parsed, the types that were kept, and the
+### attributes. An entry is only used if the sidecar hasn't changed since
+### it was parsed, and with the same types
+xml_attrib_cache = {}
+xml_attrib_cache_lock = threading.Lock()
 
-    attr_fname = fname[:-3] + '.attr'
 
-    xml = open(attr_fname, 'r').read()
 
-    attr_dict = xmltodict.parse(xml)['Cluster']
-    n_attr = int(attr_dict['NumElts'])
+def parse_xml_attribs(attr_fname, types=['DBL', 'Array', 'Boolean', 'String']):
+    '''Streams through the XML cluster written by LabVIEW, converting each
+       element as soon as it's complete and discarding it, instead of 
+       building the whole document tree. Arrays are decoded straight into
+       numpy float arrays.
 
-    new_attr_dict = {}
-    for attr_type in types:
-        try:
-            c_list = attr_dict[attr_type]
-        except Exception:
-            # traceback.print_exc()
+       Two differences with the older xmltodict parsing: arrays are numpy
+       arrays rather than lists, and empty values (<Val/>, e.g. an empty
+       string attribute) are '' rather than None.
+
+       INPUTS: attr_fname, path to the .attr file
+               types, list of LabVIEW types to keep, in the order they're
+                      added to the output
+
+       OUTPUTS: attr_dict, dictionary of attributes'''
+
+    by_type = {attr_type: [] for attr_type in types}
+
+    depth = 0
+    for event, elem in ElementTree.iterparse(attr_fname, events=('start', 'end')):
+        if event == 'start':
+            depth += 1
+            continue
+        depth -= 1
+
+        ### Only the direct children of the top level cluster are attributes
+        if depth != 1:
             continue
 
-        if type(c_list) != list:
-            c_list = [c_list]
+        attr_type = elem.tag
+        if attr_type in by_type:
+            new_key = elem.findtext('Name')
+
+            if attr_type == 'Array':
+                ### Every element of the array is a typed (Name, Val) pair
+                vals = [child.findtext('Val') for child in elem \
+                            if child.tag not in ('Name', 'Dimsize')]
+                val = np.array(vals, dtype=np.float64)
+            else:
+                val = elem.findtext('Val')
+
+            by_type[attr_type].append((new_key, val))
 
-        for item in c_list:
-            new_key = item['Name']
+        elem.clear()
+
+    new_attr_dict = {}
+    for attr_type in types:
+        for new_key, val in by_type[attr_type]:
 
             # Keep the time as 64 bit unsigned integer
             if new_key == 'Time' or new_key == 'time':
-                new_attr_dict['time'] = np.uint64(float(item['Val']))
+                new_attr_dict['time'] = np.uint64(float(val))
 
             # Conver 32-bit integers to their correct datatype
             elif (attr_type == 'I32'):
-                new_attr_dict[new_key] = np.int32(item['Val'])
+                new_attr_dict[new_key] = np.int32(val)
 
             # Convert single numbers/bool from their xml string representation
             elif (attr_type == 'DBL') or (attr_type == 'Boolean'):
-                new_attr_dict[new_key] = float(item['Val'])
-
-            # Convert arrays of numbers from their parsed xml
-            elif (attr_type == 'Array'):
-                new_arr = []
-                vals = item['DBL']
-                for val in vals:
-                    new_arr.append(float(val['Val']))
-                new_attr_dict[new_key] = new_arr
+                new_attr_dict[new_key] = float(val)
 
-            # Move string attributes to new attribute dictionary
-            elif (attr_type == 'String'):
-                new_attr_dict[new_key] = item['Val']
+            # Arrays were already decoded, strings are kept as they are
+            elif (attr_type == 'Array') or (attr_type == 'String'):
+                new_attr_dict[new_key] = val
 
             # Catch-all for unknown attributes, keep as string
             else:
                 print('Found an attribute whose type is unknown. Left as string...')
-                new_attr_dict[new_key] = item['Val']
-
-    # assert n_attr == len(new_attr_dict.keys())
+                new_attr_dict[new_key] = val
 
     return new_attr_dict
 
 
 
+def copy_xml_attribs(attribs):
+    '''Copies a cached attribute dictionary, and its arrays, so callers
+       can modify the output without touching the cache.'''
+    return {key: (np.copy(val) if isinstance(val, np.ndarray) else val) \
+                for key, val in attribs.items()}
+
+
+
+def load_xml_attribs(fname, types=['DBL', 'Array', 'Boolean', 'String'], \
+                     cache=True):
+    """LabVIEW Live HDF5 stopped saving datasets with attributes at some point.
+    To get around this, the attribute cluster is saved to an XML string and 
+    parsed into a dictionary here. Parsed attributes are cached per directory
+    and re-parsed only if the .attr file's modification time or size has
+    changed, so loading the same file repeatedly is cheap.
+
+    INPUTS: fname, path to the .h5 file (or directly to its .attr sidecar)
+            types, list of LabVIEW types to keep
+            cache, boolean to use (and fill) the attribute cache
+
+    OUTPUTS: attr_dict, dictionary of attributes, with arrays as numpy
+                        float arrays"""
+
+    attr_fname = fname if fname.endswith('.attr') else fname[:-3] + '.attr'
+
+    if not cache:
+        return parse_xml_attribs(attr_fname, types=types)
+
+    stat = os.stat(attr_fname)
+    dirname, basename = os.path.split(os.path.abspath(attr_fname))
+    stamp = (stat.st_mtime_ns, stat.st_size, tuple(types))
+
+    with xml_attrib_cache_lock:
+        dir_cache = xml_attrib_cache.setdefault(dirname, {})
+        entry = dir_cache.get(basename, None)
+
+    if (entry is None) or (entry[0] != stamp):
+        entry = (stamp, parse_xml_attribs(attr_fname, types=types))
+        with xml_attrib_cache_lock:
+            dir_cache[basename] = entry
+
+    return copy_xml_attribs(entry[1])
+
+
+
+def load_xml_attribs_many(fnames, types=['DBL', 'Array', 'Boolean', 'String'], \
+                          nthreads=8, cache=True):
+    '''Loads the .attr sidecars of many files with a pool of threads, which
+       mostly overlaps the time spent waiting on the filesystem (the data
+       is often on network storage). Files whose attributes can't be loaded
+       get an empty dictionary.
+
+       INPUTS: fnames, list of .h5 file names
+               types, list of LabVIEW types to keep
+               nthreads, number of threads in the pool
+               cache, boolean to use (and fill) the attribute cache
+
+       OUTPUTS: attribs_list, list of attribute dictionaries, aligned
+                              with fnames'''
+
+    def load_one(fname):
+        try:
+            return load_xml_attribs(fname, types=types, cache=cache)
+        except Exception:
+            print("Couldn't load attributes for: ", fname)
+            return {}
+
+    if nthreads <= 1 or len(fnames) <= 1:
+        return [load_one(fname) for fname in fnames]
+
+    with ThreadPoolExecutor(max_workers=nthreads) as pool:
+        return list(pool.map(load_one, fnames))
+
+
+
+def clear_xml_attrib_cache(dirname=None):
+    '''Empties the attribute cache, for a single directory or entirely.'''
+    with xml_attrib_cache_lock:
+        if dirname is None:
+            xml_attrib_cache.clear()
+        else:
+            xml_attrib_cache.pop(os.path.abspath(dirname), None)
+
+
+
+
+def assemble_fpga_time(high, low):
+    '''Builds the U64 FPGA timestamps (UNIX epoch in nanoseconds) from
+       the high and low I32 words. Works elementwise on arrays.'''
+    high = np.asarray(high).astype(np.uint32).astype(np.uint64)
+    low = np.asarray(low).astype(np.uint32).astype(np.uint64)
+    return np.left_shift(high, np.uint64(32)) + low
+
+
+
+def find_fpga_timestamp(fpga_dat, timestamp, diff_thresh, interleave_num, \
+                        verbose=False):
+    '''Finds the index of the first U64 timestamp in a stream of I32s
+       by assembling every candidate (high, low) pair at once and 
+       comparing to the expected time with a single vectorized test.
+
+       Since the stream is interleaved, the first timestamp should live
+       within the first frame, so those candidate offsets are checked
+       first. The full stream is only scanned if that fails, which
+       reproduces the first-match behavior of the old elementwise search.
+
+       INPUTS:  fpga_dat, stream of I32s from the FPGA
+                timestamp, expected time in seconds (UNIX epoch)
+                diff_thresh, allowed |timestamp - fpga_time| in seconds
+                interleave_num, number of I32s per interleaved frame
+
+       OUTPUTS: tind, index of the high word of the first timestamp'''
+
+    for stop in [interleave_num + 1, len(fpga_dat)]:
+        stop = min(stop, len(fpga_dat))
+        candidates = assemble_fpga_time(fpga_dat[:stop-1], fpga_dat[1:stop])
+        diffs = np.abs(timestamp - candidates.astype(np.float64) * 10**(-9))
+        found = np.flatnonzero(diffs < diff_thresh)
+        if len(found):
+            tind = int(found[0])
+            if verbose:
+                print("found timestamp  : ", float(candidates[tind]) * 10**(-9))
+                print("comparison time  : ", timestamp) 
+            return tind
+
+    raise ValueError("Couldn't find an FPGA timestamp within " \
+                     + "{:0.1f} s of {:0.1f}".format(diff_thresh, timestamp))
+
+
+
+def deinterleave_fpga_stream(fpga_dat, interleave_num, tind=0):
+    '''De-interleaves a stream of I32s into frames. Since the FIFO read 
+       request is asynchronous, the first timestamp isn't necessarily
+       the first element of the stream, and the last frame can come out
+       incomplete. Only complete frames starting at tind are kept.
+
+       INPUTS:  fpga_dat, stream of I32s from the FPGA
+                interleave_num, number of I32s per interleaved frame
+                tind, index of the first element of the first frame
+
+       OUTPUTS: frames, (nframes, interleave_num) view of fpga_dat, such
+                        that frames[:,k] is the k-th channel (also a view)'''
+
+    fpga_dat = np.asarray(fpga_dat)
+    nframes = (len(fpga_dat) - tind) // interleave_num
+    return fpga_dat[tind:tind+nframes*interleave_num].reshape(nframes, interleave_num)
+
+
+
+def _get_timestamp_search_params(timestamp, diff_thresh):
+    '''Converts the file timestamp (ns) into seconds. If no timestamp is
+       given, use the current time and set the timing threshold to one 
+       year. This threshold is used to identify the timestamp in the
+       stream of I32s'''
+    if timestamp == 0.0:
+        return time.time(), 365.0 * 24.0 * 3600.0
+    else:
+        return timestamp * (10.0**(-9)), diff_thresh
+
+
+
 
 def extract_quad(quad_dat, timestamp, verbose=False):
     '''Reads a stream of I32s, finds the first timestamp,
        then starts de-interleaving the demodulated data
-       from the FPGA'''
-    
-    if timestamp == 0.0:
-        # if no timestamp given, use current time
-        # and set the timing threshold for 1 month.
-        # This threshold is used to identify the timestamp 
-        # in the stream of I32s
-        timestamp = time.time()
-        diff_thresh = 365.0 * 24.0 * 3600.0
-    else:
-        timestamp = timestamp * (10.0**(-9))
-        diff_thresh = 60.0
-
-    for ind, dat in enumerate(quad_dat): ## % 12
-        # Assemble time stamp from successive I32s, since
-        # it's a 64 bit object
-        with warnings.catch_warnings():
-            warnings.simplefilter('ignore')
-            high = np.uint32(quad_dat[ind])
-            low = np.uint32(quad_dat[ind+1])
-            dattime = (high.astype(np.uint64) << np.uint64(32)) \
-                      + low.astype(np.uint64)
-
-        # Time stamp from FPGA is a U64 with the UNIX epoch 
-        # time in nanoseconds, synced to the host's clock
-        if (np.abs(timestamp - float(dattime) * 10**(-9)) < diff_thresh):
-            if verbose:
-                print("found timestamp  : ", float(dattime) * 10**(-9))
-                print("comparison time  : ", timestamp) 
-            break
-
-    # Once the timestamp has been found, select each dataset
-    # wit thhe appropriate decimation of the primary array
-    quad_time_high = np.uint32(quad_dat[ind::12])
-    quad_time_low = np.uint32(quad_dat[ind+1::12])
-    if len(quad_time_low) != len(quad_time_high):
-        quad_time_high = quad_time_high[:-1]
-    quad_time = np.left_shift(quad_time_high.astype(np.uint64), np.uint64(32)) \
-                  + quad_time_low.astype(np.uint64)
-
-    amp = [quad_dat[ind+2::12], quad_dat[ind+3::12], quad_dat[ind+4::12], \
-           quad_dat[ind+5::12], quad_dat[ind+6::12]]
-    phase = [quad_dat[ind+7::12], quad_dat[ind+8::12], quad_dat[ind+9::12], \
-             quad_dat[ind+10::12], quad_dat[ind+11::12]]
-            
-
-    # Since the FIFO read request is asynchronous, sometimes
-    # the timestamp isn't first to come out, but the total amount of data
-    # read out is a multiple of 12 (2 time + 5 amp + 5 phase) so an
-    # amplitude or phase channel ends up with less samples.
-    # The following is coded very generally
-
-    min_len = 10.0**9  # Assumes we never more than 1 billion samples
-    for ind in [0,1,2,3,4]:
-        if len(amp[ind]) < min_len:
-            min_len = len(amp[ind])
-        if len(phase[ind]) < min_len:
-            min_len = len(phase[ind])
-
-    # Re-size everything by the minimum length and convert to numpy array
-    quad_time = np.array(quad_time[:min_len])
-    for ind in [0,1,2,3,4]:
-        amp[ind]   = amp[ind][:min_len]
-        phase[ind] = phase[ind][:min_len]
-    amp = np.array(amp)
-    phase = np.array(phase)
-      
+       from the FPGA. Frames are 12 I32s long 
+       (2 time + 5 amp + 5 phase)'''
+
+    timestamp, diff_thresh = _get_timestamp_search_params(timestamp, 60.0)
+    tind = find_fpga_timestamp(quad_dat, timestamp, diff_thresh, 12, \
+                               verbose=verbose)
+
+    frames = deinterleave_fpga_stream(quad_dat, 12, tind=tind)
+
+    quad_time = assemble_fpga_time(frames[:,0], frames[:,1])
+    amp = frames[:,2:7].T
+    phase = frames[:,7:12].T
 
     return quad_time, amp, phase
 
@@ -321,44 +486,15 @@ def extract_quad(quad_dat, timestamp, verbose=False):
 
 
 def extract_quad_new(quad_dat, verbose=False):
-    '''Reads a stream of I32s, finds the first timestamp,
-       then starts de-interleaving the demodulated data
-       from the FPGA'''
-
-    quad_time_high = np.uint32(quad_dat[10::12])
-    quad_time_low = np.uint32(quad_dat[11::12])
-    if len(quad_time_low) != len(quad_time_high):
-        quad_time_high = quad_time_high[:-1]
-    quad_time = np.left_shift(quad_time_high.astype(np.uint64), np.uint64(32)) \
-                  + quad_time_low.astype(np.uint64)
-
-    amp = [quad_dat[0::12], quad_dat[1::12], quad_dat[2::12], \
-           quad_dat[3::12], quad_dat[4::12]]
-    phase = [quad_dat[5::12], quad_dat[6::12], quad_dat[7::12], \
-             quad_dat[8::12], quad_dat[9::12]]
-            
-
-    # Since the FIFO read request is asynchronous, sometimes
-    # the timestamp isn't first to come out, but the total amount of data
-    # read out is a multiple of 12 (2 time + 5 amp + 5 phase) so an
-    # amplitude or phase channel ends up with less samples.
-    # The following is coded very generally
-
-    min_len = 10.0**9  # Assumes we never more than 1 billion samples
-    for ind in [0,1,2,3,4]:
-        if len(amp[ind]) < min_len:
-            min_len = len(amp[ind])
-        if len(phase[ind]) < min_len:
-            min_len = len(phase[ind])
-
-    # Re-size everything by the minimum length and convert to numpy array
-    quad_time = np.array(quad_time[:min_len])
-    for ind in [0,1,2,3,4]:
-        amp[ind]   = amp[ind][:min_len]
-        phase[ind] = phase[ind][:min_len]
-    amp = np.array(amp)
-    phase = np.array(phase)
-      
+    '''De-interleaves the demodulated data from the FPGA of the new
+       trap, where the frame starts with the data and the timestamp is
+       last (5 amp + 5 phase + 2 time)'''
+
+    frames = deinterleave_fpga_stream(quad_dat, 12)
+
+    quad_time = assemble_fpga_time(frames[:,10], frames[:,11])
+    amp = frames[:,0:5].T
+    phase = frames[:,5:10].T
 
     return quad_time, amp, phase
 
@@ -374,87 +510,21 @@ def extract_quad_new(quad_dat, verbose=False):
 def extract_xyz(xyz_dat, timestamp, verbose=False):
     '''Reads a stream of I32s, finds the first timestamp,
        then starts de-interleaving the demodulated data
-       from the FPGA'''
-    
-    if timestamp == 0.0:
-        # if no timestamp given, use current time
-        # and set the timing threshold for 1 year.
-        # This threshold is used to identify the timestamp 
-        # in the stream of I32s
-        timestamp = time.time()
-        diff_thresh = 365.0 * 24.0 * 3600.0
-    else:
-        timestamp = timestamp * (10.0**(-9))
-        # 2-minute difference allowed for longer integrations
-        diff_thresh = 120.0
-
-
-    for ind, dat in enumerate(xyz_dat):
-        # Assemble time stamp from successive I32s, since
-        # it's a 64 bit object
-        with warnings.catch_warnings():
-            warnings.simplefilter('ignore')
-            high = np.uint32(xyz_dat[ind])
-            low = np.uint32(xyz_dat[ind+1])
-            dattime = (high.astype(np.uint64) << np.uint64(32)) \
-                      + low.astype(np.uint64)
-
-        # Time stamp from FPGA is a U64 with the UNIX epoch 
-        # time in nanoseconds, synced to the host's clock
-        if (np.abs(timestamp - float(dattime) * 10**(-9)) < diff_thresh):
-            tind = ind
-            if verbose:
-                print("found timestamp  : ", float(dattime) * 10**(-9))
-                print("comparison time  : ", timestamp) 
-            break
-
-    # Once the timestamp has been found, select each dataset
-    # wit thhe appropriate decimation of the primary array
-    xyz_time_high = np.uint32(xyz_dat[tind::11])
-    xyz_time_low = np.uint32(xyz_dat[tind+1::11])
-    if len(xyz_time_low) != len(xyz_time_high):
-        xyz_time_high = xyz_time_high[:-1]
-
-    xyz_time = np.left_shift(xyz_time_high.astype(np.uint64), np.uint64(32)) \
-                  + xyz_time_low.astype(np.uint64)
+       from the FPGA. Frames are 11 I32s long
+       (2 time + 2 xy_2 + 3 xyz + sync + 3 fb)'''
 
-    xyz = [xyz_dat[tind+4::11], xyz_dat[tind+5::11], xyz_dat[tind+6::11]]
-    xy_2 = [xyz_dat[tind+2::11], xyz_dat[tind+3::11]]
-    xyz_fb = [xyz_dat[tind+8::11], xyz_dat[tind+9::11], xyz_dat[tind+10::11]]
-    
-    sync = np.int32(xyz_dat[tind+7::11])
+    # 2-minute difference allowed for longer integrations
+    timestamp, diff_thresh = _get_timestamp_search_params(timestamp, 120.0)
+    tind = find_fpga_timestamp(xyz_dat, timestamp, diff_thresh, 11, \
+                               verbose=verbose)
 
-    #plt.plot(np.int32(xyz_dat[tind+1::9]).astype(np.uint64) << np.uint64(32) \
-    #         + np.int32(xyz_dat[tind::9]).astype(np.uint64) )
-    #plt.show()
+    frames = deinterleave_fpga_stream(xyz_dat, 11, tind=tind)
 
-    # Since the FIFO read request is asynchronous, sometimes
-    # the timestamp isn't first to come out, but the total amount of data
-    # read out is a multiple of 5 (2 time + X + Y + Z) so the Z
-    # channel usually  ends up with less samples.
-    # The following is coded very generally
-
-    min_len = 10.0**9  # Assumes we never more than 1 billion samples
-    for ind in [0,1,2]:
-        if len(xyz[ind]) < min_len:
-            min_len = len(xyz[ind])
-        if len(xyz_fb[ind]) < min_len:
-            min_len = len(xyz_fb[ind])
-        if ind != 2:
-            if len(xy_2[ind]) < min_len:
-                min_len = len(xy_2[ind])
-
-    # Re-size everything by the minimum length and convert to numpy array
-    xyz_time = np.array(xyz_time[:min_len])
-    sync = np.array(sync[:min_len])
-    for ind in [0,1,2]:
-        xyz[ind]    = xyz[ind][:min_len]
-        xyz_fb[ind] = xyz_fb[ind][:min_len]
-        if ind != 2:
-            xy_2[ind] = xy_2[ind][:min_len]
-    xyz = np.array(xyz)
-    xyz_fb = np.array(xyz_fb)
-    xy_2 = np.array(xy_2)
+    xyz_time = assemble_fpga_time(frames[:,0], frames[:,1])
+    xy_2 = frames[:,2:4].T
+    xyz = frames[:,4:7].T
+    sync = frames[:,7].astype(np.int32, copy=False)
+    xyz_fb = frames[:,8:11].T
 
     return xyz_time, xyz, xy_2, xyz_fb, sync
 
@@ -463,54 +533,17 @@ def extract_xyz(xyz_dat, timestamp, verbose=False):
 
 
 def extract_xyz_new(xyz_dat, verbose=False):
-    '''Reads a stream of I32s, finds the first timestamp,
-       then starts de-interleaving the demodulated data
-       from the FPGA'''
-    
-    xyz_time_high = np.uint32(xyz_dat[9::11])
-    xyz_time_low = np.uint32(xyz_dat[10::11])
-    if len(xyz_time_low) != len(xyz_time_high):
-        xyz_time_high = xyz_time_high[:-1]
-
-    xyz_time = np.left_shift(xyz_time_high.astype(np.uint64), np.uint64(32)) \
-                  + xyz_time_low.astype(np.uint64)
-
-    xyz = [xyz_dat[2::11], xyz_dat[3::11], xyz_dat[4::11]]
-    xy_2 = [xyz_dat[0::11], xyz_dat[1::11]]
-    sync = np.int32(xyz_dat[5::11])
-    xyz_fb = [xyz_dat[6::11], xyz_dat[7::11], xyz_dat[8::11]]
+    '''De-interleaves the demodulated data from the FPGA of the new
+       trap, where the frame starts with the data and the timestamp is
+       last (2 xy_2 + 3 xyz + sync + 3 fb + 2 time)'''
     
-    #plt.plot(np.int32(xyz_dat[tind+1::9]).astype(np.uint64) << np.uint64(32) \
-    #         + np.int32(xyz_dat[tind::9]).astype(np.uint64) )
-    #plt.show()
+    frames = deinterleave_fpga_stream(xyz_dat, 11)
 
-    # Since the FIFO read request is asynchronous, sometimes
-    # the timestamp isn't first to come out, but the total amount of data
-    # read out is a multiple of 5 (2 time + X + Y + Z) so the Z
-    # channel usually  ends up with less samples.
-    # The following is coded very generally
-
-    min_len = 10.0**9  # Assumes we never more than 1 billion samples
-    for ind in [0,1,2]:
-        if len(xyz[ind]) < min_len:
-            min_len = len(xyz[ind])
-        if len(xyz_fb[ind]) < min_len:
-            min_len = len(xyz_fb[ind])
-        if ind != 2:
-            if len(xy_2[ind]) < min_len:
-                min_len = len(xy_2[ind])
-
-    # Re-size everything by the minimum length and convert to numpy array
-    xyz_time = np.array(xyz_time[:min_len])
-    sync = np.array(sync[:min_len])
-    for ind in [0,1,2]:
-        xyz[ind]    = xyz[ind][:min_len]
-        xyz_fb[ind] = xyz_fb[ind][:min_len]
-        if ind != 2:
-            xy_2[ind] = xy_2[ind][:min_len]
-    xyz = np.array(xyz)
-    xyz_fb = np.array(xyz_fb)
-    xy_2 = np.array(xy_2)
+    xyz_time = assemble_fpga_time(frames[:,9], frames[:,10])
+    xy_2 = frames[:,0:2].T
+    xyz = frames[:,2:5].T
+    sync = frames[:,5].astype(np.int32, copy=False)
+    xyz_fb = frames[:,6:9].T
 
     return xyz_time, xyz, xy_2, xyz_fb, sync
 
@@ -524,76 +557,21 @@ def extract_xyz_new(xyz_dat, verbose=False):
 def extract_power(pow_dat, timestamp, verbose=False):
     '''Reads a stream of I32s, finds the first timestamp,
        then starts de-interleaving the demodulated data
-       from the FPGA'''
+       from the FPGA. Frames are 4 I32s long 
+       (2 time + power + power_fb)'''
 
     interleave_num = 4
     
-    if timestamp == 0.0:
-        # if no timestamp given, use current time
-        # and set the timing threshold for 1 year.
-        # This threshold is used to identify the timestamp 
-        # in the stream of I32s
-        timestamp = time.time()
-        diff_thresh = 365.0 * 24.0 * 3600.0
-    else:
-        timestamp = timestamp * (10.0**(-9))
-        # 2-minute difference allowed for longer integrations
-        diff_thresh = 120.0
-
-
-    for ind, dat in enumerate(pow_dat):
-        # Assemble time stamp from successive I32s, since
-        # it's a 64 bit object
-        with warnings.catch_warnings():
-            warnings.simplefilter('ignore')
-            high = np.uint32(pow_dat[ind])
-            low = np.uint32(pow_dat[ind+1])
-            dattime = (high.astype(np.uint64) << np.uint64(32)) \
-                      + low.astype(np.uint64)
-
-        # Time stamp from FPGA is a U64 with the UNIX epoch 
-        # time in nanoseconds, synced to the host's clock
-        if (np.abs(timestamp - float(dattime) * 10**(-9)) < diff_thresh):
-            tind = ind
-            if verbose:
-                print("found timestamp  : ", float(dattime) * 10**(-9))
-                print("comparison time  : ", timestamp) 
-            break
-
-    # Once the timestamp has been found, select each dataset
-    # with the appropriate decimation of the primary array
-    pow_time_high = np.uint32(pow_dat[tind::interleave_num])
-    pow_time_low = np.uint32(pow_dat[tind+1::interleave_num])
-    if len(pow_time_low) != len(pow_time_high):
-        pow_time_high = pow_time_high[:-1]
-
-    pow_time = np.left_shift(pow_time_high.astype(np.uint64), np.uint64(32)) \
-                  + pow_time_low.astype(np.uint64)
-
-    power = pow_dat[tind+2::interleave_num]
-    power_fb = pow_dat[tind+3::interleave_num]
-    # power_fb = np.zeros_like(power)
-
-    #plt.plot(np.int32(xyz_dat[tind+1::9]).astype(np.uint64) << np.uint64(32) \
-    #         + np.int32(xyz_dat[tind::9]).astype(np.uint64) )
-    #plt.show()
+    # 2-minute difference allowed for longer integrations
+    timestamp, diff_thresh = _get_timestamp_search_params(timestamp, 120.0)
+    tind = find_fpga_timestamp(pow_dat, timestamp, diff_thresh, interleave_num, \
+                               verbose=verbose)
 
-    # Since the FIFO read request is asynchronous, sometimes
-    # the timestamp isn't first to come out, but the total amount of data
-    # read out is a multiple of 3 (2 time + power) so the power
-    # channel usually  ends up with less samples.
-    # The following is coded very generally
+    frames = deinterleave_fpga_stream(pow_dat, interleave_num, tind=tind)
 
-    min_len = 10.0**9  # Assumes we never more than 1 billion samples
-    if len(power) < min_len:
-        min_len = len(power)
-    if len(power_fb) < min_len:
-        min_len = len(power_fb)
-
-    # Re-size everything by the minimum length and convert to numpy array
-    pow_time = np.array(pow_time[:min_len])
-    power = np.array(power[:min_len])
-    power_fb = np.array(power_fb[:min_len])
+    pow_time = assemble_fpga_time(frames[:,0], frames[:,1])
+    power = frames[:,2]
+    power_fb = frames[:,3]
 
     return pow_time, power, power_fb
 
@@ -669,18 +647,18 @@ def get_fpga_data(fname, timestamp=0.0, verbose=False):
 
 
 
-def sync_and_crop_fpga_data(fpga_dat, timestamp, nsamp, encode_bin, \
-                            encode_len=500, plot_sync=False):
-    '''Align the psuedo-random bits the DAQ card spits out to the FPGA
-       to synchronize the acquisition of the FPGA.'''
+def find_fpga_sync_offset(sync_dat, encode_bin, encode_len=500, plot_sync=False):
+    '''Finds the sample of the FPGA data where the DAQ acquisition starts
+       by correlating the digitized sync line with the psuedo-random bits
+       of the DAQ card.
 
-    out = {}
-    notNone = False
-    for key in fpga_dat:
-        if type(fpga_dat[key]) != type(None):
-            notNone = True
-    if not notNone:
-        return fpga_dat
+       INPUTS:  sync_dat, I32 representation of the FPGA sync channel
+                encode_bin, encoded bits from the DAQ file
+                encode_len, maximum number of bits to use
+
+       OUTPUTS: off_ind, index of the first synchronized FPGA sample
+                sync_dat_bin, binarized sync data (first 10*encode_len
+                              samples only)'''
 
     # Cutoff irrelevant zeros
     if len(encode_bin) < encode_len:
@@ -690,7 +668,6 @@ def sync_and_crop_fpga_data(fpga_dat, timestamp, nsamp, encode_bin, \
     # Load the I32 representation of the synchronization data
     # At each 500 kHz sample of the FPGA, the state of the sync
     # digital pin is sampled: True->(I32+1), False->(I32-1)
-    sync_dat = fpga_dat['sync']
 
     #plt.plot(sync_dat)
     #plt.show()
@@ -724,6 +701,27 @@ def sync_and_crop_fpga_data(fpga_dat, timestamp, nsamp, encode_bin, \
         plt.legend()
         plt.show()
 
+    return off_ind, sync_dat_bin
+
+
+
+def sync_and_crop_fpga_data(fpga_dat, timestamp, nsamp, encode_bin, \
+                            encode_len=500, plot_sync=False):
+    '''Align the psuedo-random bits the DAQ card spits out to the FPGA
+       to synchronize the acquisition of the FPGA.'''
+
+    out = {}
+    notNone = False
+    for key in fpga_dat:
+        if type(fpga_dat[key]) != type(None):
+            notNone = True
+    if not notNone:
+        return fpga_dat
+
+    off_ind, sync_dat_bin = find_fpga_sync_offset(fpga_dat['sync'], encode_bin, \
+                                                  encode_len=encode_len, \
+                                                  plot_sync=plot_sync)
+
     # Crop the xyz arrays
     out['xyz_time'] = fpga_dat['xyz_time'][off_ind:off_ind+nsamp]
     out['xyz'] = fpga_dat['xyz'][:,off_ind:off_ind+nsamp]
@@ -1,18 +1,20 @@
-import h5py, os, sys, re, glob, time, sys, fnmatch, inspect, subprocess, math, xmltodict
+import h5py, os, sys, re, glob, time, sys, fnmatch, inspect, subprocess, math
 import numpy as np
 import datetime as dt
 import dill as pickle 
 
-import matplotlib.pyplot as plt
-import matplotlib.cm as cmx
-import matplotlib.colors as colors
-import matplotlib.mlab as mlab
+from lazy_import import lazy_module
 
-import scipy.interpolate as interp
-import scipy.optimize as optimize
-import scipy.signal as signal
-import scipy.stats as stats
-import scipy.constants as constants
+plt = lazy_module('matplotlib.pyplot')
+cmx = lazy_module('matplotlib.cm')
+colors = lazy_module('matplotlib.colors')
+mlab = lazy_module('matplotlib.mlab')
+
+interp = lazy_module('scipy.interpolate')
+optimize = lazy_module('scipy.optimize')
+signal = lazy_module('scipy.signal')
+stats = lazy_module('scipy.stats')
+constants = lazy_module('scipy.constants')
 import scipy
 
 import configuration
@@ -27,7 +29,7 @@ calib_path = '/data/old_trap_processed/calibrations/'
 
 
 
-kb = constants.Boltzmann
+kb = 1.380649e-23 # [J/K], exact since the 2019 SI (scipy.constants.Boltzmann)
 Troom = 297 # Kelvins
 
 # From 2019 mass and density paper
@@ -1,16 +1,18 @@
-import h5py, os, re, glob, time, sys, fnmatch, inspect, traceback
+import h5py, os, re, glob, time, sys, fnmatch, inspect, traceback, hashlib
 import numpy as np
 import datetime as dt
 import dill as pickle 
 
-import matplotlib.pyplot as plt
-import matplotlib.cm as cmx
-import matplotlib.colors as colors
-import matplotlib.mlab as mlab
+from lazy_import import lazy_module
 
-import scipy.interpolate as interp
-import scipy.optimize as optimize
-import scipy.signal as signal
+plt = lazy_module('matplotlib.pyplot')
+cmx = lazy_module('matplotlib.cm')
+colors = lazy_module('matplotlib.colors')
+mlab = lazy_module('matplotlib.mlab')
+
+interp = lazy_module('scipy.interpolate')
+optimize = lazy_module('scipy.optimize')
+signal = lazy_module('scipy.signal')
 import scipy
 
 import configuration
@@ -44,6 +46,71 @@ from stats_util import *
 
 
 
+def __getattr__(name):
+    '''The star import doesn't carry the attributes that bead_util_funcs
+       only builds on demand (E_front, e_front_dat, ...), so they're 
+       forwarded from there.'''
+    import bead_util_funcs
+    try:
+        return bead_util_funcs.__getattr__(name)
+    except AttributeError:
+        raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
+
+
+### Index arrays for get_datffts_and_errs(), shared by all files with
+### the same number of samples, sampling rate and harmonics
+harm_index_cache = {}
+harm_index_cache_size = 256
+
+
+def get_harm_extraction_inds(nsamp, fsamp, ginds, noisebins=10, noiselim=(10,100)):
+    '''Builds (or retrieves from the cache) the rFFT bin indices used
+       to extract the data at the harmonics, the sidebands used to 
+       estimate errors, and the noise band.
+
+       The sidebands of each harmonic alternate above and below it,
+       starting two bins away: h+2, h-2, h+3, h-3, ... for noisebins
+       bins in total, and are sorted at the end.
+
+       INPUTS: nsamp, number of samples
+               fsamp, sampling frequency
+               ginds, indices (or boolean mask) of the harmonic bins
+               noisebins, number of sideband bins per harmonic
+               noiselim, (low, high) frequencies of the noise band
+
+       OUTPUTS: inddic, dictionary with 'freqs', 'harm_inds', 'err_ginds',
+                        'noise_inds' and 'gather_inds', the last being
+                        all of the others concatenated'''
+
+    ginds = np.atleast_1d(ginds)
+    key = (nsamp, float(fsamp), ginds.dtype == bool, ginds.tobytes(), \
+           noisebins, tuple(noiselim))
+    if key in harm_index_cache:
+        return harm_index_cache[key]
+
+    freqs = np.fft.rfftfreq(nsamp, d=1.0/fsamp)
+    harm_inds = np.arange(len(freqs))[ginds]
+
+    steps = np.arange(noisebins)
+    offsets = np.where(steps % 2 == 0, 2 + steps // 2, -(2 + steps // 2))
+    err_ginds = np.sort((harm_inds[:,np.newaxis] + offsets[np.newaxis,:]).ravel())
+
+    noise_inds = np.arange(len(freqs))[(freqs <= noiselim[1]) * (freqs >= noiselim[0])]
+
+    inddic = {'freqs': freqs, 'harm_inds': harm_inds, 'err_ginds': err_ginds, \
+              'noise_inds': noise_inds, \
+              'gather_inds': np.concatenate((harm_inds, err_ginds, noise_inds))}
+
+    if len(harm_index_cache) >= harm_index_cache_size:
+        harm_index_cache.clear()
+    harm_index_cache[key] = inddic
+
+    return inddic
+
+
+
+
 class DataFile:
     '''Class holing all of the data for an individual file. 
        Contains methods to  apply calibrations to the data, 
@@ -75,14 +142,65 @@ class DataFile:
             # is driven and 0 otherwise
         self.cant_calibrated = False
 
+
+
+    def __getattr__(self, name):
+        '''Only called when an attribute isn't found normally. If a channel
+           was registered by a lazy load, it's loaded and decoded here, on
+           first access, and then stored as a regular attribute.'''
+        loaders = self.__dict__.get('_lazy_loaders', {})
+        if name in loaders:
+            loaders[name]()
+            return self.__dict__[name]
+        raise AttributeError("'DataFile' object has no attribute '{:s}'".format(name))
+
+
+
+    def __getstate__(self):
+        '''Materialize everything before pickling, since the lazy loaders
+           can't be pickled.'''
+        self.materialize()
+        return self.__dict__
+
+
+
+    def register_lazy(self, names, loader):
+        '''Registers a function that loads (and sets) all the attributes in
+           names, to be called the first time any of them is accessed.'''
+        if '_lazy_loaders' not in self.__dict__:
+            self._lazy_loaders = {}
+
+        def run_loader():
+            for name in names:
+                self._lazy_loaders.pop(name, None)
+            loader()
+
+        for name in names:
+            self.__dict__.pop(name, None)
+            self._lazy_loaders[name] = run_loader
+
+
+
+    def materialize(self):
+        '''Loads every channel that hasn't been accessed yet.'''
+        loaders = self.__dict__.get('_lazy_loaders', {})
+        while len(loaders):
+            next(iter(loaders.values()))()
+
         
 
     def load_only_attribs(self, fname):
 
         fname = os.path.abspath(fname)
 
-        dat, attribs = getdata(fname)
-        if len(dat) == 0:
+        ### Only the attributes are needed, so don't load the sample data
+        try:
+            attribs = get_hdf5_attribs(fname)
+        except Exception:
+            attribs = {}
+            traceback.print_exc()
+
+        if attribs == {}:
             self.badfile = True
             return 
         else:
@@ -144,16 +262,24 @@ class DataFile:
 
 
     def load(self, fname, plot_raw_dat=False, plot_sync=False, load_other=False, \
-             skip_mon=False, load_all_pos=False, verbose=False, skip_fpga=False):
+             skip_mon=False, load_all_pos=False, verbose=False, skip_fpga=False, \
+             lazy=False):
 
         '''Loads the data from file with fname into DataFile object. 
-           Does not perform any calibrations.  
+           Does not perform any calibrations. With lazy=True, the datasets
+           are memory-mapped and each group of channels (FPGA xyz, quad, 
+           power and the DAQ monitors) is only decoded the first time one
+           of its attributes is accessed.
         ''' 
         self.new_trap = False
 
         fname = os.path.abspath(fname)
 
-        dat, attribs = getdata(fname)
+        if lazy:
+            attribs = get_hdf5_attribs(fname)
+            dat = np.transpose(memmap_hdf5_dataset(fname, 'beads/data/pos_data'))
+        else:
+            dat, attribs = getdata(fname)
 
         if plot_raw_dat:
             for n in range(20):
@@ -188,7 +314,6 @@ class DataFile:
         # If it's not an imgrid file, process all the fpga data
         if (not imgrid) and (not skip_fpga):
             fpga_fname = fname[:-3] + '_fpga.h5'
-            fpga_dat = get_fpga_data(fpga_fname, verbose=verbose, timestamp=self.time)
 
             try:
                 encode = attribs["encode_bits"]
@@ -200,70 +325,141 @@ class DataFile:
                 self.encode_bits = []
                 traceback.print_exc()
 
-            fpga_dat = sync_and_crop_fpga_data(fpga_dat, self.time, self.nsamp, \
-                                               self.encode_bits, plot_sync=plot_sync)
+            if lazy:
+                self.load_fpga_data_lazy(fpga_fname, load_all_pos=load_all_pos, \
+                                         plot_sync=plot_sync, verbose=verbose)
+            else:
+                fpga_dat = get_fpga_data(fpga_fname, verbose=verbose, timestamp=self.time)
+                fpga_dat = sync_and_crop_fpga_data(fpga_dat, self.time, self.nsamp, \
+                                                   self.encode_bits, plot_sync=plot_sync)
+                self.set_fpga_data(fpga_dat, load_all_pos=load_all_pos)
 
-            # IT CAN ONLY FIX THE TIME ATTRIB IF THE PARENT SCRIPT IS EXECUTED
-            # AS ROOT OR ANY SUPERUSER
-            if self.FIX_TIME:
-                self.time = np.int64(fpga_dat['xyz_time'][0])
-                #assert self.time != 0
-                #print 'fix time: 0 -> ', self.time, '\r'
-                #sudo_call(fix_time, self.fname, float(self.time))
+        if not skip_mon:
+            self.load_monitor_data(fname, dat, attribs, lazy=lazy)
 
-            self.sync_data = fpga_dat['sync']
+        if load_other:
+            self.load_other_data()
 
-            ###self.pos_data = np.transpose(dat[:, configuration.col_labels["bead_pos"]])
-            self.pos_data = fpga_dat['xyz']
-            if load_all_pos:
-                self.pos_data_2 = fpga_dat['xy_2']
-            self.pos_time = fpga_dat['xyz_time']
-            self.pos_fb = fpga_dat['fb']
 
-            self.power = fpga_dat['power']
-            self.power_fb = fpga_dat['power_fb']
 
-            #print self.pos_data
+    def set_fpga_data(self, fpga_dat, load_all_pos=False):
+        '''Unpacks the synchronized and cropped output of get_fpga_data()
+           into the class attributes.'''
 
-            # Load quadrant and backscatter amplitudes and phases
-            self.amp = fpga_dat['amp']
-            self.phase = fpga_dat['phase']
-            self.quad_time = fpga_dat['quad_time']
+        # IT CAN ONLY FIX THE TIME ATTRIB IF THE PARENT SCRIPT IS EXECUTED
+        # AS ROOT OR ANY SUPERUSER
+        if self.FIX_TIME:
+            self.time = np.int64(fpga_dat['xyz_time'][0])
+            #assert self.time != 0
+            #print 'fix time: 0 -> ', self.time, '\r'
+            #sudo_call(fix_time, self.fname, float(self.time))
 
-            if load_all_pos:
-                # run bu.print_quadrant_indices() to see an explanation of these
-                right = self.amp[0] + self.amp[1]
-                left = self.amp[2] + self.amp[3]
-                top = self.amp[0] + self.amp[2]
-                bottom = self.amp[1] + self.amp[3]
+        self.sync_data = fpga_dat['sync']
 
-                x2 = right - left
-                y2 = top - bottom
+        ###self.pos_data = np.transpose(dat[:, configuration.col_labels["bead_pos"]])
+        self.pos_data = fpga_dat['xyz']
+        if load_all_pos:
+            self.pos_data_2 = fpga_dat['xy_2']
+        self.pos_time = fpga_dat['xyz_time']
+        self.pos_fb = fpga_dat['fb']
 
-                quad_sum = np.zeros_like(self.amp[0])
-                for ind in [0,1,2,3]:
-                    quad_sum += self.amp[ind]
+        self.power = fpga_dat['power']
+        self.power_fb = fpga_dat['power_fb']
 
-                self.pos_data_3 = np.array([x2.astype(np.float64)/quad_sum, \
-                                            y2.astype(np.float64)/quad_sum, \
-                                            self.pos_data[2]])
+        #print self.pos_data
 
+        # Load quadrant and backscatter amplitudes and phases
+        self.amp = fpga_dat['amp']
+        self.phase = fpga_dat['phase']
+        self.quad_time = fpga_dat['quad_time']
 
-            #self.phi_cm = np.mean(self.phase[[0, 1, 2, 3]]) 
+        if load_all_pos:
+            self.build_pos_data_3()
 
-        if not skip_mon:
-            self.load_monitor_data(fname, dat, attribs)
+        #self.phi_cm = np.mean(self.phase[[0, 1, 2, 3]]) 
 
-        if load_other:
-            self.load_other_data()
-                
 
 
+    def build_pos_data_3(self):
+        '''Builds the xy position from the quadrant amplitudes.'''
 
-    def load_monitor_data(self, fname, dat, attribs, debug=False):
+        # run bu.print_quadrant_indices() to see an explanation of these
+        right = self.amp[0] + self.amp[1]
+        left = self.amp[2] + self.amp[3]
+        top = self.amp[0] + self.amp[2]
+        bottom = self.amp[1] + self.amp[3]
+
+        x2 = right - left
+        y2 = top - bottom
+
+        quad_sum = np.zeros_like(self.amp[0])
+        for ind in [0,1,2,3]:
+            quad_sum += self.amp[ind]
+
+        self.pos_data_3 = np.array([x2.astype(np.float64)/quad_sum, \
+                                    y2.astype(np.float64)/quad_sum, \
+                                    self.pos_data[2]])
+
+
+
+    def load_fpga_data_lazy(self, fpga_fname, load_all_pos=False, plot_sync=False, \
+                            verbose=False):
+        '''Memory-maps the FPGA streams and registers a loader for each of 
+           them. The xyz stream has the sync channel, so it's always needed
+           to crop the other streams.'''
+
+        def load_xyz():
+            stream = np.transpose(memmap_hdf5_dataset(fpga_fname, 'beads/data/pos_data'))
+            xyz_time, xyz, xy_2, xyz_fb, sync = \
+                        extract_xyz(stream, self.time, verbose=verbose)
+            off_ind, sync_bin = find_fpga_sync_offset(sync, self.encode_bits, \
+                                                      plot_sync=plot_sync)
+            crop = slice(off_ind, off_ind+self.nsamp)
+
+            self._fpga_crop = crop
+            self.sync_data = sync_bin[crop]
+            self.pos_data = xyz[:,crop]
+            self.pos_data_2 = xy_2[:,crop]
+            self.pos_time = xyz_time[crop]
+            self.pos_fb = xyz_fb[:,crop]
+
+        def load_quad():
+            stream = np.transpose(memmap_hdf5_dataset(fpga_fname, 'beads/data/quad_data'))
+            quad_time, amp, phase = extract_quad(stream, self.time, verbose=verbose)
+            self.quad_time = quad_time[self._fpga_crop]
+            self.amp = amp[:,self._fpga_crop]
+            self.phase = phase[:,self._fpga_crop]
+
+        def load_power():
+            with h5py.File(fpga_fname, 'r') as f:
+                has_power = 'beads/data/pow_data' in f
+            if has_power:
+                stream = np.transpose(memmap_hdf5_dataset(fpga_fname, 'beads/data/pow_data'))
+                _, power, power_fb = extract_power(stream, self.time, verbose=verbose)
+                self.power = power[self._fpga_crop]
+                self.power_fb = power_fb[self._fpga_crop]
+            else:
+                self.power = np.zeros_like(self.pos_data[0])
+                self.power_fb = np.zeros_like(self.pos_data[0])
+
+        self.register_lazy(['_fpga_crop', 'sync_data', 'pos_data', 'pos_data_2', \
+                            'pos_time', 'pos_fb'], load_xyz)
+        self.register_lazy(['quad_time', 'amp', 'phase'], load_quad)
+        self.register_lazy(['power', 'power_fb'], load_power)
+        if load_all_pos:
+            self.register_lazy(['pos_data_3'], self.build_pos_data_3)
+
+        if self.FIX_TIME:
+            self.time = np.int64(self.pos_time[0])
+
+
+
+    def load_monitor_data(self, fname, dat, attribs, debug=False, lazy=False):
 
         '''Loads the data from file with fname into DataFile object. 
-           Does not perform any calibrations.  
+           Does not perform any calibrations. With lazy=True, dat is
+           the raw (memory-mapped) dataset in ADC bits, and the stage 
+           and electrode monitors are only converted on first access.
         ''' 
 
         #dat, attribs = getdata(fname)
@@ -280,19 +476,34 @@ class DataFile:
                 plt.plot(dat[:,i])
             plt.show()
 
-        try:
-            self.cant_data = np.transpose(dat[:, configuration.col_labels["stage_pos"]])
-        except Exception:
-            self.cant_data = []
-            print("Couldn't load stage data...")
-            traceback.print_exc()
+        if lazy:
+            adc_fac = (configuration.adc_params["adc_res"] - 1) / \
+                       (2. * configuration.adc_params["adc_max_voltage"])
 
-        try:
-            self.electrode_data = np.transpose(dat[:, configuration.col_labels["electrodes"]])
-        except Exception:
-            self.electrode_data = []
-            print("Couldn't load electrode data...")
-            traceback.print_exc()
+            def channel_loader(attr, label):
+                def load_channels():
+                    setattr(self, attr, \
+                            np.transpose(dat[:, configuration.col_labels[label]]) / adc_fac)
+                return load_channels
+
+            self.register_lazy(['cant_data'], channel_loader('cant_data', 'stage_pos'))
+            self.register_lazy(['electrode_data'], \
+                               channel_loader('electrode_data', 'electrodes'))
+
+        else:
+            try:
+                self.cant_data = np.transpose(dat[:, configuration.col_labels["stage_pos"]])
+            except Exception:
+                self.cant_data = []
+                print("Couldn't load stage data...")
+                traceback.print_exc()
+
+            try:
+                self.electrode_data = np.transpose(dat[:, configuration.col_labels["electrodes"]])
+            except Exception:
+                self.electrode_data = []
+                print("Couldn't load electrode data...")
+                traceback.print_exc()
 
         #freqs = np.fft.rfftfreq(self.nsamp, d=1.0/self.fsamp)
         #for ind in [0,1,2]:
@@ -360,15 +571,21 @@ class DataFile:
 
 
     def load_new(self, fname, plot_raw_dat=False, skip_mon=False, \
-                    verbose=False):
+                    verbose=False, lazy=False):
 
         '''Loads the data from file with fname into DataFile object. 
-           Does not perform any calibrations.  
+           Does not perform any calibrations. With lazy=True, the datasets
+           are memory-mapped and each channel is only decoded the first
+           time it's accessed.
         ''' 
         self.new_trap = True
 
         fname = os.path.abspath(fname)
 
+        if lazy:
+            self.load_new_lazy(fname, verbose=verbose)
+            return
+
         dat1, dat2, dat3, dat4, dat5, dat6, attribs = getdata_new(fname)
 
         # if plot_raw_dat:
@@ -394,6 +611,69 @@ class DataFile:
 
         self.time = self.pos_time[0]
 
+        self.reconstruct_electrode_data(dat5, attribs)
+
+        self.build_pos_data_3_new()
+
+
+
+    def load_new_lazy(self, fname, verbose=False):
+        '''Reads only the attributes and the shape and first timestamp
+           of the FPGA data, registering loaders for everything else.'''
+
+        attribs = get_hdf5_attribs(fname)
+
+        self.fname = fname
+        self.date = re.search(r"\d{8,}", fname)[0]
+
+        self.fsamp = attribs['Fsamp'] / attribs['downsamp']
+
+        def load_optional(key, label):
+            try:
+                return memmap_hdf5_dataset(fname, key)
+            except KeyError:
+                print('No {:s} data'.format(label))
+                return []
+
+        dat1 = memmap_hdf5_dataset(fname, 'pos_data')
+        first_frame = deinterleave_fpga_stream(dat1, 11)[0]
+        self.nsamp = len(dat1) // 11
+        self.time = assemble_fpga_time(first_frame[9], first_frame[10])
+
+        def load_xyz():
+            self.pos_time, _, self.pos_data_2, self.pos_fb, self.sync_data \
+                        = extract_xyz_new(dat1)
+
+        def load_quad():
+            self.quad_time, self.amp, self.phase = \
+                        extract_quad_new(memmap_hdf5_dataset(fname, 'quad_data'))
+
+        def load_other():
+            self.other_data = load_optional('spin_data', 'spin')
+
+        def load_cant():
+            self.cant_data = load_optional('cant_data', 'attractor')
+
+        def load_power():
+            self.power = load_optional('laser_power', 'power')
+
+        def load_electrodes():
+            self.reconstruct_electrode_data(load_optional('electrode_data', 'electrode'), \
+                                            attribs)
+
+        self.register_lazy(['pos_time', 'pos_data_2', 'pos_fb', 'sync_data'], load_xyz)
+        self.register_lazy(['quad_time', 'amp', 'phase'], load_quad)
+        self.register_lazy(['other_data'], load_other)
+        self.register_lazy(['cant_data'], load_cant)
+        self.register_lazy(['power'], load_power)
+        self.register_lazy(['electrode_settings', 'electrode_data'], load_electrodes)
+        self.register_lazy(['pos_data_3', 'pos_data'], self.build_pos_data_3_new)
+
+
+
+    def reconstruct_electrode_data(self, dat5, attribs):
+        '''Rebuilds the electrode data and settings of the new trap, which
+           only saves short portions of the electrode signals.'''
 
         ### Reconstruct the elctrode_settings array as it's saved in the old trap
         self.electrode_settings = {}
@@ -477,6 +757,12 @@ class DataFile:
 
         self.electrode_data = elec_data
 
+
+
+    def build_pos_data_3_new(self):
+        '''Builds the xy position from the quadrant amplitudes and the z
+           position from the backscattered phase, for the new trap.'''
+
         # run bu.print_quadrant_indices() to see an explanation of these
         right = self.amp[0] + self.amp[1]
         left = self.amp[2] + self.amp[3]
@@ -772,81 +1058,51 @@ class DataFile:
         ''' 
 
 
-        freqs = np.fft.rfftfreq(len(self.pos_data[0]), d=1.0/self.fsamp)
-        fund_ind = np.argmin(np.abs(freqs - drive_freq))
+        N = len(self.pos_data[0])
+        inddic = get_harm_extraction_inds(N, self.fsamp, ginds, noisebins=noisebins, \
+                                          noiselim=noiselim)
+        freqs = inddic['freqs']
         bin_sp = freqs[1] - freqs[0]
+        err_ginds = inddic['err_ginds']
 
-        harm_freqs = freqs[ginds]
+        nharm = len(inddic['harm_inds'])
+        nerr = len(err_ginds)
 
-        if type(harm_freqs) == np.float64:
-            harm_freqs = np.array([harm_freqs])
-            just_one = True
+        if elec_drive:
+            drive = self.electrode_data[elec_ind]
         else:
-            just_one = False
+            drive = self.cant_data[drive_ind]
+        meandrive = np.mean(drive)
 
-        datffts = np.zeros((3, len(ginds)), dtype=np.complex128)
-        daterrs = np.zeros((3, len(ginds)*noisebins), dtype=np.complex128)
+        ### Drive, responses and diagonalized responses all in one batched
+        ### FFT, then a single gather of the harmonics, sidebands and noise band
+        tseries = [drive] + [self.pos_data[resp]*self.conv_facs[resp] for resp in [0,1,2]]
         if diag:
-            diagdatffts = np.zeros((3, len(ginds)), dtype=np.complex128)
-            diagdaterrs = np.zeros((3, len(ginds)*noisebins), dtype=np.complex128)
+            tseries += [self.diag_pos_data[resp] for resp in [0,1,2]]
+        ffts = np.fft.rfft(np.array(tseries), axis=-1)
 
-        noiseffts = np.zeros((3, len(ginds)), dtype=np.complex128)
-        noise_inds = np.arange(len(freqs))[(freqs <= noiselim[1]) * (freqs >= noiselim[0])]
-        #for ind in ginds:
-        #    noise_inds = np.delete(noise_inds, ind)
-
-        if elec_drive:
-            drivefft_full = np.fft.rfft(self.electrode_data[elec_ind])
-            meandrive = np.mean(self.electrode_data[elec_ind])
-        else:
-            drivefft_full = np.fft.rfft(self.cant_data[drive_ind])
-            meandrive = np.mean(self.cant_data[drive_ind])
+        drivefft_full = ffts[0]
         driveffts = drivefft_full[ginds]
         driveffts_all = drivefft_full[drive_ginds]
 
-        for resp in [0,1,2]:
-
-            N = len(self.pos_data[resp])
+        gathered = ffts[1:][:,inddic['gather_inds']]
+        harm_vals = gathered[:,:nharm]
+        err_vals = gathered[:,nharm:nharm+nerr]
+        noise_vals = gathered[:,nharm+nerr:]
 
-            datfft = np.fft.rfft(self.pos_data[resp]*self.conv_facs[resp])
-            # plt.loglog(freqs, np.abs(datfft)*fft_norm(self.nsamp, self.fsamp))
-            # plt.show()
-            # input()
-            datffts[resp] += datfft[ginds]
-
-            noise_dat = datfft[noise_inds]
-            
-            #noiseffts[resp] = np.mean(np.abs(noise_dat)) * \
-            #                  np.exp(1.0j * np.mean(np.angle(noise_dat)))
-
-            noiseffts[resp] = np.mean(noise_dat)
+        datffts = harm_vals[:3]
+        daterrs = err_vals[:3]
+        noiseffts = np.repeat(np.mean(noise_vals[:3], axis=-1)[:,np.newaxis], \
+                              nharm, axis=-1)
+        if diag:
+            diagdatffts = harm_vals[3:]
+            diagdaterrs = err_vals[3:]
 
-            ### OKAY UP TO HERE
+        for resp in [0,1,2]:
 
+            datfft = ffts[1+resp]
             if diag:
-                diagdatfft = np.fft.rfft(self.diag_pos_data[resp])
-                diagdatffts[resp] += diagdatfft[ginds]
-
-            err_ginds = []
-            for freqind, freq in enumerate(harm_freqs):
-                harm_ind = np.argmin(np.abs(freqs-freq))
-                neg = False
-                pos_ind = harm_ind + 2
-                neg_ind = harm_ind - 2
-                for i in range(noisebins):
-                    if not neg:
-                        neg = True
-                        err_ginds.append(pos_ind)
-                        pos_ind += 1
-                    else:
-                        neg = False
-                        err_ginds.append(neg_ind)
-                        neg_ind -= 1
-            err_ginds.sort()
-
-            daterrs[resp] += datfft[err_ginds]
-            if diag:
-                diagdaterrs[resp] += diagdatfft[err_ginds]
+                diagdatfft = ffts[4+resp]
 
             if plot:
                 normfac = np.sqrt(2.0 * bin_sp) * fft_norm(N, self.fsamp)
@@ -1021,34 +1277,25 @@ class DataFile:
 
            OUTPUTS: none, generates new class attribute.'''
 
-        if self.new_trap:
-            tf_path = '/data/new_trap_processed/calibrations/transfer_funcs/'
-        else:
-            tf_path = '/data/old_trap_processed/calibrations/transfer_funcs/'
+        tf_path = self.get_tf_path(date=date)
 
-        ext = configuration.extensions['trans_fun']
-        if not len(date):
-            tf_path +=  self.date + ext
-        else:
-            tf_path += date + ext
+        ### Generate FFT frequencies for given data
+        N = len(self.pos_data[0])
+        freqs = np.fft.rfftfreq(N, d=1.0/self.fsamp)
 
-        # Load the transfer function. Note that this Hfunc maps
-        # drive -> response, so we will need to invert
+        # Load the transfer function, compute it at the frequencies of
+        # interest and invert it so we can map response -> drive. This is
+        # cached (see tf.get_inverse_tf_array()), since it only depends 
+        # on the TF file and the FFT parameters. Note that the original 
+        # Hfunc maps drive -> response
         try:
-            Hfunc = pickle.load(open(tf_path, 'rb'))
+            Harr = tf.get_inverse_tf_array(tf_path, N, self.fsamp, maxfreq=maxfreq, \
+                                           suppress_off_diag=suppress_off_diag)
         except Exception:
             print("Couldn't automatically find correct TF")
             traceback.print_exc()
             return
 
-        ### Generate FFT frequencies for given data
-        N = len(self.pos_data[0])
-        freqs = np.fft.rfftfreq(N, d=1.0/self.fsamp)
-
-        ### Compute TF at frequencies of interest. Appropriately inverts
-        ### so we can map response -> drive
-        Harr = tf.make_tf_array(freqs, Hfunc, suppress_off_diag=suppress_off_diag)
-
         ### Estimate the xy resonant frequencies from the fit. After changing
         ### how the fits are represented, this code remains commented as the
         ### Hfunc object is no longer actually a function (deceptive)
@@ -1059,26 +1306,15 @@ class DataFile:
         if plot:
             tf.plot_tf_array(freqs, Harr)
 
-        maxfreq_ind = np.argmin( np.abs(freqs - maxfreq) )
-        Harr[maxfreq_ind+1:,:,:] = 0.0+0.0j
-
-        f_ind = np.argmin( np.abs(freqs - step_cal_drive_freq) )
-        mat = Harr[f_ind,:,:]
-        conv_facs = [0, 0, 0]
-        for i in [0,1,2]:
-            conv_facs[i] = np.abs(mat[i,i])
-        self.conv_facs = conv_facs
+        self.conv_facs = get_conv_facs(Harr, freqs, step_cal_drive_freq)
+        conv_facs = self.conv_facs
 
         ### Compute the FFT, apply the TF and inverse FFT
-        if self.new_trap:
-            data = self.pos_data_3
-        else:
-            data = self.pos_data
-        data_fft = np.fft.rfft(data)
-        diag_fft = np.einsum('ikj,ki->ji', Harr, data_fft)
-
+        data = self.get_diag_input()
 
         if plot:
+            data_fft = np.fft.rfft(data)
+            diag_fft = np.einsum('ikj,ki->ji', Harr, data_fft)
             norm = fft_norm(N, self.fsamp)
             fig, axarr = plt.subplots(3,1,sharex=True,sharey=True)
             for ax in [0,1,2]:
@@ -1087,7 +1323,36 @@ class DataFile:
             plt.tight_layout()
             plt.show()
 
-        self.diag_pos_data = np.fft.irfft(diag_fft)
+        self.diag_pos_data = tf.apply_inverse_tf(data, Harr)
+
+
+
+    def get_tf_path(self, date=''):
+        '''Path to the transfer function used to diagonalize this file,
+           from the file's date unless another date is given.'''
+
+        if self.new_trap:
+            tf_path = '/data/new_trap_processed/calibrations/transfer_funcs/'
+        else:
+            tf_path = '/data/old_trap_processed/calibrations/transfer_funcs/'
+
+        ext = configuration.extensions['trans_fun']
+        if not len(date):
+            tf_path +=  self.date + ext
+        else:
+            tf_path += date + ext
+
+        return tf_path
+
+
+
+    def get_diag_input(self):
+        '''The position data that gets diagonalized, which for the new
+           trap is the sum/difference reconstruction pos_data_3.'''
+        if self.new_trap:
+            return self.pos_data_3
+        else:
+            return self.pos_data
 
 
     
@@ -1181,31 +1446,24 @@ class DataFile:
         # Bin responses against the drive. If data has been diagonalized,
         # it bins the diagonal data as well
         dt = 1. / self.fsamp
-        binned_data = [[0,0,0], [0,0,0], [0,0,0]]
         if len(self.diag_pos_data):
-            diag_binned_data = [[0,0,0], [0,0,0], [0,0,0]]
-        for resp in [0,1,2]:
-            bins, binned_vec, binned_err = \
-                            spatial_bin(drivevec, self.pos_data[resp], dt, \
-                                        nbins = nbins, nharmonics = nharmonics, \
-                                        harms = harms, width = width, \
-                                        sg_filter = sg_filter, sg_params = sg_params, \
-                                        verbose = verbose, maxfreq = maxfreq)
-            binned_data[resp][0] = bins
-            binned_data[resp][1] = binned_vec
-            binned_data[resp][2] = binned_err
-            
-            if len(self.diag_pos_data):
-                diag_bins, diag_binned_vec, diag_binned_err = \
-                            spatial_bin(drivevec, self.diag_pos_data[resp], dt, \
-                                        nbins = nbins, nharmonics = nharmonics, \
-                                        harms = harms, width = width, \
-                                        sg_filter = sg_filter, sg_params = sg_params, \
-                                        verbose = verbose, maxfreq = maxfreq)
-
-                diag_binned_data[resp][0] = diag_bins
-                diag_binned_data[resp][1] = diag_binned_vec
-                diag_binned_data[resp][2] = diag_binned_err
+            resps = np.concatenate((self.pos_data[:3], self.diag_pos_data[:3]))
+        else:
+            resps = np.array(self.pos_data[:3])
+
+        ### All responses are binned together against the one drive
+        bins, binned_vecs, binned_errs = \
+                        spatial_bin(drivevec, resps, dt, \
+                                    nbins = nbins, nharmonics = nharmonics, \
+                                    harms = harms, width = width, \
+                                    sg_filter = sg_filter, sg_params = sg_params, \
+                                    verbose = verbose, maxfreq = maxfreq)
+
+        binned_data = [[bins, binned_vecs[resp], binned_errs[resp]] \
+                            for resp in [0,1,2]]
+        if len(self.diag_pos_data):
+            diag_binned_data = [[bins, binned_vecs[resp+3], binned_errs[resp+3]] \
+                                    for resp in [0,1,2]]
 
         self.binned_data = binned_data
         if len(self.diag_pos_data):
@@ -1216,33 +1474,236 @@ class DataFile:
 
 
 
+def get_conv_facs(Harr, freqs, step_cal_drive_freq=41.0):
+    '''Diagonal elements of the inverse TF at the step-calibration drive
+       frequency, used to convert each axis to units of force.'''
+    f_ind = np.argmin( np.abs(freqs - step_cal_drive_freq) )
+    mat = Harr[f_ind,:,:]
+    conv_facs = [0, 0, 0]
+    for i in [0,1,2]:
+        conv_facs[i] = np.abs(mat[i,i])
+    return conv_facs
+
+
+
+def diagonalize_many(dfs, date='', maxfreq=1000, suppress_off_diag=False, \
+                     step_cal_drive_freq=41.0, chunk_size=100, workers=None):
+    '''Diagonalizes a list of DataFile objects in batches, with the same
+       results as calling DataFile.diagonalize() on each of them. Files
+       sharing a transfer function, nsamp and fsamp are stacked into
+       (chunk_size, 3, nsamp) arrays so each chunk takes one batched rfft,
+       one broadcasted matrix product and one irfft.
+
+           INPUTS: dfs, list of loaded DataFile objects
+                   date, date in form YYYYMMDD if you don't want to use
+                         default TF from file date
+                   maxfreq, max frequency above which data is top-hat filtered
+                   chunk_size, max number of files stacked together
+                   workers, number of threads for scipy.fft
+
+           OUTPUTS: none, generates diag_pos_data and conv_facs for 
+                    each DataFile'''
+
+    groups = {}
+    for df in dfs:
+        key = (df.get_tf_path(date=date), len(df.pos_data[0]), float(df.fsamp))
+        groups.setdefault(key, []).append(df)
+
+    for (tf_path, N, fsamp), group in groups.items():
+        try:
+            Harr = tf.get_inverse_tf_array(tf_path, N, fsamp, maxfreq=maxfreq, \
+                                           suppress_off_diag=suppress_off_diag)
+        except Exception:
+            print("Couldn't automatically find correct TF")
+            traceback.print_exc()
+            continue
+
+        freqs = np.fft.rfftfreq(N, d=1.0/fsamp)
+        conv_facs = get_conv_facs(Harr, freqs, step_cal_drive_freq)
+
+        for start in range(0, len(group), chunk_size):
+            chunk = group[start:start+chunk_size]
+            data = np.array([df.get_diag_input() for df in chunk])
+            diag_data = tf.apply_inverse_tf(data, Harr, workers=workers)
+            del data
+
+            ### Each file gets its own copy, so the stacked chunk is freed
+            ### rather than kept alive by views into it
+            for ind, df in enumerate(chunk):
+                df.conv_facs = list(conv_facs)
+                df.diag_pos_data = np.array(diag_data[ind])
+            del diag_data
+
+
+
+
+
+
+### Cache of the rFFTs of high-speed data channels, see hsDat.get_rfft()
+hsdat_fft_cache_dir = os.path.join(os.path.expanduser('~'), '.cache', \
+                                   'opt_lev_analysis', 'hsdat_fft')
+hsdat_fingerprint_bytes = 2**16
+
+### Size limit of the cache, the least recently used FFTs are removed
+### when it's exceeded
+hsdat_fft_cache_max_bytes = 4 * 2**30
+
+
+def get_file_fingerprint(fname):
+    '''SHA1 of the size of a file and of its first and last few kB, 
+       which identifies the content of a data file (the sample data and
+       the timestamp in its attributes) without reading all of it.'''
+    size = os.path.getsize(fname)
+    sha = hashlib.sha1(str(size).encode())
+    with open(fname, 'rb') as f:
+        sha.update(f.read(hsdat_fingerprint_bytes))
+        f.seek(max(size - hsdat_fingerprint_bytes, 0))
+        sha.update(f.read(hsdat_fingerprint_bytes))
+    return sha.hexdigest()
+
+
+
+
+def prune_hsdat_fft_cache(cache_dir='', max_bytes=None):
+    '''Removes the least recently used FFTs from the cache of 
+       hsDat.get_rfft() until it's below max_bytes (by default
+       hsdat_fft_cache_max_bytes). Files are ordered by their access
+       time, or modification time where access times aren't updated.'''
+
+    if not len(cache_dir):
+        cache_dir = hsdat_fft_cache_dir
+    if max_bytes is None:
+        max_bytes = hsdat_fft_cache_max_bytes
+
+    entries = []
+    for fname in glob.glob(os.path.join(cache_dir, '*.npy')):
+        try:
+            stat = os.stat(fname)
+        except OSError:
+            continue
+        entries.append((max(stat.st_atime, stat.st_mtime), stat.st_size, fname))
+
+    total = sum(entry[1] for entry in entries)
+    for _, size, fname in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(fname)
+            total -= size
+        except OSError:
+            continue
+
+
+
+
+def iter_hsdat_channel(fnames, chan, block_size=2**20):
+    '''Reads one channel of successive high-speed data files in blocks,
+       as a single continuous stream.'''
+    for fname in fnames:
+        for block in hsDat(fname, load_attribs=False).iter_channel(chan, \
+                                                        block_size=block_size):
+            yield block
+
 
 
 
 class hsDat:
-    def __init__(self, fname='', load=False, load_attribs=True):
+    def __init__(self, fname='', load=False, load_attribs=True, mmap=False):
         self.fname = fname
         self.dat = []
+        self.raw_dat = []
         self.attribs = {}
 
         if load:
-            self.load()
+            self.load(mmap=mmap)
         if load_attribs:
             self.load_attribs()
 
 
-    def load(self, fname=''):
+    def load(self, fname='', mmap=False):
+        '''Loads the high-speed data, as self.dat with shape (nsamp, nchan).
+
+           With mmap=True, the dataset is memory-mapped straight from the 
+           file instead of being read and transposed. self.raw_dat is then
+           the (nchan, nsamp) memmap, self.dat its transposed view and 
+           get_channel() returns contiguous views of single channels. This
+           only works for contiguous, uncompressed datasets, otherwise it 
+           falls back to reading the data.'''
         if len(fname):
             self.fname = fname
 
         try:
             f = h5py.File(self.fname, 'r')
             dset = f['beads/data/high_speed_data']
-            self.dat = np.transpose(dset)
-            f.close()
+
+            offset = dset.id.get_offset() if mmap else None
+            if (offset is not None) and (dset.chunks is None) \
+                    and (dset.compression is None):
+                shape, dtype = dset.shape, dset.dtype
+                f.close()
+                self.raw_dat = np.memmap(self.fname, mode='r', dtype=dtype, \
+                                         offset=offset, shape=shape)
+            else:
+                self.raw_dat = dset[()]
+                f.close()
+            self.dat = np.transpose(self.raw_dat)
         except (KeyError, IOError):
             print("Warning, got no keys for: ", self.fname)
             self.dat = []
+            self.raw_dat = []
+
+
+    def get_channel(self, chan):
+        '''View of a single channel, loading the data if needed.'''
+        if not len(self.raw_dat):
+            self.load(mmap=True)
+        return self.raw_dat[chan]
+
+
+    def iter_channel(self, chan, block_size=2**20):
+        '''Reads a single channel from the file in blocks, without loading
+           the whole dataset, e.g. as the input of demod_stream().'''
+        with h5py.File(self.fname, 'r') as f:
+            dset = f['beads/data/high_speed_data']
+            for start in range(0, dset.shape[1], block_size):
+                yield dset[chan,start:start+block_size]
+
+
+    def get_rfft(self, chan, cache=False, cache_dir=''):
+        '''rFFT of a single channel. With cache=True, it's saved in a 
+           cache keyed by the file's content (get_file_fingerprint()) and
+           channel, so repeated analyses of the same file skip both reading
+           the data and the FFT. Cached FFTs are returned as read-only
+           memmaps, which can be sliced to a band of interest cheaply.
+           A full-length FFT is large (32 MB for 2^22 samples), so the 
+           cache is limited to hsdat_fft_cache_max_bytes (see 
+           prune_hsdat_fft_cache()).'''
+        if not cache:
+            return np.fft.rfft(self.get_channel(chan))
+
+        if not len(cache_dir):
+            cache_dir = hsdat_fft_cache_dir
+        path = os.path.join(cache_dir, '{:s}_ch{:d}.npy'\
+                                .format(get_file_fingerprint(self.fname), chan))
+
+        if os.path.isfile(path):
+            try:
+                return np.load(path, mmap_mode='r')
+            except Exception:
+                print("Couldn't load cached FFT: ", path)
+
+        fft = np.fft.rfft(self.get_channel(chan))
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            ### Write then rename, so other processes never see partial files
+            tmp_path = path + '.{:d}.tmp'.format(os.getpid())
+            with open(tmp_path, 'wb') as f:
+                np.save(f, fft)
+            os.replace(tmp_path, path)
+            prune_hsdat_fft_cache(cache_dir)
+        except (IOError, OSError):
+            print("Couldn't save FFT to cache: ", path)
+        return fft
 
 
     def load_attribs(self, fname=''):
@@ -1,31 +1,37 @@
-import h5py, os, re, glob, time, sys, fnmatch, inspect
-import subprocess, math, xmltodict, traceback
+import h5py, os, re, glob, time, sys, fnmatch, inspect, bisect
+import subprocess, math, traceback, itertools
 import numpy as np
 import datetime as dt
 import dill as pickle 
 
-import matplotlib.pyplot as plt
-import matplotlib.cm as cm
-import matplotlib.colors as colors
-import matplotlib.mlab as mlab
+### matplotlib, most of scipy, tqdm and joblib are only imported when first
+### used (see lazy_import), to keep the import of this module cheap
+from lazy_import import lazy_module, lazy_callable
 
-import scipy.interpolate as interp
-import scipy.optimize as optimize
-import scipy.signal as signal
-import scipy.stats as stats
-import scipy.constants as constants
+plt = lazy_module('matplotlib.pyplot')
+cm = lazy_module('matplotlib.cm')
+colors = lazy_module('matplotlib.colors')
+mlab = lazy_module('matplotlib.mlab')
+
+interp = lazy_module('scipy.interpolate')
+optimize = lazy_module('scipy.optimize')
+signal = lazy_module('scipy.signal')
+stats = lazy_module('scipy.stats')
+constants = lazy_module('scipy.constants')
 import scipy
 
-from obspy.signal.detrend import polynomial
+from fractions import Fraction
 
-from tqdm import tqdm
-from joblib import Parallel, delayed
+tqdm = lazy_callable('tqdm', 'tqdm')
+Parallel = lazy_callable('joblib', 'Parallel')
+delayed = lazy_callable('joblib', 'delayed')
 
 import configuration
 
 import warnings
 
 from bead_data_funcs import get_hdf5_time
+import attrib_index
 
 #######################################################
 # This module has basic utility functions for analyzing bead
@@ -60,36 +66,91 @@ my_path = os.path.abspath( os.path.dirname(__file__) )
 #calib_path = '/data/old_trap_processed/calibrations/'
 calib_path = os.path.abspath( os.path.join(my_path, '../data/') )
 
-e_top_dat   = np.loadtxt(os.path.join(calib_path, 'e-top_1V_optical-axis.txt'), comments='%')
-e_bot_dat   = np.loadtxt(os.path.join(calib_path, 'e-bot_1V_optical-axis.txt'), comments='%')
-e_left_dat  = np.loadtxt(os.path.join(calib_path, 'e-left_1V_left-right-axis.txt'), comments='%')
-e_right_dat = np.loadtxt(os.path.join(calib_path, 'e-right_1V_left-right-axis.txt'), comments='%')
-e_front_dat = np.loadtxt(os.path.join(calib_path, 'e-front_1V_front-back-axis.txt'), comments='%')
-e_back_dat  = np.loadtxt(os.path.join(calib_path, 'e-back_1V_front-back-axis.txt'), comments='%')
+### COMSOL simulations of the field at the trap with 1V on each electrode,
+### as (file name, index of the row with the coordinate along the
+### electrode's axis, transpose) keyed by electrode. The tables are only
+### loaded the first time they're needed, see get_trap_efield_funcs()
+efield_tables = {'top':   ('e-top_1V_optical-axis.txt', 2, False), \
+                 'bot':   ('e-bot_1V_optical-axis.txt', 2, False), \
+                 'left':  ('e-left_1V_left-right-axis.txt', 1, False), \
+                 'right': ('e-right_1V_left-right-axis.txt', 1, False), \
+                 'front': ('e-front_1V_front-back-axis.txt', 0, False), \
+                 'back':  ('e-back_1V_front-back-axis.txt', 0, False), \
+                 'xp': ('new-trap_efield-x_+x-elec-1V_x-axis.txt', 0, True), \
+                 'xn': ('new-trap_efield-x_-x-elec-1V_x-axis.txt', 0, True), \
+                 'yp': ('new-trap_efield-y_+y-elec-1V_y-axis.txt', 1, True), \
+                 'yn': ('new-trap_efield-y_-y-elec-1V_y-axis.txt', 1, True), \
+                 'zp': ('new-trap_efield-z_+z-elec-1V_z-axis.txt', 2, True), \
+                 'zn': ('new-trap_efield-z_-z-elec-1V_z-axis.txt', 2, True)}
+
+### Parsing the text tables is slow, so they're also saved together as a 
+### .npz file, which is used as long as none of the tables has changed
+efield_cache_path = os.path.join(os.path.expanduser('~'), '.cache', \
+                                 'opt_lev_analysis', 'trap_efield_tables.npz')
+
+efield_dats = {}
+efield_funcs = {}
+
+
+def load_efield_tables():
+    '''Loads the COMSOL field tables, from the .npz cache if it's up to 
+       date, otherwise from the text files, then updating the cache.
+
+       OUTPUTS: dats, dictionary of 2D arrays keyed by electrode'''
+
+    if len(efield_dats):
+        return efield_dats
+
+    paths = {key: os.path.join(calib_path, efield_tables[key][0]) \
+                for key in efield_tables}
+    mtimes = np.array([os.stat(paths[key]).st_mtime for key in efield_tables])
+
+    dats = {}
+    try:
+        with np.load(efield_cache_path) as npz:
+            if np.array_equal(npz['mtimes'], mtimes):
+                dats = {key: npz[key] for key in efield_tables}
+    except Exception:
+        pass
+
+    if not len(dats):
+        for key, (fname, _, transpose) in efield_tables.items():
+            dat = np.loadtxt(paths[key], comments='%')
+            dats[key] = dat.transpose() if transpose else dat
+        try:
+            os.makedirs(os.path.dirname(efield_cache_path), exist_ok=True)
+            tmp_path = efield_cache_path + '.{:d}.tmp'.format(os.getpid())
+            with open(tmp_path, 'wb') as f:
+                np.savez(f, mtimes=mtimes, **dats)
+            os.replace(tmp_path, efield_cache_path)
+        except (IOError, OSError):
+            pass
+
+    efield_dats.update(dats)
+    return efield_dats
 
-E_front  = interp.interp1d(e_front_dat[0], e_front_dat[-1])
-E_back   = interp.interp1d(e_back_dat[0],  e_back_dat[-1])
-E_right  = interp.interp1d(e_right_dat[1], e_right_dat[-1])
-E_left   = interp.interp1d(e_left_dat[1],  e_left_dat[-1])
-E_top    = interp.interp1d(e_top_dat[2],   e_top_dat[-1])
-E_bot    = interp.interp1d(e_bot_dat[2],   e_bot_dat[-1])
 
 
+def get_trap_efield_funcs():
+    '''Interpolating functions of the field along each electrode's axis,
+       keyed by electrode, built on the first call.'''
+    if not len(efield_funcs):
+        dats = load_efield_tables()
+        for key, (_, axind, _) in efield_tables.items():
+            efield_funcs[key] = interp.interp1d(dats[key][axind], dats[key][-1])
+    return efield_funcs
 
 
-e_xp_dat = np.loadtxt(os.path.join(calib_path, 'new-trap_efield-x_+x-elec-1V_x-axis.txt'), comments='%').transpose()
-e_xn_dat = np.loadtxt(os.path.join(calib_path, 'new-trap_efield-x_-x-elec-1V_x-axis.txt'), comments='%').transpose()
-e_yp_dat = np.loadtxt(os.path.join(calib_path, 'new-trap_efield-y_+y-elec-1V_y-axis.txt'), comments='%').transpose()
-e_yn_dat = np.loadtxt(os.path.join(calib_path, 'new-trap_efield-y_-y-elec-1V_y-axis.txt'), comments='%').transpose()
-e_zp_dat = np.loadtxt(os.path.join(calib_path, 'new-trap_efield-z_+z-elec-1V_z-axis.txt'), comments='%').transpose()
-e_zn_dat = np.loadtxt(os.path.join(calib_path, 'new-trap_efield-z_-z-elec-1V_z-axis.txt'), comments='%').transpose()
 
-E_xp  = interp.interp1d(e_xp_dat[0], e_xp_dat[-1])
-E_xn  = interp.interp1d(e_xn_dat[0], e_xn_dat[-1])
-E_yp  = interp.interp1d(e_yp_dat[1], e_yp_dat[-1])
-E_yn  = interp.interp1d(e_yn_dat[1], e_yn_dat[-1])
-E_zp  = interp.interp1d(e_zp_dat[2], e_zp_dat[-1])
-E_zn  = interp.interp1d(e_zn_dat[2], e_zn_dat[-1])
+def __getattr__(name):
+    '''Keeps the old module attributes (E_front, e_front_dat, ...) working,
+       now that the tables are loaded on demand.'''
+    if name.startswith('E_') and (name[2:] in efield_tables):
+        return get_trap_efield_funcs()[name[2:]]
+    if name.startswith('e_') and name.endswith('_dat') \
+            and (name[2:-4] in efield_tables):
+        return load_efield_tables()[name[2:-4]]
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
 
 # plt.figure()
 # plt.plot(e_front_dat[0], e_front_dat[-1])
@@ -423,11 +484,20 @@ def find_all_fnames(dirlist, ext='.h5', sort=True, exclude_fpga=True, \
 
 
 
-def sort_files_by_timestamp(files, use_origin_timestamp=False):
-    '''Pretty self-explanatory function.'''
+def sort_files_by_timestamp(files, use_origin_timestamp=False, \
+                            use_attrib_index=False):
+    '''Pretty self-explanatory function. With use_attrib_index, the 
+       timestamps come from the per-directory attribute index (see 
+       attrib_index.py) so only new or modified files have their 
+       attributes read. This writes the index into the data directories, 
+       so it's off by default.'''
 
     try:
-        files = [(get_hdf5_time(path), path) for path in files]
+        if use_attrib_index:
+            times = attrib_index.get_file_attribs(files, keys=['time'])['time']
+            files = list(zip(times, files))
+        else:
+            files = [(get_hdf5_time(path), path) for path in files]
     except Exception:
         print('BAD HDF5 TIMESTAMPS, USING GENESIS TIMESTAMP')
         traceback.print_exc()
@@ -705,6 +775,65 @@ def detrend_poly(arr, order=1.0, plot=False):
 
 
 
+def bin_by_edges(xvec, yvecs, edges, include_right=False, calc_std=False):
+    '''Averages one or many responses in bins of a common x-vector, for 
+       all of the bins at once. Bin membership is found with a single
+       searchsorted() and the sums with bincount(), so this is O(N).
+
+       INPUTS:  xvec, (N,) array of values being binned against
+                yvecs, (N,) or (..., N) stack of responses to bin
+                edges, (Nbins+1,) increasing array of bin edges. Bin i
+                        holds edges[i] <= x < edges[i+1]
+                include_right, boolean to include x == edges[-1] in the
+                                last bin
+                calc_std, boolean to also compute the standard deviation
+                          within each bin
+
+       OUTPUTS: means, (..., Nbins) mean in each bin, NaN where empty
+                counts, (Nbins,) number of points in each bin
+                stds, (..., Nbins) standard deviation in each bin, only 
+                        if calc_std is True'''
+
+    xvec = np.asarray(xvec)
+    yvecs = np.asarray(yvecs)
+    nbins = len(edges) - 1
+
+    binds = np.searchsorted(edges, xvec, side='right') - 1
+    if include_right:
+        binds[xvec == edges[-1]] = nbins - 1
+
+    ### Points outside of the edges all go in an extra bin that's dropped
+    binds[(binds < 0) + (binds >= nbins)] = nbins
+
+    counts = np.bincount(binds, minlength=nbins+1)
+
+    ### Offset the bin indices for each response so a single bincount 
+    ### handles the whole stack
+    ystack = yvecs.reshape(-1, yvecs.shape[-1])
+    nresp = ystack.shape[0]
+    offsets = (np.arange(nresp) * (nbins + 1))[:,np.newaxis]
+    flat_binds = (binds[np.newaxis,:] + offsets).ravel()
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sums = np.bincount(flat_binds, weights=ystack.ravel(), \
+                           minlength=nresp*(nbins+1)).reshape(nresp, nbins+1)
+        means = sums / counts
+
+        if calc_std:
+            resid = ystack - means[:,binds]
+            sqsums = np.bincount(flat_binds, weights=(resid**2).ravel(), \
+                                 minlength=nresp*(nbins+1)).reshape(nresp, nbins+1)
+            stds = np.sqrt(sqsums / counts)
+
+    outshape = yvecs.shape[:-1] + (nbins,)
+    means = means[:,:nbins].reshape(outshape)
+    if calc_std:
+        return means, counts[:nbins], stds[:,:nbins].reshape(outshape)
+    return means, counts[:nbins]
+
+
+
+
 def spatial_bin(drive, resp, dt, nbins=100, nharmonics=10, harms=[], \
                 width=0, sg_filter=False, sg_params=[3,1], verbose=True, \
                 maxfreq=2500, add_mean=False, correct_phase_shift=False, \
@@ -718,7 +847,9 @@ def spatial_bin(drive, resp, dt, nbins=100, nharmonics=10, harms=[], \
        is significant spectral leakage into neighboring bins.
 
        INPUT:   drive, single frequency drive signal, sampled with some dt
-       	        resp, arbitrary response to be 'binned'
+       	        resp, arbitrary response to be 'binned', or a stack of
+                      responses with time along the last axis (e.g. x, y, z,
+                      diag x, y, z), all binned against the same drive
        	        dt, sample spacing in seconds [s]
                 nbins, number of samples in the final resp(drive)
        	        nharmonics, number of harmonics to include in filter
@@ -738,11 +869,15 @@ def spatial_bin(drive, resp, dt, nbins=100, nharmonics=10, harms=[], \
                             'forward-going' or 'backward-going' data
 
        OUTPUT:  drivevec, vector of drive values, monotonically increasing
-                respvec, resp as a function of drivevec'''
+                respvec, resp as a function of drivevec, with the same
+                          leading axes as resp
+                errvec, same for the out-of-band noise'''
 
 
+    resp = np.asarray(resp)
+
     nsamp = len(drive)
-    if len(resp) != nsamp:
+    if resp.shape[-1] != nsamp:
         if verbose:
             print("Data Error: x(t) and f(t) don't have the same length")
             sys.stdout.flush()
@@ -753,7 +888,7 @@ def spatial_bin(drive, resp, dt, nbins=100, nharmonics=10, harms=[], \
 
     ### Generate FFTs for filtering
     drivefft = np.fft.rfft(drive)
-    respfft = np.fft.rfft(resp)
+    respfft = np.fft.rfft(resp, axis=-1)
     freqs = np.fft.rfftfreq(len(drive), d=dt)
 
     ### Find the drive frequency, ignoring the DC bin
@@ -813,14 +948,14 @@ def spatial_bin(drive, resp, dt, nbins=100, nharmonics=10, harms=[], \
             drivefilt[h_lower_ind:h_upper_ind+1] = drivefilt[harm_ind]
 
     if correct_phase_shift:
-        phase_shift = np.angle(respfft[fund_ind]) - np.angle(drivefft[fund_ind])
-        drivefilt2 = drivefilt * np.exp(-1.0j * phase_shift)
+        phase_shift = np.angle(respfft[...,fund_ind]) - np.angle(drivefft[fund_ind])
+        drivefilt2 = drivefilt * np.exp(-1.0j * np.asarray(phase_shift)[...,np.newaxis])
     else:
         drivefilt2 = np.copy(drivefilt)
 
     if add_mean:
         drivefilt[0] = 1.0+0.0j
-        drivefilt2[0] = 1.0+0.0j
+        drivefilt2[...,0] = 1.0+0.0j
 
     ### Apply the filter to both drive and response
     drivefft_filt = drivefilt * drivefft
@@ -828,43 +963,29 @@ def spatial_bin(drive, resp, dt, nbins=100, nharmonics=10, harms=[], \
     errfft_filt = errfilt * respfft
 
     ### Reconstruct the filtered data
-    drive_r = np.fft.irfft(drivefft_filt) 
-    resp_r = np.fft.irfft(respfft_filt)
-    err_r = np.fft.irfft(errfft_filt)
+    drive_r = np.fft.irfft(drivefft_filt, n=nsamp) 
+    resp_r = np.fft.irfft(respfft_filt, n=nsamp, axis=-1)
+    err_r = np.fft.irfft(errfft_filt, n=nsamp, axis=-1)
 
     ### Sort reconstructed data, interpolate and resample
     mindrive = np.min(drive_r)
     maxdrive = np.max(drive_r)
     grad = np.gradient(drive_r)
 
-    sortinds = drive_r.argsort()
-    drive_r = drive_r[sortinds]
-    resp_r = resp_r[sortinds]
-    err_r = err_r[sortinds]
-
     if grad_sign < 0:
-        ginds = grad[sortinds] < 0
+        ginds = grad < 0
     elif grad_sign > 0:
-        ginds = grad[sortinds] > 0
+        ginds = grad > 0
     elif grad_sign == 0.0:
-        ginds = np.ones(len(grad[sortinds]), dtype=np.bool)
+        ginds = np.ones(len(grad), dtype=bool)
 
     bin_spacing = (maxdrive - mindrive) * (1.0 / nbins)
     drivevec = np.linspace(mindrive+0.5*bin_spacing, maxdrive-0.5*bin_spacing, nbins)
-    
-    ### This part is slow, don't really know the best way to fix that....
-    respvec = []
-    errvec = []
-    for bin_loc in drivevec:
-        inds = (drive_r[ginds] >= bin_loc - 0.5*bin_spacing) * \
-               (drive_r[ginds] < bin_loc + 0.5*bin_spacing)
-        val = np.mean( resp_r[ginds][inds] )
-        err_val = np.mean( err_r[ginds][inds] )
-        respvec.append(val)
-        errvec.append(err_val)
-
-    respvec = np.array(respvec)
-    errvec = np.array(errvec)
+    edges = np.append(drivevec - 0.5*bin_spacing, drivevec[-1] + 0.5*bin_spacing)
+
+    ### Average every response in every bin at once
+    respvec, _ = bin_by_edges(drive_r[ginds], resp_r[...,ginds], edges)
+    errvec, _ = bin_by_edges(drive_r[ginds], err_r[...,ginds], edges)
 
     #plt.plot(drive_r, resp_r)
     #plt.plot(drive_r[ginds], resp_r[ginds], linewidth=2)
@@ -873,24 +994,26 @@ def spatial_bin(drive, resp, dt, nbins=100, nharmonics=10, harms=[], \
     #plt.show()
 
     if sg_filter:
-        respvec = signal.savgol_filter(respvec, sg_params[0], sg_params[1])
+        respvec = signal.savgol_filter(respvec, sg_params[0], sg_params[1], axis=-1)
 
 
     if plot:
         plt.figure()
         drive_asd = np.abs(drivefft)
-        resp_asd = np.abs(respfft)
+        resp_asd = np.abs(respfft).reshape(-1, len(freqs))
         plt.loglog(freqs, drive_asd / np.max(drive_asd), label='Drive')
-        plt.loglog(freqs, resp_asd / np.max(resp_asd), label='Response')
-        plt.loglog(freqs[np.abs(drivefilt)>0], \
-                   resp_asd[np.abs(drivefilt)>0] / np.max(resp_asd), 
-                   'X', label='Filter', ms=10)
+        for asd in resp_asd:
+            plt.loglog(freqs, asd / np.max(asd), label='Response')
+            plt.loglog(freqs[np.abs(drivefilt)>0], \
+                       asd[np.abs(drivefilt)>0] / np.max(asd), 
+                       'X', label='Filter', ms=10)
         plt.xlabel('Frequency [Hz]')
         plt.ylabel('ASD [arb.]')
         plt.legend()
 
         plt.figure()
-        plt.errorbar(drivevec, respvec,  yerr=errvec, ls='', marker='o', ms=6)
+        for vec, err in zip(respvec.reshape(-1, nbins), errvec.reshape(-1, nbins)):
+            plt.errorbar(drivevec, vec,  yerr=err, ls='', marker='o', ms=6)
         plt.xlabel('Drive units')
         plt.ylabel('Response units')
 
@@ -903,11 +1026,14 @@ def spatial_bin(drive, resp, dt, nbins=100, nharmonics=10, harms=[], \
 
 
 def rebin(xvec, yvec, errs=[], nbins=500, plot=False, correlated_errs=False):
-    '''Slow and derpy function to re-bin based on averaging. Works
-       with any value of nbins, but can be slow since it's a for loop.'''
+    '''Re-bins based on averaging, with evenly spaced bins between the
+       minimum and maximum of xvec. Works with any value of nbins.'''
     if len(errs):
         assert len(errs) == len(yvec), 'error vec is not the right length'
 
+    xvec = np.asarray(xvec)
+    yvec = np.asarray(yvec)
+
     if nbins > 0.25 * len(xvec):
         nbins = int(0.25 * len(xvec))
 
@@ -915,24 +1041,18 @@ def rebin(xvec, yvec, errs=[], nbins=500, plot=False, correlated_errs=False):
     dx = lenx / nbins
 
     xvec_new = np.linspace(np.min(xvec)+0.5*dx, np.max(xvec)-0.5*dx, nbins)
-    yvec_new = np.zeros_like(xvec_new)
-    errs_new = np.zeros_like(xvec_new)
+    edges = np.append(xvec_new - 0.5*dx, xvec_new[-1] + 0.5*dx)
 
-    for xind, x in enumerate(xvec_new):
-        if x != xvec_new[-1]:
-            inds = (xvec >= x - 0.5*dx) * (xvec < x + 0.5*dx)
-        else:
-            inds = (xvec >= x - 0.5*dx) * (xvec <= x + 0.5*dx)
+    yvec_new, counts, stds = bin_by_edges(xvec, yvec, edges, \
+                                          include_right=True, calc_std=True)
 
-        if len(errs):
-            errs_new[xind] = np.sqrt( np.mean(errs[inds]**2))
-        else:
-            if correlated_errs:
-                errs_new[xind] = np.std(yvec[inds])
-            else:
-                errs_new[xind] = np.std(yvec[inds]) / np.sqrt(np.sum(inds))
-
-        yvec_new[xind] = np.mean(yvec[inds])
+    if len(errs):
+        errs_new = np.sqrt(bin_by_edges(xvec, np.asarray(errs)**2, edges, \
+                                        include_right=True)[0])
+    elif correlated_errs:
+        errs_new = stds
+    else:
+        errs_new = stds / np.sqrt(counts)
 
     if plot:
         plt.scatter(xvec, yvec, color='C0')
@@ -1010,7 +1130,12 @@ def rebin_vectorized(a, nbin, model=None):
 
 def correlation(drive, response, fsamp, fdrive, filt = False, band_width = 1):
     '''Compute the full correlation between drive and response,
-       correctly normalized for use in step-calibration.
+       correctly normalized for use in step-calibration. The lags
+       are computed all at once from a zero-padded FFT.
+
+       Both signals can also be stacks of traces of the same length,
+       with time along the last axis, in which case every pair is
+       correlated at once.
 
        INPUTS:   drive, drive signal as a function of time
                  response, resposne signal as a function of time
@@ -1022,33 +1147,34 @@ def correlation(drive, response, fsamp, fdrive, filt = False, band_width = 1):
        OUTPUTS:  corr_full, full and correctly normalized correlation'''
 
     ### First subtract of mean of signals to avoid correlating dc
-    drive = drive-np.mean(drive)
-    response = response-np.mean(response)
+    drive = drive - np.mean(drive, axis=-1, keepdims=True)
+    response = response - np.mean(response, axis=-1, keepdims=True)
 
     ### bandpass filter around drive frequency if desired.
     if filt:
         b, a = signal.butter(3, [2.*(fdrive-band_width/2.)/fsamp, \
                              2.*(fdrive+band_width/2.)/fsamp ], btype = 'bandpass')
-        drive = signal.filtfilt(b, a, drive)
-        response = signal.filtfilt(b, a, response)
+        drive = signal.filtfilt(b, a, drive, axis=-1)
+        response = signal.filtfilt(b, a, response, axis=-1)
     
     ### Compute the number of points and drive amplitude to normalize correlation
-    lentrace = len(drive)
-    drive_amp = np.sqrt(2)*np.std(drive)
+    lentrace = drive.shape[-1]
+    drive_amp = np.sqrt(2)*np.std(drive, axis=-1, keepdims=True)
 
-    ### Define the correlation vector which will be populated later
-    corr = np.zeros(int(fsamp/fdrive))
+    ### Number of lags, with the response implicitly zero-padded, so
+    ###     corr[i] = SUM_n drive[n] * response[n+i]
+    ### The FFT length leaves room for all of the lags without wrapping
+    nlag = int(fsamp/fdrive)
+    nfft = scipy.fft.next_fast_len(lentrace + nlag - 1, real=True)
 
-    ### Zero-pad the response
-    response = np.append(response, np.zeros(int(fsamp / fdrive) - 1) )
+    drive_fft = scipy.fft.rfft(drive, n=nfft, axis=-1)
+    response_fft = scipy.fft.rfft(response, n=nfft, axis=-1)
+    corr = scipy.fft.irfft(np.conj(drive_fft) * response_fft, n=nfft, axis=-1)[...,:nlag]
 
-    ### Build the correlation
-    for i in range(len(corr)):
-        ### Correct for loss of points at end
-        correct_fac = 2.0*lentrace/(lentrace-i) ### x2 from empirical test
-        corr[i] = np.sum(drive*response[i:i+lentrace])*correct_fac
+    ### Correct for loss of points at end
+    correct_fac = 2.0*lentrace/(lentrace-np.arange(nlag)) ### x2 from empirical test
 
-    return corr * (1.0 / (lentrace * drive_amp))
+    return corr * correct_fac * (1.0 / (lentrace * drive_amp))
 
 
 
@@ -1221,6 +1347,228 @@ def demod(input_sig, fsig, fsamp, harmind=1.0, filt=False, \
 
 
 
+def demod_ddc(input_sig, fsig, fsamp, harmind=1.0, fout=2000.0, bandwidth=0.0, \
+              window=('kaiser', 5.0)):
+    '''Digital down-conversion, as an alternative to demod() when only a
+       narrow band around harmind*fsig is needed. The signal is mixed to
+       baseband with a complex oscillator, then low-passed and decimated
+       in one step with a polyphase filter (scipy.signal.resample_poly), 
+       so the output, and anything computed from it, is smaller by the 
+       decimation factor.
+
+       The amplitude and phase modulation are then simply
+           amp = np.abs(baseband)
+           phase_mod = np.unwrap(np.angle(baseband)) / harmind
+
+       INPUTS:  input_sig, signal as a function of time
+                fsig, frequency of the carrier
+                fsamp, sampling frequency
+                harmind, harmonic of fsig to demodulate
+                fout, output sampling rate. The ratio to fsamp is 
+                      approximated by a fraction with a denominator of
+                      at most 1000, so the actual rate is returned, and
+                      it can't be below fsamp/1000
+                bandwidth, if non-zero and below fout, the baseband is
+                           further low-passed to +-bandwidth/2
+                window, window used to design the polyphase filter
+
+       OUTPUTS: baseband, complex baseband signal sampled at fout, scaled 
+                          so its magnitude is the carrier amplitude
+                fout, actual output sampling rate'''
+
+    fc = float(harmind) * fsig
+
+    ratio = Fraction(fout / fsamp).limit_denominator(1000)
+    up, down = ratio.numerator, ratio.denominator
+    if up < 1:
+        raise ValueError('fout = {:0.4g} Hz is too low, the minimum is fsamp/1000 = {:0.4g} Hz'\
+                            .format(fout, fsamp / 1000.0))
+    fout = fsamp * up / down
+
+    sig = input_sig - np.mean(input_sig)
+
+    ### Carrier phase computed modulo one cycle, to stay accurate for 
+    ### long records
+    carrier_cycles = (np.arange(len(sig)) * (fc / fsamp)) % 1.0
+    mixed = sig * np.exp(-2.0j * np.pi * carrier_cycles)
+
+    ### x2 since mixing a real carrier leaves half of it at baseband
+    baseband = 2.0 * signal.resample_poly(mixed, up, down, window=window)
+
+    if bandwidth and (bandwidth < fout):
+        sos = signal.butter(3, 0.5 * bandwidth, btype='lowpass', fs=fout, output='sos')
+        baseband = signal.sosfiltfilt(sos, baseband)
+
+    return baseband, fout
+
+
+
+
+def analytic_bandpass_fir(fsamp, lower, upper, ntaps=None):
+    '''Complex FIR filter which only passes positive frequencies between
+       lower and upper, scaled so that its output is the analytic signal
+       (the equivalent of hilbert()) of the band-limited input.
+
+       INPUTS:  fsamp, sampling frequency
+                lower, upper, edges of the pass band
+                ntaps, number of taps (odd), by default ~8 times the 
+                       number of samples per 1/bandwidth
+
+       OUTPUTS: taps, complex FIR coefficients, with a delay of
+                      (ntaps - 1) / 2 samples'''
+
+    if ntaps is None:
+        ntaps = int(8.0 * fsamp / (upper - lower))
+    ntaps += 1 - (ntaps % 2)
+
+    lowpass = signal.firwin(ntaps, 0.5 * (upper - lower), fs=fsamp)
+    n = np.arange(ntaps) - (ntaps - 1) // 2
+    return 2.0 * lowpass * np.exp(2.0j * np.pi * (0.5 * (upper + lower)) * n / fsamp)
+
+
+
+
+def demod_stream(blocks, fsig, fsamp, harmind=1.0, bandwidth=1000.0, \
+                 filt_band=[], notch_freqs=[], notch_qs=[], ntaps=None, \
+                 nfft=None, force_2pi_wrap=False):
+    '''Streaming version of demod() for records too long to hold in memory.
+       The signal arrives in blocks of any size and is filtered by overlap-
+       save with the complex FIR of analytic_bandpass_fir(), which does the
+       job of the bandpass and the hilbert transform at once. The phase is
+       unwrapped continuously across blocks.
+
+       Since the whole record is never available, there's no mean 
+       subtraction (the bandpass removes DC anyway), padding, detrending
+       or tukey window as in demod().
+
+       INPUTS:  blocks, iterable of 1D arrays, successive pieces of the signal
+                fsig, frequency of the carrier
+                fsamp, sampling frequency
+                harmind, harmonic of fsig to demodulate
+                bandwidth, width of the pass band around harmind*fsig
+                filt_band, explicit [lower, upper] pass band
+                notch_freqs, notch_qs, IIR notches applied beforehand
+                ntaps, FIR length, see analytic_bandpass_fir()
+                nfft, overlap-save FFT length, by default the power of 2
+                      at least 8 times ntaps
+                force_2pi_wrap, boolean to wrap the phase to [-pi, pi)
+
+       OUTPUTS: generator of (amp, phase_mod) blocks, with the same total
+                length as the input'''
+
+    fc = float(harmind) * fsig
+
+    if len(filt_band):
+        lower, upper = filt_band
+    else:
+        lower = fc - 0.5 * bandwidth
+        upper = fc + 0.5 * bandwidth
+
+    taps = analytic_bandpass_fir(fsamp, lower, upper, ntaps=ntaps)
+    ntaps = len(taps)
+    delay = (ntaps - 1) // 2
+
+    if nfft is None:
+        nfft = int(2**np.ceil(np.log2(8 * ntaps)))
+    step = nfft - ntaps + 1
+    taps_fft = np.fft.fft(taps, n=nfft)
+
+    notches = [signal.iirnotch(notch_freq, notch_qs[i], fs=fsamp) \
+                    for i, notch_freq in enumerate(notch_freqs)]
+    notch_states = [np.zeros(max(len(an), len(bn)) - 1) for bn, an in notches]
+
+    history = np.zeros(ntaps - 1)
+    pending = np.zeros(0)
+    nskip = delay       # filter delay, dropped from the start of the output
+    nout = 0            # samples output so far, for the carrier phase
+    last_phase = None
+    cycles_per_samp = fc / fsamp
+
+    def process(segment, nvalid):
+        nonlocal nskip, nout, last_phase
+
+        filtered = np.fft.ifft(np.fft.fft(segment) * taps_fft)[ntaps-1:ntaps-1+nvalid]
+        if nskip:
+            dropped = min(nskip, len(filtered))
+            filtered = filtered[dropped:]
+            nskip -= dropped
+        if not len(filtered):
+            return None
+
+        ### Mix down with the carrier, keeping its phase accurate for
+        ### arbitrarily long records
+        carrier_cycles = ((nout + np.arange(len(filtered))) * cycles_per_samp) % 1.0
+        baseband = filtered * np.exp(-2.0j * np.pi * carrier_cycles)
+        nout += len(filtered)
+
+        amp = np.abs(baseband)
+        phase = np.angle(baseband)
+        if last_phase is None:
+            phase = np.unwrap(phase)
+        else:
+            phase = np.unwrap(np.concatenate(([last_phase], phase)))[1:]
+        last_phase = phase[-1]
+
+        phase_mod = phase * (1.0 / float(harmind))
+        if force_2pi_wrap:
+            phase_mod = (phase_mod + np.pi) % (2.0*np.pi) - np.pi
+
+        return amp, phase_mod
+
+    for block in itertools.chain(blocks, [None]):
+        if block is None:
+            ### Flush the filter so the output is as long as the input
+            block = np.zeros(delay)
+            final = True
+        else:
+            block = np.asarray(block, dtype=np.float64)
+            for i, (bn, an) in enumerate(notches):
+                block, notch_states[i] = signal.lfilter(bn, an, block, zi=notch_states[i])
+            final = False
+
+        pending = np.concatenate((pending, block))
+        while len(pending) >= step or (final and len(pending)):
+            nvalid = min(step, len(pending))
+            segment = np.concatenate((history, pending[:nvalid], \
+                                      np.zeros(step - nvalid)))
+            history = segment[nvalid:nvalid+ntaps-1]
+            pending = pending[nvalid:]
+
+            out = process(segment, nvalid)
+            if out is not None:
+                yield out
+
+
+
+
+def demod_to_memmap(blocks, nsamp, outpath, fsig, fsamp, harmind=1.0, \
+                    bandwidth=1000.0, filt_band=[], notch_freqs=[], notch_qs=[], \
+                    ntaps=None, nfft=None, force_2pi_wrap=False):
+    '''Runs demod_stream() and writes the result into a (2, nsamp) .npy
+       file of amplitude and phase, which is returned as a memmap.
+
+       INPUTS:  nsamp, total number of samples in the blocks
+                outpath, path of the .npy file
+                see demod_stream() for the others'''
+
+    out = np.lib.format.open_memmap(outpath, mode='w+', dtype=np.float64, \
+                                    shape=(2, nsamp))
+    ind = 0
+    for amp, phase_mod in demod_stream(blocks, fsig, fsamp, harmind=harmind, \
+                                       bandwidth=bandwidth, filt_band=filt_band, \
+                                       notch_freqs=notch_freqs, notch_qs=notch_qs, \
+                                       ntaps=ntaps, nfft=nfft, \
+                                       force_2pi_wrap=force_2pi_wrap):
+        out[0,ind:ind+len(amp)] = amp
+        out[1,ind:ind+len(amp)] = phase_mod
+        ind += len(amp)
+
+    out.flush()
+    return out
+
+
+
+
 
 def minimize_nll(nll_func, param_arr, confidence_level=0.9, plot=False):
     # 90% confidence level for 1sigma errors
@@ -1286,13 +1634,15 @@ def trap_efield(voltages, nsamp=0, only_x=False, only_y=False, only_z=False, \
         print("There are eight electrodes.")
         print("   len(volt arr. passed to 'trap_efield') != 8")
     else:
+        funcs = get_trap_efield_funcs()
+
         if only_y or only_z:
             Ex = np.zeros(nsamp)
         else:
             if new_trap:
-                Ex = voltages[3] * E_xp(0.0) + voltages[4] * E_xn(0.0)
+                Ex = voltages[3] * funcs['xp'](0.0) + voltages[4] * funcs['xn'](0.0)
             else:   
-                Ex = voltages[3] * E_front(0.0) + voltages[4] * E_back(0.0)
+                Ex = voltages[3] * funcs['front'](0.0) + voltages[4] * funcs['back'](0.0)
             # plt.plot(voltages[3], label='3')
             # plt.plot(voltages[4], label='4')
             # plt.legend()
@@ -1302,9 +1652,9 @@ def trap_efield(voltages, nsamp=0, only_x=False, only_y=False, only_z=False, \
             Ey = np.zeros(nsamp)
         else:
             if new_trap:
-                Ey = voltages[5] * E_yp(0.0) + voltages[6] * E_yn(0.0)
+                Ey = voltages[5] * funcs['yp'](0.0) + voltages[6] * funcs['yn'](0.0)
             else:
-                Ey = voltages[5] * E_right(0.0) + voltages[6] * E_left(0.0)
+                Ey = voltages[5] * funcs['right'](0.0) + voltages[6] * funcs['left'](0.0)
             # plt.plot(voltages[5], label='5')
             # plt.plot(voltages[6], label='6')
             # plt.legend()
@@ -1314,9 +1664,9 @@ def trap_efield(voltages, nsamp=0, only_x=False, only_y=False, only_z=False, \
             Ez = np.zeros(nsamp)
         else:
             if new_trap:
-                Ez = voltages[1] * E_zp(0.0)   + voltages[2] * E_zn(0.0)
+                Ez = voltages[1] * funcs['zp'](0.0)   + voltages[2] * funcs['zn'](0.0)
             else:
-                Ez = voltages[1] * E_top(0.0)   + voltages[2] * E_bot(0.0)
+                Ez = voltages[1] * funcs['top'](0.0)   + voltages[2] * funcs['bot'](0.0)
             # plt.plot(voltages[1], label='1')
             # plt.plot(voltages[2], label='2')
             # plt.legend()
@@ -1487,21 +1837,173 @@ def fit_damped_osc_amp(sig, fsamp, fit_band=[], plot=False, \
 
 
 
+def fft_peak_baseline(asd, window=100, delta_fac=5.0, lower_delta_fac=0.0, \
+                      max_iter=10):
+    '''Computes the running baseline used by find_fft_peaks(), for every
+       bin at once. The baseline at a given bin is the mean of a ring buffer
+       of 'window' previous ASD values, where values that are above 
+       lower_delta_fac times the baseline, but not above delta_fac times
+       the baseline, are left out of the buffer (once it's been filled).
+
+       The buffer's sum is a cumulative sum of the changes made by each
+       value that enters it. The values left out depend on the baseline
+       itself, so that part is iterated until it's self-consistent, which
+       is the same as the original bin-by-bin result since each decision
+       only depends on earlier ones. Each iteration only settles the 
+       decisions up to the next one that changes, so when that takes more
+       than max_iter iterations (e.g. after a step in the noise floor),
+       the bin-by-bin loop is used instead (see fft_peak_baseline_loop()).
+
+            asd : the ASD in which we're trying to find peaks
+
+            window : length of the ring buffer
+
+            delta_fac, lower_delta_fac : thresholds, as in find_fft_peaks()
+
+       OUTPUTS: baseline, mean of the buffer before each bin is added
+                          (baseline[0] is NaN since the buffer is empty)'''
+
+    if not lower_delta_fac:
+        lower_delta_fac = delta_fac
+
+    asd = np.asarray(asd, dtype=np.float64)
+    nbin = len(asd)
+    all_inds = np.arange(nbin)
+    counts = np.minimum(all_inds, window)
+
+    ### The buffer is indexed by bin number modulo the window, so work in
+    ### rows of 'window' bins with each column being one buffer slot
+    nrow = int(np.ceil(nbin / window))
+    padded_inds = np.arange(nrow * window).reshape(nrow, window)
+
+    def get_baseline(entered):
+        ### Index of the last bin that entered each slot, up to each bin
+        last = np.where(entered, all_inds, -1)
+        last = np.append(last, -np.ones(nrow*window - nbin, dtype=int))
+        last = np.maximum.accumulate(last.reshape(nrow, window), axis=0)
+
+        ### Value each entering bin replaces (zero for an empty slot)
+        prev = np.vstack((-np.ones((1, window), dtype=int), last[:-1])).ravel()[:nbin]
+        replaced = np.where(prev >= 0, asd[np.maximum(prev, 0)], 0.0)
+
+        changes = np.where(entered, asd - replaced, 0.0)
+        buffer_sum = np.concatenate(([0.0], np.cumsum(changes)[:-1]))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return buffer_sum / counts
+
+    entered = np.ones(nbin, dtype=bool)
+    baseline = get_baseline(entered)
+    if lower_delta_fac >= delta_fac:
+        return baseline
+
+    for i in range(max_iter):
+        skipped = (asd > lower_delta_fac * baseline) * \
+                        np.invert(asd > delta_fac * baseline)
+        skipped[:window] = False
+        new_entered = np.invert(skipped)
+        if np.array_equal(new_entered, entered):
+            return baseline
+        entered = new_entered
+        baseline = get_baseline(entered)
+
+    return fft_peak_baseline_loop(asd, window=window, delta_fac=delta_fac, \
+                                  lower_delta_fac=lower_delta_fac)
+
+
+
+def fft_peak_baseline_loop(asd, window=100, delta_fac=5.0, lower_delta_fac=0.0):
+    '''Same as fft_peak_baseline(), one bin at a time with a running sum
+       of the ring buffer, which takes a time linear in the number of bins
+       whatever the ASD looks like.'''
+
+    if not lower_delta_fac:
+        lower_delta_fac = delta_fac
+
+    vals = np.asarray(asd, dtype=np.float64).tolist()
+    nbin = len(vals)
+
+    ring = [0.0] * window
+    buffer_sum = 0.0
+    baseline = np.zeros(nbin)
+    baseline[0] = np.nan
+
+    for ind, val in enumerate(vals):
+        if ind:
+            base = buffer_sum / min(ind, window)
+            baseline[ind] = base
+            if (ind >= window) and (val > lower_delta_fac * base) \
+                    and not (val > delta_fac * base):
+                continue
+        slot = ind % window
+        buffer_sum += val - ring[slot]
+        ring[slot] = val
+
+    return baseline
+
+
+
+
+def refine_fft_peaks(freqs, asd, inds):
+    '''Estimates the center and amplitude of peaks in an ASD from the
+       three bins around each local maximum, by fitting a parabola to the
+       log of the ASD, which is exact for a gaussian peak.
+
+       INPUTS: freqs, frequencies of the ASD (evenly spaced)
+               asd, ASD values
+               inds, indices of the bins to refine
+
+       OUTPUTS: centers, estimated peak frequencies
+                amps, estimated peak amplitudes'''
+
+    inds = np.asarray(inds, dtype=int)
+    df = freqs[1] - freqs[0]
+
+    ### The peaks at the very edges can't be refined
+    edge = (inds == 0) + (inds == len(asd) - 1)
+    cinds = np.clip(inds, 1, len(asd) - 2)
+
+    tiny = np.finfo(np.float64).tiny
+    lm = np.log(np.maximum(asd[cinds-1], tiny))
+    l0 = np.log(np.maximum(asd[cinds], tiny))
+    lp = np.log(np.maximum(asd[cinds+1], tiny))
+
+    curv = lm - 2.0*l0 + lp
+    with np.errstate(divide='ignore', invalid='ignore'):
+        delta = 0.5 * (lm - lp) / curv
+
+    ### Only a maximum (negative curvature) within a bin is trusted
+    good = np.invert(edge) * (curv < 0) * (np.abs(delta) <= 1.0)
+    delta = np.where(good, delta, 0.0)
+
+    centers = freqs[cinds] + delta * df
+    amps = np.where(good, np.exp(l0 - 0.25*(lm - lp)*delta), asd[cinds])
+    centers = np.where(edge, freqs[inds], centers)
+    amps = np.where(edge, asd[inds], amps)
+
+    return centers, amps
+
+
+
+
 def find_fft_peaks(freqs, fft, window=100, delta_fac=5.0, \
                    lower_delta_fac=0.0, exclude_df=10, band=[], \
-                   plot=False):
+                   refine='gauss', plot=False):
     '''Function to scan the ASD associated to an input FFT, looking for 
        values above the baseline of the ASD, and then attempting to fit
        a gaussian to the region around the above-baseline feature. It 
        should avoid fitting the same feature multiple times.
 
+       The baseline and the threshold crossings are computed for all 
+       bins at once (see fft_peak_baseline()), so only the crossings
+       are looped over.
+
             freqs : the array of frequencies associated to the input
                 FFT. Assumed to be in Hz
 
             fft : the FFT in which we are trying to find peaks
 
             window : the width (in frequency bins) of the region where
-                the fit is performed
+                the fit is performed, and of the baseline
 
             delta_fac : the factor above the baseline required to 
                 trigger a peak fitting
@@ -1516,6 +2018,10 @@ def find_fft_peaks(freqs, fft, window=100, delta_fac=5.0, \
                 found and fit with a gaussian
 
             band : the frequenncy band (if any) in which to limit the search
+
+            refine : 'gauss' to fit a gaussian to the window around 
+                each peak, or 'parabola' for the (much faster, but 
+                noisier) three-point estimate of refine_fft_peaks()
        '''
 
     if not lower_delta_fac:
@@ -1527,59 +2033,51 @@ def find_fft_peaks(freqs, fft, window=100, delta_fac=5.0, \
     ### Compute the ASD
     asd = np.abs(fft)
 
-    ### Define some arrays for later use
-    baseline = []
-    all_inds = np.arange(len(freqs))
+    ### Find every bin sufficiently above the baseline
+    baseline = fft_peak_baseline(asd, window=window, delta_fac=delta_fac, \
+                                 lower_delta_fac=lower_delta_fac)
+    cross_inds = np.arange(1, len(asd))[asd[1:] > delta_fac * baseline[1:]]
+
+    if refine == 'parabola':
+        ### The first crossing is usually on the rising side of a peak, so
+        ### refine around the maximum within exclude_df bins above it
+        span = max(int(exclude_df), 1)
+        padded = np.append(asd, np.zeros(span))
+        local = np.lib.stride_tricks.sliding_window_view(padded, span+1)[cross_inds]
+        max_inds = cross_inds + np.argmax(local, axis=-1)
+        cross_centers, cross_amps = refine_fft_peaks(freqs, asd, max_inds)
 
     ### Define the fitting function, which in this case is a gaussian
     ### without a constant
     fit_fun = lambda x,a,b,c: gauss(x, a, b, c, 0)
+    all_inds = np.arange(len(freqs))
 
-    ### Loop over all (frequency, ASD) pairs, looking for peaks
+    ### Loop over the crossings, skipping those too close to the most
+    ### recently found peak
     peaks = []
-    for ind, (freq, val) in enumerate(zip(freqs, asd)):
-
-        ### See if the current value is above the baseline
-        if ind != 0:
-            cond1 = val > lower_delta_fac * np.mean(baseline)
-            cond2 = val > delta_fac * np.mean(baseline)
-        else:
-            baseline.append(val)
-            continue
-
-        ### Update the baseline, appending a value if it hasn't been
-        ### fully built yet, skipping spuriously large values (based on
-        ### the lower_delta_fac threshold), or updating an old value of
-        ### baseline to properly reflect the local baseline
-        if ind < window:
-            baseline.append(val)
-        elif cond1 and not cond2:
-            continue
-        else:
-            baseline[int(ind%window)] = val
-
-        ### If the current frequency is too close to the most recently found
-        ### peak, then skip it and move on
+    for cross_ind, ind in enumerate(cross_inds):
+        freq = freqs[ind]
         if len(peaks):
             if np.abs(freq - peaks[-1][0]) < exclude_df*df:
                 continue
 
-        ### If the current ASD value is sufficiently above the baseline,
-        ### fit the region around the current value to a gaussian
-        if cond2:
-            ### Define a mask for local fitting
-            mask = (all_inds > ind - window/2) * (all_inds < ind + window/2)
+        if refine == 'parabola':
+            peaks.append( [cross_centers[cross_ind], cross_amps[cross_ind]] )
+            continue
 
-            ### Try the fit
-            p0 = [val, freq, df]
-            try:
-                popt, pcov = optimize.curve_fit(fit_fun, freqs[mask], \
-                                                asd[mask], p0=p0, maxfev=5000)
-            except:
-                popt = p0
+        ### Define a mask for local fitting
+        mask = (all_inds > ind - window/2) * (all_inds < ind + window/2)
 
-            ### Append either the fit result, or our best guess if the fit failed
-            peaks.append( [popt[1], popt[0]] )
+        ### Try the fit
+        p0 = [asd[ind], freq, df]
+        try:
+            popt, pcov = optimize.curve_fit(fit_fun, freqs[mask], \
+                                            asd[mask], p0=p0, maxfev=5000)
+        except:
+            popt = p0
+
+        ### Append either the fit result, or our best guess if the fit failed
+        peaks.append( [popt[1], popt[0]] )
 
     if plot:
         plot_pdet([peaks, []], freqs, asd, loglog=True)
@@ -1591,14 +2089,51 @@ def find_fft_peaks(freqs, fft, window=100, delta_fac=5.0, \
 
 
 
+def pack_fft_peaks(peaks_list):
+    '''Packs a list of (Npeak, 2) arrays of (freq, amp), as output by 
+       find_fft_peaks() for successive integrations, into a single ragged
+       (CSR-style) array, with the peaks of each integration sorted by 
+       frequency.
+
+       OUTPUTS: offsets, (Nint+1,) array, where the peaks of integration j
+                         are peaks[offsets[j]:offsets[j+1]]
+                peaks, (Npeak_total, 2) array of (freq, amp)'''
+
+    peaks_list = [np.asarray(peaks, dtype=np.float64).reshape(-1, 2) \
+                    for peaks in peaks_list]
+    lengths = np.array([len(peaks) for peaks in peaks_list], dtype=int)
+    offsets = np.concatenate(([0], np.cumsum(lengths)))
+
+    if not len(peaks_list):
+        return offsets, np.zeros((0, 2))
+    peaks = np.concatenate(peaks_list, axis=0)
+
+    ### Sort by frequency within each integration, with a single sort
+    ### keyed by integration first
+    row = np.repeat(np.arange(len(peaks_list)), lengths)
+    order = np.lexsort((peaks[:,0], row))
+
+    return offsets, peaks[order]
+
+
+
+
 def track_spectral_feature(peaks_list, init_features=[], first_fft=(), \
                            allowed_jumps=0.05):
-    '''Function to track a spectral feature over successive integrations,
-       making use of paralleization.
+    '''Function to track spectral features over successive integrations.
+       The peaks of all integrations are kept in one ragged array, sorted 
+       by frequency within each integration, so each feature is advanced 
+       with a binary search instead of sorting all of the peaks.
+
+       For each feature and integration, the three peaks closest to the
+       current feature location are considered, and the biggest of those
+       within the allowed jump becomes the new feature location. If there
+       aren't any, the feature is lost for that integration, which gives
+       [0, 0] in the output, and the old location is kept.
 
             peaks_list : the list of successive FFT peaks (found by the
                 function find_fft_peaks()) in which we're trying to 
-                track a feature
+                track a feature, or the same packed by pack_fft_peaks()
 
             init_features : list of initial feature locations used to seed
                 the tracking. if empty, it will plot the first ASD and 
@@ -1606,6 +2141,9 @@ def track_spectral_feature(peaks_list, init_features=[], first_fft=(), \
 
             allowed_jump : fraction of feature fequency which it's allowed
                 to jump between successive integrations
+
+       OUTPUTS: feature_lists, (Nfeature, Nint, 2) array of the (freq, amp)
+                               of each feature in each integration
        '''
 
     if not len(init_features) and not len(first_fft):
@@ -1627,46 +2165,63 @@ def track_spectral_feature(peaks_list, init_features=[], first_fft=(), \
     if not iterable(allowed_jumps):
         allowed_jumps = [allowed_jumps for i in range(len(init_features))]
 
+    if type(peaks_list) == tuple:
+        offsets, peaks = peaks_list
+    else:
+        offsets, peaks = pack_fft_peaks(peaks_list)
 
-    ### Loop over each of the features we're interested in and track it across
-    ### the successive integrations
-    feature_lists = []
-    for i, init_feature in enumerate(init_features):
-        clist = []
-        feature = [init_feature, 0.0]
-
-        ### Loop over all the integrations
-        for j, peaks in enumerate(peaks_list):
-
-            try:
-                ### Compute the distances between the current feature location
-                ### and the frequency of all the peaks found for a particular
-                ### integration
-                distances = np.abs(peaks[:,0] - feature[0])
-
-                ### Sort the distances and find which are within the allowed jump
-                sorter = np.argsort(distances)
-                close_enough = distances[sorter] < allowed_jumps[i] * feature[0]
-
-                ### Sort the peaks and sub-select the ones that are close enough
-                peaks_sorted = peaks[sorter,:]
-                peaks_valid = peaks_sorted[close_enough,:]
-
-                ### Try to find the biggest peak within those that are close enough.
-                ### Sometimes this fails if the peak gets anomalously small or lost
-                ### in the noise, since peaks_valid might be an empty array                
-                feature_ind = np.argmax(peaks_valid[:3,1])
-                feature = peaks_valid[feature_ind]
+    nint = len(offsets) - 1
+    nfeature = len(init_features)
+    feature_lists = np.zeros((nfeature, nint, 2))
 
-                clist.append(feature)
+    ### Per-step work is a handful of comparisons, so it's done on plain 
+    ### lists, which is much cheaper than numpy calls on a few elements
+    freq_list = peaks[:,0].tolist()
+    amp_list = peaks[:,1].tolist()
+    offset_list = np.asarray(offsets).tolist()
 
-            except:
-                clist.append([0.0, 0.0])
+    features = [float(init_feature) for init_feature in init_features]
+    jumps = [float(jump) for jump in allowed_jumps]
+    found_inds = np.full((nfeature, nint), -1, dtype=int)
 
-        ### Add the result from tracking this specific feature
-        feature_lists.append(clist)
+    for j in range(nint):
+        start, stop = offset_list[j], offset_list[j+1]
+        if stop == start:
+            continue
 
-    return np.array(feature_lists)
+        for i in range(nfeature):
+            loc = features[i]
+            max_dist = jumps[i] * loc
+
+            ### Walk outwards from the insertion point to visit the 3 closest
+            ### peaks in order of distance, stopping at the first one that's
+            ### too far, and keep the biggest
+            right = bisect.bisect_left(freq_list, loc, start, stop)
+            left = right - 1
+            best = -1
+            for _ in range(3):
+                dleft = loc - freq_list[left] if left >= start else np.inf
+                dright = freq_list[right] - loc if right < stop else np.inf
+                if dleft <= dright:
+                    ind, dist = left, dleft
+                    left -= 1
+                else:
+                    ind, dist = right, dright
+                    right += 1
+                if not dist < max_dist:
+                    break
+                if (best < 0) or (amp_list[ind] > amp_list[best]):
+                    best = ind
+
+            ### A lost feature keeps its old location
+            if best >= 0:
+                found_inds[i,j] = best
+                features[i] = freq_list[best]
+
+    found = found_inds >= 0
+    feature_lists[found] = peaks[found_inds[found]]
+
+    return feature_lists
 
 
 
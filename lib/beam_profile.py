@@ -1,11 +1,12 @@
 import numpy as np
 import bead_util as bu
-import matplotlib.pyplot as plt
+from lazy_import import lazy_module, lazy_callable
+plt = lazy_module('matplotlib.pyplot')
 import os
-import scipy.signal as sig
+sig = lazy_module('scipy.signal')
 import scipy
 import glob
-from scipy.optimize import curve_fit
+curve_fit = lazy_callable('scipy.optimize', 'curve_fit')
 
 
 data_dir1 = "/data/20180529/imaging_tests/p0/xprofile"
@@ -1,22 +1,38 @@
-import sys, time, traceback
+import os, sys, time, traceback
 
 import numpy as np
 
-import matplotlib
-matplotlib.use('gtk3agg')
-import matplotlib.pyplot as plt
-from matplotlib.ticker import MultipleLocator, NullFormatter
+from lazy_import import lazy_module, lazy_callable, when_imported
+
+def setup_pyplot(pyplot):
+    '''Plot style for this module, applied as soon as pyplot is imported
+       (here or by a script).'''
+    pyplot.rcParams.update({'font.size': 14})
+
+### The interactive backend has to be picked before pyplot is imported,
+### which no longer happens here
+if 'matplotlib' in sys.modules:
+    sys.modules['matplotlib'].use('gtk3agg')
+else:
+    os.environ.setdefault('MPLBACKEND', 'gtk3agg')
+
+plt = lazy_module('matplotlib.pyplot')
+when_imported('matplotlib.pyplot', setup_pyplot)
+MultipleLocator = lazy_callable('matplotlib.ticker', 'MultipleLocator')
+NullFormatter = lazy_callable('matplotlib.ticker', 'NullFormatter')
 
 import bead_util as bu
 import configuration as config
 
-import scipy.signal as signal
-import scipy.optimize as optimize
-import scipy.constants as constants
+signal = lazy_module('scipy.signal')
+optimize = lazy_module('scipy.optimize')
+constants = lazy_module('scipy.constants')
 
-import sklearn.cluster as cluster
+cluster = lazy_module('sklearn.cluster')
 
-plt.rcParams.update({'font.size': 14})
+tqdm = lazy_callable('tqdm', 'tqdm')
+Parallel = lazy_callable('joblib', 'Parallel')
+delayed = lazy_callable('joblib', 'delayed')
 
 #######################################################
 # Core module for handling calibrations, both the step 
@@ -55,17 +71,17 @@ def multi_step_fun(x, qs, x0s):
 
 
 
-def find_step_cal_response(file_obj, bandwidth=1., include_in_phase=False, \
-                           using_tabor=False, tabor_ind=3, mon_fac=100, \
-                           ecol=-1, pcol=-1, new_trap=False, plot=False, \
-                           userphase=0.0, nearest=True):
-    '''Analyze a data step-calibraiton data file, find the drive frequency,
-       correlate the response to the drive
+def get_step_cal_signals(file_obj, bandwidth=1., using_tabor=False, tabor_ind=3, \
+                         mon_fac=100, ecol=-1, pcol=-1, new_trap=False, plot=False):
+    '''Extracts the drive (electric field) and bandpass filtered response
+       of a step-calibration data file, and finds the drive frequency
 
        INPUTS:   file_obj, input file object
                  bandwidth, bandpass filter bandwidth
 
-       OUTPUTS:  H, (response / drive)'''
+       OUTPUTS:  drive, drive efield as a function of time
+                 responsefilt, filtered response as a function of time
+                 drive_freq, drive frequency'''
 
     if not using_tabor:
         if pcol == -1:
@@ -202,8 +218,22 @@ def find_step_cal_response(file_obj, bandwidth=1., include_in_phase=False, \
 
         input()
 
-    ### Compute the full, normalized correlation and extract amplitude
-    corr_full = bu.correlation(drive, responsefilt, file_obj.fsamp, drive_freq)
+    return drive, responsefilt, drive_freq
+
+
+
+
+def step_cal_response_from_corr(corr_full, drive, drive_freq, userphase=0.0):
+    '''Extracts the in-phase, maximum and user-phase response from the
+       full, normalized correlation of a step-calibration file
+
+       INPUTS:   corr_full, correlation from bu.correlation()
+                 drive, drive efield as a function of time
+                 drive_freq, drive frequency
+                 userphase, phase at which to take the correlation
+
+       OUTPUTS:  outdict, dictionary of responses / drive'''
+
     ncorr = len(corr_full)
 
     phase_ratio = userphase / (2.0 * np.pi)
@@ -234,6 +264,114 @@ def find_step_cal_response(file_obj, bandwidth=1., include_in_phase=False, \
 
 
 
+def find_step_cal_response(file_obj, bandwidth=1., include_in_phase=False, \
+                           using_tabor=False, tabor_ind=3, mon_fac=100, \
+                           ecol=-1, pcol=-1, new_trap=False, plot=False, \
+                           userphase=0.0, nearest=True):
+    '''Analyze a data step-calibraiton data file, find the drive frequency,
+       correlate the response to the drive
+
+       INPUTS:   file_obj, input file object
+                 bandwidth, bandpass filter bandwidth
+
+       OUTPUTS:  H, (response / drive)'''
+
+    drive, responsefilt, drive_freq = \
+            get_step_cal_signals(file_obj, bandwidth=bandwidth, using_tabor=using_tabor, \
+                                 tabor_ind=tabor_ind, mon_fac=mon_fac, ecol=ecol, \
+                                 pcol=pcol, new_trap=new_trap, plot=plot)
+
+    ### Compute the full, normalized correlation and extract amplitude
+    corr_full = bu.correlation(drive, responsefilt, file_obj.fsamp, drive_freq)
+
+    return step_cal_response_from_corr(corr_full, drive, drive_freq, userphase=userphase)
+
+
+
+
+def find_step_cal_responses(fnames, bandwidth=1., using_tabor=False, tabor_ind=3, \
+                            mon_fac=100, ecol=-1, pcol=-1, new_trap=False, \
+                            userphase=0.0, elec_channel_select=None, chunk_size=50, \
+                            ncore=1):
+    '''Same as find_step_cal_response() for a whole list of step-calibration
+       files. The files are loaded in chunks and reduced to their drive and 
+       response, then all files with the same length and drive frequency 
+       are correlated together in one batched FFT.
+
+       INPUTS:   fnames, list of step-calibration files
+                 bandwidth, bandpass filter bandwidth
+                 elec_channel_select, with the new trap, skip the files where
+                                      this electrode isn't driven
+                 chunk_size, number of files loaded per job
+                 ncore, number of jobs for loading the files
+
+       OUTPUTS:  outdicts, list of output dictionaries of 
+                           find_step_cal_response(), with 'time',
+                           'fname', 'nsamp' and 'fsamp' added, for each
+                           file that could be processed'''
+
+    def load_chunk(names):
+        signals = []
+        for name in names:
+            df = bu.DataFile()
+            try:
+                if new_trap:
+                    df.load_new(name)
+                    if (elec_channel_select is not None) and \
+                            (not df.electrode_settings['driven'][elec_channel_select]):
+                        continue
+                else:
+                    df.load(name)
+
+                if using_tabor and not new_trap:
+                    df.load_other_data()
+
+                drive, responsefilt, drive_freq = \
+                        get_step_cal_signals(df, bandwidth=bandwidth, using_tabor=using_tabor, \
+                                             tabor_ind=tabor_ind, mon_fac=mon_fac, \
+                                             ecol=ecol, pcol=pcol, new_trap=new_trap)
+            except Exception:
+                traceback.print_exc()
+                continue
+
+            signals.append({'fname': name, 'time': df.time, 'fsamp': df.fsamp, \
+                            'drive': drive, 'response': responsefilt, \
+                            'drive_freq': drive_freq})
+        return signals
+
+    chunks = [fnames[i:i+chunk_size] for i in range(0, len(fnames), chunk_size)]
+    signals = Parallel(n_jobs=ncore)(delayed(load_chunk)(names) \
+                                        for names in tqdm(chunks))
+    signals = [sig for chunk in signals for sig in chunk]
+
+    ### Correlate all of the files sharing a trace length, sampling and
+    ### drive frequency at once
+    groups = {}
+    for ind, sig in enumerate(signals):
+        key = (len(sig['drive']), sig['fsamp'], sig['drive_freq'])
+        groups.setdefault(key, []).append(ind)
+
+    outdicts = [None for sig in signals]
+    for (nsamp, fsamp, drive_freq), inds in groups.items():
+        drives = np.array([signals[ind]['drive'] for ind in inds])
+        responses = np.array([signals[ind]['response'] for ind in inds])
+        corrs = bu.correlation(drives, responses, fsamp, drive_freq)
+
+        for ind, corr_full, drive in zip(inds, corrs, drives):
+            outdict = step_cal_response_from_corr(corr_full, drive, drive_freq, \
+                                                  userphase=userphase)
+            outdict['time'] = signals[ind]['time']
+            outdict['fname'] = signals[ind]['fname']
+            outdict['nsamp'] = nsamp
+            outdict['fsamp'] = fsamp
+            outdicts[ind] = outdict
+
+    return outdicts
+
+
+
+
+
 def step_cal(step_cal_vec, nsec=10, amp_gain = 1., new_trap = False, \
              auto_try = 0.0, max_step_size=10, plot_residual_histograms=False):
     '''Generates a step calibration from a list of DataFile objects
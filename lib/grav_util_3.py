@@ -1,54 +1,90 @@
-import os, sys, time, itertools, copy, re
+import os, sys, time, itertools, copy, re, traceback
+
+from statistics import NormalDist
 
 import dill as pickle
 
 import numpy as np
 import scipy
 
-from scipy.optimize import curve_fit
+from lazy_import import lazy_module, lazy_callable, when_imported
+
+def setup_pyplot(pyplot):
+    '''Plot style for this module, applied as soon as pyplot is imported
+       (here or by a script), along with the 3D axes used by some of the
+       plots.'''
+    import mpl_toolkits.mplot3d
+    pyplot.rcParams.update({'font.size': 14})
 
-from mpl_toolkits.mplot3d import Axes3D
-import matplotlib.pyplot as plt
+curve_fit = lazy_callable('scipy.optimize', 'curve_fit')
 
-import scipy.interpolate as interp
-import scipy.stats as stats
-import scipy.optimize as opti
-import scipy.linalg as linalg
+plt = lazy_module('matplotlib.pyplot')
+when_imported('matplotlib.pyplot', setup_pyplot)
+
+interp = lazy_module('scipy.interpolate')
+stats = lazy_module('scipy.stats')
+opti = lazy_module('scipy.optimize')
+linalg = lazy_module('scipy.linalg')
 
 import bead_util as bu
+import attrib_index
+import agg_store
 import calib_util as cal
 import transfer_func_util as tf
 import configuration as config
-import pandas as pd
 
-from tqdm import tqdm
-from joblib import Parallel, delayed
+tqdm = lazy_callable('tqdm', 'tqdm')
+Parallel = lazy_callable('joblib', 'Parallel')
+delayed = lazy_callable('joblib', 'delayed')
 
-from iminuit import Minuit, describe
+Minuit = lazy_callable('iminuit', 'Minuit')
+describe = lazy_callable('iminuit', 'describe')
 
 import warnings
 warnings.filterwarnings("ignore")
 
-plt.rcParams.update({'font.size': 14})
-
-### Current constraints
+### Current constraints. The limit files are only read when they're
+### first used, through get_limit_data() or the module attributes
+### limitdata and limitdata2 (see __getattr__() below)
 
 limitdata_path = '/data/old_trap_processed/sensitivities/decca1_limits.txt'
-limitdata = np.loadtxt(limitdata_path, delimiter=',')
 limitlab = 'No Decca 2'
 
 limitdata_path2 = '/data/old_trap_processed/sensitivities/decca2_limits.txt'
-limitdata2 = np.loadtxt(limitdata_path2, delimiter=',')
 limitlab2 = 'With Decca 2'
 
+limit_data_cache = {}
+
 
 
 ### Stats
 
 confidence_level = 0.95
-chi2dist = stats.chi2(1)
-# factor of 0.5 from Wilks's theorem: -2 log (Liklihood) ~ chi^2(1)
-con_val = 0.5 * chi2dist.ppf(confidence_level)
+# factor of 0.5 from Wilks's theorem: -2 log (Liklihood) ~ chi^2(1). The
+# quantile of chi^2(1) is the square of the normal one, which avoids
+# importing scipy.stats here
+con_val = 0.5 * NormalDist().inv_cdf(0.5 + 0.5 * confidence_level)**2
+
+
+
+def get_limit_data(path):
+    '''Loads (once) one of the limit curves, as an (N, 2) array of 
+       lambda [m] and alpha.'''
+    if path not in limit_data_cache:
+        limit_data_cache[path] = np.loadtxt(path, delimiter=',')
+    return limit_data_cache[path]
+
+
+
+def __getattr__(name):
+    '''Module attributes that are only built when first accessed.'''
+    if name == 'limitdata':
+        return get_limit_data(limitdata_path)
+    if name == 'limitdata2':
+        return get_limit_data(limitdata_path2)
+    if name == 'chi2dist':
+        return stats.chi2(1)
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
 
 
 ax_dict = {0: 'X', 1: 'Y', 2: 'Z'}
@@ -167,10 +203,125 @@ def null(A, eps=1.0e-15):
 
 
 
+def householder_complement_params(unit_vecs):
+    '''Computes the Householder reflection used to build an orthonormal
+       complement of one or many unit vectors u, without building any
+       matrices. With P = I - tau * v v^T acting on u[1:] and mapping it
+       to beta * e_0, the complement of u is spanned by rows 1 through
+       N-2 of P (placed in components 1 through N-1), followed by
+       (-beta*sign(u[0]), |u[0]| * P[0]). This is the basis that the SVD
+       in null() returns for a matrix with u as its only non-zero row, in
+       the same order and with the same signs (up to the sign of the last
+       vector for some templates with exactly-zero leading components).
+
+       INPUTS:   unit_vecs, (..., N) array of unit vectors, N > 1
+
+       OUTPUTS:  tau, (...) array of reflection coefficients
+                 v, (..., N-1) array of reflection vectors, v[...,0] = 1
+                 beta, (...) array, the reflected u[1:] is beta * e_0
+                 sign0, (...) array of the sign of u[0], with sign(0) = 1
+    '''
+    unit_vecs = np.asarray(unit_vecs, dtype=np.float64)
+
+    alpha = unit_vecs[...,1]
+    xnorm = np.linalg.norm(unit_vecs[...,2:], axis=-1)
+
+    ### Same conventions as LAPACK's dlarfg: nothing to reflect if the
+    ### components after alpha are all zero
+    reflect = xnorm != 0
+    beta = np.where(reflect, -np.copysign(np.hypot(alpha, xnorm), alpha), alpha)
+    safe_beta = np.where(reflect, beta, 1.0)
+    tau = np.where(reflect, (beta - alpha) / safe_beta, 0.0)
+
+    v = np.ones(unit_vecs.shape[:-1] + (unit_vecs.shape[-1] - 1,))
+    denom = np.where(reflect, alpha - beta, 1.0)
+    v[...,1:] = unit_vecs[...,2:] / denom[...,np.newaxis]
+
+    sign0 = np.where(unit_vecs[...,0] >= 0, 1.0, -1.0)
+
+    return tau, v, beta, sign0
+
+
+
+
+def template_complement(template_vec):
+    '''Builds the N-1 orthonormal vectors spanning the complement of a
+       single N-dimensional real vector, as rows of an (N-1)xN ndarray.
+       See householder_complement_params() for the construction.'''
+
+    template_vec = np.asarray(template_vec, dtype=np.float64)
+    ndim = len(template_vec)
+    if ndim < 2:
+        return np.zeros((0, ndim))
+
+    unit_vec = template_vec / np.linalg.norm(template_vec)
+    tau, v, beta, sign0 = householder_complement_params(unit_vec)
+
+    reflection = np.eye(ndim - 1) - tau * np.outer(v, v)
+
+    complement = np.zeros((ndim - 1, ndim))
+    complement[:-1,1:] = reflection[1:]
+    complement[-1,0] = -beta * sign0
+    complement[-1,1:] = np.abs(unit_vec[0]) * reflection[0]
+
+    return complement
+
+
+
+
+def project_onto_template_basis(template_vecs, data_vecs):
+    '''Projects data onto the orthogonal basis built from a template by
+       make_basis_from_template_vec(), in units of the template amplitude.
+       Output k is np.inner(real_basis[k], data) / np.inner(template, template),
+       so output 0 is the best-fit template amplitude and the rest are the
+       components of the data orthogonal to the template. The basis itself
+       is never built, so this is O(N) per projection, and any number of
+       templates and data vectors are done in one go.
+
+       INPUTS:   template_vecs, (..., N) array of real template vectors
+                 data_vecs, (..., K, N) array of real data vectors, with
+                            K vectors projected onto each template
+
+       OUTPUTS:  projections, (..., K, N) array
+    '''
+    template_vecs = np.asarray(template_vecs, dtype=np.float64)
+    data_vecs = np.asarray(data_vecs, dtype=np.float64)
+
+    template_norm = np.linalg.norm(template_vecs, axis=-1)
+    unit_vecs = template_vecs / template_norm[...,np.newaxis]
+    tau, v, beta, sign0 = householder_complement_params(unit_vecs)
+
+    ### Add an axis to broadcast the parameters of each template
+    ### against its K data vectors
+    template_norm = template_norm[...,np.newaxis]
+    tau, beta, sign0 = tau[...,np.newaxis], beta[...,np.newaxis], sign0[...,np.newaxis]
+    v = v[...,np.newaxis,:]
+    u0 = unit_vecs[...,np.newaxis,0]
+
+    ### Apply the reflection to the components 1 through N-1 of the data
+    tail = data_vecs[...,1:]
+    reflected = tail - (tau * np.sum(v * tail, axis=-1))[...,np.newaxis] * v
+
+    projections = np.empty(data_vecs.shape)
+    projections[...,0] = np.einsum('...n,...kn->...k', unit_vecs, data_vecs)
+    projections[...,1:-1] = reflected[...,1:]
+    projections[...,-1] = -beta * sign0 * data_vecs[...,0] \
+                            + np.abs(u0) * reflected[...,0]
+
+    ### The basis vectors after the template are scaled by the template norm,
+    ### then everything is normalized by the squared template norm
+    projections[...,0] *= 1.0 / template_norm
+    projections[...,1:] *= 1.0 / template_norm[...,np.newaxis]
+
+    return projections
+
+
+
+
 def make_basis_from_template_vec(template_vec):
-    '''Uses SVD decomposition to make a set of N, linearly
-       independent basis-vectors from a single N-dimensional
-       input vector.
+    '''Makes a set of N, linearly independent basis-vectors from a 
+       single N-dimensional input vector, using Householder reflections
+       to build orthonormal complements of the real and imaginary parts.
 
        INPUTS:   template_vec, iterable object with N-components
                                assumed complex-valued. 
@@ -190,27 +341,18 @@ def make_basis_from_template_vec(template_vec):
     real_norm = np.linalg.norm(reals)
     imag_norm = np.linalg.norm(imags)
 
-    zeros = np.zeros_like(reals)
-    
-    ### Build up the matrix of basis vectors with our single, known
-    ### vector and the rest zeros (large null space)
-    real_rows = [reals / real_norm]
-    if imag_norm != 0: 
-        # if template_vec is real, then imag_norm = 0. we don't
-        # want any divide-by-zero errors do we
-        imag_rows = [imags / imag_norm]
+    ### Compute a set of orthonormal vectors that span the complement
+    ### of each component. If template_vec is real, then imag_norm = 0,
+    ### and (like the old SVD-based null()) we keep a block of zeros
+    if real_norm != 0:
+        real_basis = template_complement(reals) * real_norm
     else:
-        imag_rows = [imags]
+        real_basis = np.zeros((len(reals), len(reals)))
 
-    ### Add the zero vectors
-    for dim in range(len(reals)-1):
-        real_rows.append(zeros)
-        imag_rows.append(zeros)
-
-    ### Compute a set of linearly independent vectors that span
-    ### the null of the given matrices
-    real_basis = null(real_rows) * real_norm
-    imag_basis = null(imag_rows) * imag_norm
+    if imag_norm != 0:
+        imag_basis = template_complement(imags) * imag_norm
+    else:
+        imag_basis = np.zeros((len(imags), len(imags)))
     
     ### Append the real and imaginary components of the given input
     ### vector in order to complete the spanning basis
@@ -467,11 +609,58 @@ def fit_parabola_to_chi2(params, chi_sqs, plot=False):
 
 
 
-def build_mod_grav_funcs(theory_data_dir):
+### Template grids opened by build_mod_grav_funcs() in this process, keyed
+### by directory, so the GravFuncs objects sent to joblib workers only
+### open them once per worker (see GravFuncs.__setstate__())
+grav_funcs_cache = {}
+
+grav_data_fnames = ['Gravdata.npy', 'yukdata.npy', 'lambdas.npy', \
+                    'xpos.npy', 'ypos.npy', 'zpos.npy']
+
+
+
+class GridComponent:
+    '''Interpolating function for some of the outputs of a multi-output
+       RegularGridInterpolator, e.g. a single axis of the Newtonian force
+       or a single lambda of the Yukawa force. It interpolates a view of 
+       the grid values of the full interpolator, so nothing is copied, and
+       it's only built the first time it's called.
+
+       INPUTS: func, the multi-output RegularGridInterpolator
+               index, tuple of indices into the output dimensions of func'''
+
+    def __init__(self, func, index):
+        self.func = func
+        self.index = tuple(index)
+        self.component_func = None
+
+
+    def __call__(self, pts):
+        if self.component_func is None:
+            ndim = len(self.func.grid)
+            values = self.func.values[(slice(None),)*ndim + self.index]
+            self.component_func = interp.RegularGridInterpolator(self.func.grid, values)
+        return self.component_func(pts)
+
+
+
+
+def build_mod_grav_funcs(theory_data_dir, mmap=True, cache=True):
     '''Loads data from the output of /data/grav_sim_data/process_data.py
        which processes the raw simulation output from the farmshare code
 
+       The force grids are memory-mapped (read-only) rather than read
+       into memory, so only the parts that are interpolated get read, and
+       every process working from the same directory shares the same
+       pages. There is one interpolating function for all the axes, and
+       one for all the lambdas and axes. The per-axis and per-lambda 
+       functions are views of those (see GridComponent).
+
        INPUTS: theory_data_dir, path to the directory containing the data
+               mmap, boolean to memory-map the force grids
+               cache, boolean to reuse the functions already built in
+                      this process for the same directory, as long as
+                      the files haven't changed
 
        OUTPUTS: gfuncs, 3 element list with 3D interpolating functions
                         for regular gravity [fx, fy, fz]
@@ -481,9 +670,20 @@ def build_mod_grav_funcs(theory_data_dir):
                 lambdas, np.array with all lambdas from the simulation
     '''
 
+    ### Files that are rewritten (e.g. by collect_results.py) are reopened
+    mtimes = tuple(os.stat(theory_data_dir + fname).st_mtime_ns \
+                        for fname in grav_data_fnames)
+    cache_key = (os.path.abspath(theory_data_dir), bool(mmap))
+    if cache and (cache_key in grav_funcs_cache):
+        cache_mtimes, outdic = grav_funcs_cache[cache_key]
+        if cache_mtimes == mtimes:
+            return outdic
+
+    mmap_mode = 'r' if mmap else None
+
     ### Load modified gravity curves from simulation output
-    Gdata = np.load(theory_data_dir + 'Gravdata.npy')
-    yukdata = np.load(theory_data_dir + 'yukdata.npy')
+    Gdata = np.load(theory_data_dir + 'Gravdata.npy', mmap_mode=mmap_mode)
+    yukdata = np.load(theory_data_dir + 'yukdata.npy', mmap_mode=mmap_mode)
     lambdas = np.load(theory_data_dir + 'lambdas.npy')
     xpos = np.load(theory_data_dir + 'xpos.npy')
     ypos = np.load(theory_data_dir + 'ypos.npy')
@@ -497,26 +697,27 @@ def build_mod_grav_funcs(theory_data_dir):
     xlim = (np.min(xpos), np.max(xpos))
     ylim = (np.min(ypos), np.max(ypos))
     zlim = (np.min(zpos), np.max(zpos))
-
-    # print('Lims')
-    # print(xlim)
-    # print(ylim)
-    # print(zlim)
-
-    ### Build interpolating functions for regular gravity
-    gfuncs = [0,0,0]
-    for resp in [0,1,2]:
-        gfuncs[resp] = interp.RegularGridInterpolator((xpos, ypos, zpos), Gdata[:,:,:,resp])
-
-    ### Build interpolating functions for yukawa-modified gravity
-    yukfuncs = [[],[],[]]
-    for resp in [0,1,2]:
-        for lambind, yuklambda in enumerate(lambdas):
-            lamb_func = interp.RegularGridInterpolator((xpos, ypos, zpos), yukdata[lambind,:,:,:,resp])
-            yukfuncs[resp].append(lamb_func)
     lims = [xlim, ylim, zlim]
 
-    outdic = {'gfuncs': gfuncs, 'yukfuncs': yukfuncs, 'lambdas': lambdas, 'lims': lims}
+    ### Single interpolating functions with all axes (and lambdas) as 
+    ### outputs, to evaluate every template in one call. Output shapes
+    ### are (Npts, 3) and (Npts, Nlambda, 3) respectively
+    gfunc_all = interp.RegularGridInterpolator((xpos, ypos, zpos), Gdata)
+    yukfunc_all = interp.RegularGridInterpolator((xpos, ypos, zpos), \
+                                                 np.moveaxis(yukdata, 0, -2))
+
+    ### Interpolating functions for each axis of regular gravity, and
+    ### each axis and lambda of yukawa-modified gravity
+    gfuncs = [GridComponent(gfunc_all, (resp,)) for resp in [0,1,2]]
+    yukfuncs = [[GridComponent(yukfunc_all, (lambind, resp)) \
+                    for lambind in range(len(lambdas))] for resp in [0,1,2]]
+
+    outdic = {'gfuncs': gfuncs, 'yukfuncs': yukfuncs, 'lambdas': lambdas, 'lims': lims, \
+              'gfunc_all': gfunc_all, 'yukfunc_all': yukfunc_all}
+
+    if cache:
+        grav_funcs_cache[cache_key] = (mtimes, outdic)
+
     return outdic
 
     #return gfuncs, yukfuncs, lambdas, lims
@@ -530,15 +731,41 @@ def build_mod_grav_funcs(theory_data_dir):
 
 
 
+### Attributes of GravFuncs holding the interpolating functions
+grav_func_keys = ['gfuncs', 'yukfuncs', 'gfunc_all', 'yukfunc_all']
+
 class GravFuncs:
 
     def __init__(self, theory_data_dir, load=True, verbose=True):
+        self.template_bank = {}
         if load:
             self.load_grav_funcs(theory_data_dir, verbose=verbose)
         else:
             self.grav_loaded = False
 
 
+    def __getstate__(self):
+        '''The interpolating functions aren't pickled, since they're backed
+           by the memory-mapped template grids. They're rebuilt from the 
+           same files when unpickled, so joblib workers share the grids
+           rather than each getting a copy.'''
+        state = self.__dict__.copy()
+        for key in grav_func_keys:
+            state.pop(key, None)
+        return state
+
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if getattr(self, 'grav_loaded', False):
+            try:
+                self.load_grav_funcs(self.theory_data_dir, verbose=False)
+            except Exception:
+                print("Couldn't reload gravity data from: ", self.theory_data_dir)
+                traceback.print_exc()
+                self.clear_grav_funcs()
+
+
     def load_grav_funcs(self, theory_data_dir, verbose=True):
         self.theory_data_dir = theory_data_dir
         if verbose:
@@ -547,6 +774,8 @@ class GravFuncs:
         grav_dict = build_mod_grav_funcs(theory_data_dir)
         self.gfuncs = grav_dict['gfuncs']
         self.yukfuncs = grav_dict['yukfuncs']
+        self.gfunc_all = grav_dict['gfunc_all']
+        self.yukfunc_all = grav_dict['yukfunc_all']
         self.lambdas = grav_dict['lambdas']
         self.lims = grav_dict['lims']
         self.grav_loaded = True
@@ -564,12 +793,44 @@ class GravFuncs:
     def clear_grav_funcs(self):
         self.gfuncs = ''
         self.yukfuncs = ''
+        self.gfunc_all = ''
+        self.yukfunc_all = ''
         self.lambdas = ''
         self.lims = ''
         self.grav_loaded = False
 
 
 
+    def get_harmonic_coeffs(self, forces, posvec, drivevec, ginds, nharm, normfac):
+        '''Resamples forces, sampled along posvec, onto the attractor drive,
+           then keeps the nharm largest FFT coefficients out of the bins
+           in ginds. Any number of forces are done with one interpolating
+           function and one batched FFT.
+
+           INPUTS: forces, (Npos, ...) array of forces along posvec
+                   posvec, bead position relative to the density modulation
+                   drivevec, same position as a function of time
+
+           OUTPUTS: coeffs, (..., nharm) array of FFT coefficients
+                    coeff_bool, (..., len(ginds)) boolean array with the 
+                                bins of ginds that were kept
+                    forcet, (..., Nsamp) array of forces vs time'''
+
+        force_func = interp.interp1d(posvec, forces, axis=0)
+        forcet = np.moveaxis(force_func(drivevec), 0, -1)
+
+        curr_fft = np.fft.rfft(forcet)[...,ginds] * normfac
+        curr_asd = np.abs(curr_fft)
+
+        thresh = np.sort(curr_asd, axis=-1)[...,[-nharm]]
+        coeff_bool = curr_asd >= thresh
+
+        coeffs = curr_fft[coeff_bool].reshape(forces.shape[1:] + (nharm,))
+
+        return coeffs, coeff_bool, forcet
+
+
+
     def make_templates(self, cant_posvec, drivevec, ax0pos, ax1pos, ginds, \
                        p0_bead, fsamp, single_lambda=False, single_lambind=0, \
                        new_trap=False, plot=True, n_largest_harms=100):
@@ -592,94 +853,83 @@ class GravFuncs:
         normfac = np.sqrt(2.0 * bin_sp) * bu.fft_norm(nsamp, fsamp)
 
         ## Include normal gravity in fit. But why???
-        gfft = np.zeros((3, nharm), dtype=np.complex128)
-        gbool = np.zeros((3, len(ginds)), dtype=bool)
-        for resp in [0,1,2]:
-                    
-            gforce = self.gfuncs[resp](pts*1.0e-6)
-            gforce_func = interp.interp1d(posvec, gforce)
-
-            gforcet = gforce_func(drivevec)
-            curr_gfft = np.fft.rfft(gforcet)[ginds] * normfac
-            curr_asd = np.abs(curr_gfft)
+        gforce = self.gfunc_all(pts*1.0e-6)
+        gfft, gbool, _ = self.get_harmonic_coeffs(gforce, posvec, drivevec, \
+                                                  ginds, nharm, normfac)
+
+        ### Evaluate the modified gravity for every lambda and axis at once,
+        ### unless a single lambda is requested, in which case the others
+        ### are left as zeros
+        nlambda = len(self.lambdas)
+        yuks = np.zeros( (nlambda, 3, nharm), dtype=np.complex128)
+        yukbool = np.zeros( (nlambda, 3, len(ginds)), dtype=bool)
+        if single_lambda:
+            lambinds = [single_lambind]
+            yukforce = GridComponent(self.yukfunc_all, (single_lambind,))\
+                                (pts*1.0e-6)[:,np.newaxis,:]
+        else:
+            lambinds = list(range(nlambda))
+            yukforce = self.yukfunc_all(pts*1.0e-6)
 
-            thresh = (curr_asd[np.argsort(curr_asd)[::-1]])[nharm-1]
-            bool_ginds = curr_asd >= thresh
-            gbool[resp,:] = bool_ginds
+        yuks[lambinds], yukbool[lambinds], yukforcet = \
+                    self.get_harmonic_coeffs(yukforce, posvec, drivevec, \
+                                             ginds, nharm, normfac)
 
-            gfft[resp] += np.fft.rfft(gforcet)[ginds[bool_ginds]] * normfac
+        for ind, lambind in enumerate(lambinds):
 
-        yuks = np.zeros( (len(self.lambdas), 3, nharm), dtype=np.complex128)
-        yukbool = np.zeros( (len(self.lambdas), 3, len(ginds)), dtype=bool)
-        for lambind, yuklambda in enumerate(self.lambdas):
+            if not plot:
+                break
 
-            if single_lambda and (lambind != single_lambind):
-                continue
+            yuklambda = self.lambdas[lambind]
 
-            if plot:
-                fig1, ax1 = plt.subplots(1,1)
-                fig2, ax2 = plt.subplots(1,1)
-                fig3, ax3 = plt.subplots(1,1)
-                fig4, ax4 = plt.subplots(1,1)
+            fig1, ax1 = plt.subplots(1,1)
+            fig2, ax2 = plt.subplots(1,1)
+            fig3, ax3 = plt.subplots(1,1)
+            fig4, ax4 = plt.subplots(1,1)
 
-                ax1.set_title('Attractor Drive')
-                ax1.plot((1.0 / fsamp) * np.arange(nsamp), drivevec)
-                ax1.set_xlabel('Time [s]')
-                ax1.set_ylabel('Attractor drive [um]')
-                fig1.tight_layout()
+            ax1.set_title('Attractor Drive')
+            ax1.plot((1.0 / fsamp) * np.arange(nsamp), drivevec)
+            ax1.set_xlabel('Time [s]')
+            ax1.set_ylabel('Attractor drive [um]')
+            fig1.tight_layout()
 
             resp_dict = {0: 'X', 1: 'Y', 2: 'Z'}
             marker_dict = {0: 'o', 1: 'P', 2: 'X'}
             for resp in [0,1,2]:
-                yukforce = self.yukfuncs[resp][lambind](pts*1.0e-6)
-                yukforce_func = interp.interp1d(posvec, yukforce)
-
-                yukforcet = yukforce_func(drivevec)
-                curr_yukfft = np.fft.rfft(yukforcet)[ginds] * normfac
-                curr_asd = np.abs(curr_yukfft)
-
-                thresh = (curr_asd[np.argsort(curr_asd)[::-1]])[nharm-1]
-                bool_ginds = curr_asd >= thresh
-                yukbool[lambind,resp,:] = bool_ginds
-
-                yuks[lambind,resp,:] += np.fft.rfft(yukforcet)[ginds[bool_ginds]] * normfac
+                ax2.plot((1.0 / fsamp) * np.arange(nsamp), yukforcet[ind,resp], \
+                         label=resp_dict[resp])
+                ax3.plot(posvec, yukforce[:,ind,resp], label=resp_dict[resp])
+                ax4.loglog(freqs, np.abs(np.fft.rfft(yukforcet[ind,resp]))*normfac, \
+                            ls='', marker=marker_dict[resp], alpha=0.3, \
+                            color='C{:d}'.format(resp), ms=5)
+                ax4.loglog(freqs[ginds[yukbool[lambind,resp,:]]], \
+                           np.abs(yuks[lambind,resp,:]), \
+                           ls='', marker=marker_dict[resp], label=resp_dict[resp], \
+                           color='C{:d}'.format(resp), ms=10)
+
+            title_str = 'Force for $\\alpha = 1$ and $\\lambda = {:0.1g}$ m'\
+                            .format(yuklambda)
+            ax2.set_title(title_str)
+            ax2.set_xlabel('Time [s]')
+            ax2.set_ylabel('Force [N]')
+            ax2.legend(fontsize=10, ncol=3)
+            fig2.tight_layout()
+
+            ax3.set_title(title_str)
+            ax3.set_xlabel('Position along Density Modulation [um]')
+            ax3.set_ylabel('Force [N]')
+            ax3.legend(fontsize=10, ncol=3)
+            fig3.tight_layout()
+
+            ax4.set_title(title_str)
+            ax4.set_xlabel('Frequency [Hz]')
+            ax4.set_ylabel('Force Spectral Density [N/$\\sqrt{\\rm{Hz}}$]')
+            ax4.legend(fontsize=10, ncol=3)
+            fig4.tight_layout()
 
+            plt.show()
 
-                if plot:
-                    ax2.plot((1.0 / fsamp) * np.arange(nsamp), yukforcet, label=resp_dict[resp])
-                    ax3.plot(posvec, yukforce, label=resp_dict[resp])
-                    ax4.loglog(freqs, np.abs(np.fft.rfft(yukforcet))*normfac, \
-                                ls='', marker=marker_dict[resp], alpha=0.3, \
-                                color='C{:d}'.format(resp), ms=5)
-                    ax4.loglog(freqs[ginds[yukbool[lambind,resp,:]]], \
-                               np.abs(yuks[lambind,resp,:]), \
-                               ls='', marker=marker_dict[resp], label=resp_dict[resp], \
-                               color='C{:d}'.format(resp), ms=10)
-
-            if plot:
-                title_str = 'Force for $\\alpha = 1$ and $\\lambda = {:0.1g}$ m'\
-                                .format(yuklambda)
-                ax2.set_title(title_str)
-                ax2.set_xlabel('Time [s]')
-                ax2.set_ylabel('Force [N]')
-                ax2.legend(fontsize=10, ncol=3)
-                fig2.tight_layout()
-
-                ax3.set_title(title_str)
-                ax3.set_xlabel('Position along Density Modulation [um]')
-                ax3.set_ylabel('Force [N]')
-                ax3.legend(fontsize=10, ncol=3)
-                fig3.tight_layout()
-
-                ax4.set_title(title_str)
-                ax4.set_xlabel('Frequency [Hz]')
-                ax4.set_ylabel('Force Spectral Density [N/$\\sqrt{\\rm{Hz}}$]')
-                ax4.legend(fontsize=10, ncol=3)
-                fig4.tight_layout()
-
-                plt.show()
-
-                input()
+            input()
 
         yukamp = np.mean(np.abs(yuks[0]))
         #yukstr = '%0.3e' % yukamp
@@ -692,12 +942,125 @@ class GravFuncs:
 
 
 
+    def get_template_key(self, obj, ax0pos, ax1pos, p0_bead, n_largest_harms=100, \
+                         drive_tol=0.1):
+        '''Key of the template bank for a FileData object. Files share 
+           templates if they're at the same position, with the same bead
+           position and the same notch filter, and their attractor drives 
+           have the same frequency, and the same mean and amplitude to
+           within drive_tol [um]. The phase of the drive doesn't matter,
+           since the bank stores templates for phase-referenced drives.'''
+
+        drivevec = obj.rebuild_drive(phase_ref=True)
+        drive_mean = int(np.round(np.mean(drivevec) / drive_tol))
+        drive_amp = int(np.round(0.5 * np.ptp(drivevec) / drive_tol))
+
+        return (getattr(self, 'theory_data_dir', ''), float(ax0pos), float(ax1pos), \
+                tuple(float(p) for p in p0_bead), int(obj.nsamp), float(obj.fsamp), \
+                int(obj.fund_ind), drive_mean, drive_amp, \
+                tuple(int(ind) for ind in obj.ginds), int(n_largest_harms))
+
+
+
+    def get_bank_templates(self, obj, ax0pos, ax1pos, p0_bead, n_largest_harms=100, \
+                           drive_tol=0.1, new_trap=False, plot=False):
+        '''Returns templates (see make_templates()) for the drive of a
+           FileData object, from the template bank. If there are no templates
+           yet for its key (see get_template_key()), they are computed with
+           the phase-referenced drive of obj and added to the bank.
+
+           Since the drive is periodic, shifting its phase by phi just
+           multiplies the FFT coefficient at the h-th harmonic of the 
+           drive by exp(i * h * phi). So templates are rotated from the 
+           reference phase to the phase of obj's drive.'''
+
+        key = self.get_template_key(obj, ax0pos, ax1pos, p0_bead, \
+                                    n_largest_harms=n_largest_harms, drive_tol=drive_tol)
+
+        if not hasattr(self, 'template_bank'):
+            self.template_bank = {}
+
+        if key not in self.template_bank:
+            drivevec = obj.rebuild_drive(phase_ref=True)
+            templates = self.make_templates(obj.posvec, drivevec, ax0pos, ax1pos, \
+                                            obj.ginds, p0_bead, obj.fsamp, \
+                                            new_trap=new_trap, plot=plot, \
+                                            n_largest_harms=n_largest_harms)
+            self.template_bank[key] = {'yukffts': templates['yukffts'], \
+                                       'yukbool': templates['yukbool']}
+
+        return self.rotate_bank_templates(self.template_bank[key], obj)
+
+
+
+    def fill_template_bank(self, objs, ax0pos, ax1pos, n_largest_harms=100, \
+                           drive_tol=0.1, new_trap=False, plot=False, ncore=1):
+        '''Computes the templates missing from the template bank for a list 
+           of FileData objects, once per key, in parallel.
+
+           OUTPUTS: keys, list of template bank keys aligned with objs'''
+
+        if not hasattr(self, 'template_bank'):
+            self.template_bank = {}
+
+        keys = [self.get_template_key(obj, ax0pos, ax1pos, obj.p0_bead, \
+                                      n_largest_harms=n_largest_harms, drive_tol=drive_tol) \
+                    for obj in objs]
+
+        new_objs = {}
+        for key, obj in zip(keys, objs):
+            if (key not in self.template_bank) and (key not in new_objs):
+                new_objs[key] = obj
+
+        def make_entry(obj):
+            ### Copy without the bank, so it isn't sent to every job
+            gfunc = GravFuncs('', load=False)
+            gfunc.__dict__.update(self.__dict__)
+            gfunc.template_bank = {}
+            gfunc.get_bank_templates(obj, ax0pos, ax1pos, obj.p0_bead, \
+                                     n_largest_harms=n_largest_harms, drive_tol=drive_tol, \
+                                     new_trap=new_trap, plot=plot)
+            return list(gfunc.template_bank.values())[0]
+
+        if len(new_objs):
+            entries = Parallel(n_jobs=ncore)(delayed(make_entry)(obj) \
+                                                for obj in new_objs.values())
+            self.template_bank.update(zip(new_objs.keys(), entries))
+
+        return keys
+
+
+
+    @staticmethod
+    def rotate_bank_templates(entry, obj):
+        '''Rotates the templates of a template bank entry from the reference
+           drive phase to the drive phase of a FileData object.'''
+
+        yukbool = entry['yukbool']
+        harm_nums = np.array(obj.ginds) / float(obj.fund_ind)
+        harm_nums = np.broadcast_to(harm_nums, yukbool.shape)[yukbool]
+
+        phase_fac = np.exp(1.0j * harm_nums * obj.get_drive_phase())
+        yukffts = entry['yukffts'] * phase_fac.reshape(entry['yukffts'].shape)
 
+        return {'yukffts': yukffts, 'yukbool': yukbool}
 
 
 
 
 
+
+
+
+
+### Array attributes of FileData kept in the columnar AggregateData store,
+### in addition to the scalars in agg_store.scalar_dtypes
+store_array_keys = ['ginds', 'drive_ginds', 'err_ginds', 'datfft', 'daterr', \
+                    'diagdatfft', 'diagdaterr', 'noisefft', 'drivefft', \
+                    'drivefft_all', 'binned', 'posvec']
+
+
+
 class FileData:
     '''A class to store data from a single file, only
        what is relevant for higher level analysis.'''
@@ -705,9 +1068,10 @@ class FileData:
 
     def __init__(self, fname, diagonalize=True, tfdate='', tophatf=2500, \
                     plot_tf=False, step_cal_drive_freq=41.0, \
-                    new_trap=False, empty=False, suppress_off_diag=False):
+                    new_trap=False, empty=False, suppress_off_diag=False, lazy=False):
         '''Load an hdf5 file into a bead_util.DataFile obj. Calibrate the stage position.
-           Calibrate the microsphere response with th transfer function.'''
+           Calibrate the microsphere response with th transfer function. With lazy=True,
+           channels of the DataFile are only read from disk when they're first used.'''
 
 
         self.tfdate = tfdate
@@ -725,9 +1089,9 @@ class FileData:
             self.fname = fname
             try:
                 if new_trap:
-                    df.load_new(fname)
+                    df.load_new(fname, lazy=lazy)
                 else:
-                    df.load(fname)
+                    df.load(fname, lazy=lazy)
                 self.badfile = False
             except Exception:
                 self.badfile = True
@@ -779,7 +1143,16 @@ class FileData:
         self.df = df
 
 
-    def rebuild_drive(self):
+    def get_drive_phase(self):
+        '''Phase of the fundamental of the attractor drive.'''
+        inds = np.array(self.drive_ginds)
+        return np.angle(self.drivefft_all[np.argmin(np.abs(inds - self.fund_ind))])
+
+
+
+    def rebuild_drive(self, phase_ref=False):
+        '''Rebuilds the attractor drive from its harmonics. With phase_ref=True,
+           the drive is shifted in time so its fundamental has zero phase.'''
 
         ## Transform ginds array to array of indices for drive freq
         #temp_inds = np.array(range(int(self.nsamp*0.5) + 1))
@@ -790,9 +1163,14 @@ class FileData:
         bin_sp = freqs[1] - freqs[0]
         normfac = np.sqrt(2.0 * bin_sp) * bu.fft_norm(self.nsamp, self.fsamp)
 
+        drivefft_all = np.array(self.drivefft_all)
+        if phase_ref:
+            harm_nums = np.array(inds) / float(self.fund_ind)
+            drivefft_all = drivefft_all * np.exp(-1.0j * harm_nums * self.get_drive_phase())
+
         full_drive_fft = np.zeros(len(freqs), dtype=np.complex128)
         for ind, freq_ind in enumerate(inds):
-            full_drive_fft[freq_ind] = self.drivefft_all[ind] * (1.0 / normfac)
+            full_drive_fft[freq_ind] = drivefft_all[ind] * (1.0 / normfac)
 
         drivevec = np.fft.irfft(full_drive_fft)
 
@@ -961,6 +1339,49 @@ class FileData:
 
 
         
+    def get_store_row(self):
+        '''Reduces the extracted data to a row of an agg_store.AggStore.'''
+        row = {'fname': self.fname, 'p0_bead': np.array(self.p0_bead, dtype=np.float64), \
+               'mtime': getattr(self, 'mtime', np.nan), \
+               'param_hash': getattr(self, 'param_hash', '')}
+        for key in agg_store.scalar_dtypes.keys():
+            row[key] = getattr(self, key)
+        for key in store_array_keys:
+            row[key] = np.asarray(getattr(self, key))
+        return row
+
+
+
+    def load_store_row(self, row, params={}):
+        '''Loads a row of an agg_store.AggStore, as output by get_store_row(),
+           along with the processing parameters common to all rows.
+
+           The object only carries the store columns (see get_store_row())
+           and those parameters. The DataFile is left empty, and anything
+           computed outside of extract_data() and load_position_and_bias(),
+           like aux_data or background_rms, isn't there. Use reload_datafile()
+           to get the raw data back.'''
+        for key in ['tfdate', 'plot_tf', 'step_cal_drive_freq', 'tophatf', \
+                    'new_trap', 'suppress_off_diag']:
+            if key in params:
+                setattr(self, key, params[key])
+
+        self.fname = str(row['fname'])
+        self.p0_bead = list(row['p0_bead'])
+        self.mtime = float(row['mtime'])
+        self.param_hash = str(row['param_hash'])
+        for key in agg_store.scalar_dtypes.keys():
+            setattr(self, key, np.asarray(row[key]).item())
+        for key in store_array_keys:
+            setattr(self, key, row[key])
+
+        self.empty = False
+        self.badfile = False
+        self.data_closed = True
+        self.df = bu.DataFile()
+
+
+
     def save(self, verbose=True):
         parts = self.fname.split('.')
         if len(parts) > 2:
@@ -1021,8 +1442,28 @@ class AggregateData:
                  elec_drive=False, elec_ind=0, maxfreq=2500, noisebins=10,\
                  dim3=False, extract_resonant_freq=False, noiselim=(10.0,100.0), \
                  tfdate='', tf_interp=False, step_cal_drive_freq=41.0, \
-                 new_trap=False, ncore=1, aux_data=[], suppress_off_diag=False):
-        
+                 new_trap=False, ncore=1, aux_data=[], suppress_off_diag=False, \
+                 lazy=False, diag_chunk=2, store_path='', incremental=False, \
+                 stream=False, prefetch=None):
+        '''diag_chunk sets how many files each job loads before diagonalizing
+           them together with bu.diagonalize_many(). Every file of a chunk
+           is held in memory by the job until the chunk is done, so larger
+           chunks trade memory for fewer batched FFTs.
+
+           With a store_path, newly processed files are appended to the 
+           columnar store there (see save_store()). With incremental=True as
+           well, files already in the store with the same modification time
+           and processing parameters are read from the store instead, without
+           opening the raw data, so only new or modified files are processed.
+
+           With stream=True, workers send back only the compact store row of
+           each file, chunks are collected in the order they finish with at
+           most 'prefetch' of them (default 2*ncore) dispatched ahead, and rows
+           are appended to the store as they arrive rather than at the end.
+
+           Files that can't be processed are dropped from self.fnames, and
+           listed with the reason in self.failed_files (and in the store).'''
+
         if new_trap:
             self.new_trap = True
         else:
@@ -1034,6 +1475,16 @@ class AggregateData:
         self.times = np.zeros(len(fnames))
         self.aux_data = aux_data
 
+        ### Hash of everything that changes the extracted data, to know 
+        ### when files in the store need to be processed again
+        process_params = {'tophatf': tophatf, 'harms': list(harms), \
+                          'elec_drive': elec_drive, 'elec_ind': elec_ind, \
+                          'maxfreq': maxfreq, 'noisebins': noisebins, \
+                          'dim3': dim3, 'noiselim': list(noiselim), 'tfdate': tfdate, \
+                          'step_cal_drive_freq': step_cal_drive_freq, \
+                          'new_trap': new_trap, 'suppress_off_diag': suppress_off_diag}
+        param_hash = agg_store.get_param_hash(process_params)
+
         # Nnames = len(self.fnames)
 
         # old_time = time.time()
@@ -1058,46 +1509,193 @@ class AggregateData:
 
 
 
-        def process_file(name):
-
-            # Initialize FileData obj, extract the data, then close the big file
-            new_obj = FileData(name, tophatf=tophatf, tfdate=tfdate, new_trap=new_trap, \
-                                step_cal_drive_freq=step_cal_drive_freq, \
-                                suppress_off_diag=suppress_off_diag)
+        def process_file(new_obj):
+            '''Returns a record for the file: {'fname', 'obj'} if it was
+               processed, or {'fname', 'error'} if it wasn't. With stream=True
+               the object is reduced to its compact store row, {'fname', 'row'}.'''
 
+            name = new_obj.fname
             if new_obj.badfile:
                 print('FOUND BADDIE: ')
                 print(name)
                 #new_obj.load_position_and_bias(dim3=dim3)
-                return
+                return {'fname': name, 'error': 'Bad file'}
 
-            no_drive = [0, 0, 0]
-            for i in range(3):
-                if np.std(new_obj.df.cant_data[i]) > 10.0:
-                    no_drive[i] = 1
-            if not np.sum(no_drive):
-                print('Bad attractor data')
-                return
-                
-            if not reload_dat and not new_obj.badfile:
-                new_obj.load()
-            else:
+            try:
+                no_drive = [0, 0, 0]
+                for i in range(3):
+                    if np.std(new_obj.df.cant_data[i]) > 10.0:
+                        no_drive[i] = 1
+                if not np.sum(no_drive):
+                    print('Bad attractor data')
+                    return {'fname': name, 'error': 'Bad attractor data'}
+                    
                 new_obj.extract_data(harms=harms, noisebins=noisebins, \
                                      plot_harm_extraction=plot_harm_extraction, \
                                      elec_drive=elec_drive, elec_ind=elec_ind, \
                                      maxfreq=maxfreq, noiselim=noiselim)
                 new_obj.load_position_and_bias(dim3=dim3)
+                new_obj.p0_bead = p0_bead
 
                 new_obj.close_datafile()
 
-            new_obj.save(verbose=False)
+                new_obj.mtime = os.stat(name).st_mtime
+                new_obj.param_hash = param_hash
 
-            return new_obj
+                ### Streamed files only send back their store row, so they
+                ### aren't pickled to a .fildat file
+                if stream:
+                    return {'fname': name, 'row': new_obj.get_store_row()}
+
+                new_obj.save(verbose=False)
+                return {'fname': name, 'obj': new_obj}
+
+            except Exception:
+                print("Couldn't process: ", name)
+                return {'fname': name, 'error': traceback.format_exc()}
             #self.file_data_objs.append(new_obj)
 
+
+        def process_chunk(names):
+
+            if not reload_dat:
+                # Skip the raw data entirely and load the previously saved
+                # FileData objects
+                records = []
+                for name in names:
+                    try:
+                        new_obj = FileData(name, empty=True)
+                        new_obj.fname = name
+                        new_obj.load()
+                    except Exception:
+                        print("Couldn't load saved FileData for: ", name)
+                        records.append({'fname': name, 'error': traceback.format_exc()})
+                        continue
+                    if stream:
+                        new_obj.p0_bead = getattr(new_obj, 'p0_bead', p0_bead)
+                        records.append({'fname': name, 'row': new_obj.get_store_row()})
+                    else:
+                        records.append({'fname': name, 'obj': new_obj})
+                return records
+
+            # Initialize FileData objs for a chunk of files, diagonalize them
+            # all together, then extract the data and close the big files
+            new_objs = []
+            records = []
+            for name in names:
+                try:
+                    new_objs.append(FileData(name, tophatf=tophatf, tfdate=tfdate, \
+                                             new_trap=new_trap, \
+                                             step_cal_drive_freq=step_cal_drive_freq, \
+                                             suppress_off_diag=suppress_off_diag, \
+                                             lazy=lazy, diagonalize=False))
+                except Exception:
+                    print("Couldn't load: ", name)
+                    records.append({'fname': name, 'error': traceback.format_exc()})
+
+            try:
+                bu.diagonalize_many([obj.df for obj in new_objs if not obj.badfile], \
+                                    date=tfdate, maxfreq=tophatf, \
+                                    step_cal_drive_freq=step_cal_drive_freq, \
+                                    suppress_off_diag=suppress_off_diag, \
+                                    chunk_size=diag_chunk)
+            except Exception:
+                error = traceback.format_exc()
+                return records + [{'fname': obj.fname, 'error': error} for obj in new_objs]
+
+            return records + [process_file(new_obj) for new_obj in new_objs]
+
         if len(self.fnames):
-            file_data_objs = Parallel(n_jobs=ncore)(delayed(process_file)(name) \
-                                                      for name in tqdm(self.fnames))
+            ### Find the files that are already in the store and up to date
+            store = agg_store.AggStore(agg_store.get_store_path(store_path)) \
+                        if len(store_path) else None
+            stored_objs = {}
+            if incremental and (store is not None):
+                stored_inds = store.find_up_to_date(self.fnames, param_hash)
+                store_params = store.get_params()
+                for name, row in zip(stored_inds.keys(), \
+                                     store.read_rows(list(stored_inds.values()))):
+                    stored_objs[name] = FileData('', empty=True)
+                    stored_objs[name].load_store_row(row, params=store_params)
+                print('Found {:d} of {:d} files up to date in the store'\
+                            .format(len(stored_objs), len(self.fnames)))
+
+            ### Same as get_store_params(), known before any file is processed
+            row_params = {'p0_bead': [float(p) for p in self.p0_bead], \
+                          'new_trap': bool(self.new_trap), 'tfdate': tfdate, \
+                          'plot_tf': False, 'tophatf': tophatf, \
+                          'step_cal_drive_freq': step_cal_drive_freq, \
+                          'suppress_off_diag': suppress_off_diag}
+
+            new_names = [name for name in self.fnames if name not in stored_objs]
+            chunks = [new_names[i:i+diag_chunk] \
+                        for i in range(0, len(new_names), diag_chunk)]
+
+            new_objs = {}
+            failures = []
+            if stream:
+                ### Chunks are returned as they finish, with at most 'prefetch'
+                ### of them dispatched ahead, and written to the store right away
+                if prefetch is None:
+                    prefetch = 2 * max(ncore, 1)
+                ### joblib < 1.4 has no 'generator_unordered', and < 1.3 can't
+                ### return a generator at all, in which case the chunks are
+                ### only written to the store once they're all done
+                for return_as in ['generator_unordered', 'generator', None]:
+                    try:
+                        if return_as is None:
+                            parallel = Parallel(n_jobs=ncore, pre_dispatch=prefetch)
+                        else:
+                            parallel = Parallel(n_jobs=ncore, return_as=return_as, \
+                                                pre_dispatch=prefetch)
+                        break
+                    except (TypeError, ValueError):
+                        continue
+                results = parallel(delayed(process_chunk)(names) for names in chunks)
+                row_buffer = []
+                for records in tqdm(results, total=len(chunks)):
+                    for record in records:
+                        if 'error' in record:
+                            failures.append(record)
+                            continue
+                        new_obj = FileData('', empty=True)
+                        new_obj.load_store_row(record['row'], params=row_params)
+                        new_objs[record['fname']] = new_obj
+                        row_buffer.append(record['row'])
+
+                    if (store is not None) and (len(row_buffer) >= agg_store.row_chunk):
+                        store.append(row_buffer, params=row_params)
+                        row_buffer = []
+
+                if (store is not None) and len(row_buffer):
+                    store.append(row_buffer, params=row_params)
+
+            else:
+                chunk_records = Parallel(n_jobs=ncore)(delayed(process_chunk)(names) \
+                                                        for names in tqdm(chunks))
+                for records in chunk_records:
+                    for record in records:
+                        if 'error' in record:
+                            failures.append(record)
+                        else:
+                            new_objs[record['fname']] = record['obj']
+
+            if (store is not None) and len(failures):
+                store.append_failures(failures, param_hash=param_hash)
+
+            ### Files that couldn't be processed are dropped, and kept track
+            ### of in self.failed_files
+            self.failed_files = failures
+            if len(failures):
+                print('{:d} of {:d} files could not be processed'\
+                            .format(len(failures), len(self.fnames)))
+
+            self.fnames = [name for name in self.fnames \
+                            if (name in stored_objs) or (name in new_objs)]
+            self.times = np.zeros(len(self.fnames))
+
+            file_data_objs = [stored_objs[name] if name in stored_objs \
+                                else new_objs[name] for name in self.fnames]
             self.file_data_objs = file_data_objs
 
             for ind, obj in enumerate(self.file_data_objs):
@@ -1114,8 +1712,16 @@ class AggregateData:
                 except Exception:
                     file_aux_data = []
 
-            self.times0 = self.times - self.times[0]
+            self.times0 = self.times - self.times[0] if len(self.times) else []
+
+            if (store is not None) and not stream:
+                good_objs = [new_objs[name] for name in new_names if name in new_objs]
+                for start in range(0, len(good_objs), agg_store.row_chunk):
+                    store.append([obj.get_store_row() for obj in \
+                                    good_objs[start:start+agg_store.row_chunk]], \
+                                 params=row_params)
         else:
+            self.failed_files = []
             self.times0 = []
 
         self.alpha_dict = ''
@@ -1127,7 +1733,9 @@ class AggregateData:
         self.gfuncs_class = GravFuncs('', load=False)
 
 
-    def save(self, savepath, verbose=True):
+    def save(self, savepath, verbose=True, template_bank=False):
+        '''Pickles the object to a .agg file. The template bank isn't part of
+           the pickle, but with template_bank=True it's saved next to it.'''
         parts = savepath.split('.')
         if len(parts) > 2:
             print("Bad file name... too many periods/extensions")
@@ -1142,12 +1750,27 @@ class AggregateData:
                 savepath = parts[0] + '.agg'
             sys.stdout.flush()
             self.gfuncs_class.clear_grav_funcs()
+            bank = getattr(self.gfuncs_class, 'template_bank', {})
+            self.gfuncs_class.template_bank = {}
             pickle.dump(self, open(savepath, 'wb'))
+            self.gfuncs_class.template_bank = bank
             self.gfuncs_class.reload_grav_funcs()
             if verbose:
                 print('Done!')
                 print('Saved to: ', savepath)
                 sys.stdout.flush()
+            if template_bank:
+                self.save_template_bank(parts[0] + '.tbank', verbose=verbose)
+
+
+    def save_template_bank(self, savepath, verbose=True):
+        if verbose:
+            print('Saving template bank...', end=' ')
+            sys.stdout.flush()
+        bank = getattr(self.gfuncs_class, 'template_bank', {})
+        pickle.dump( bank, open(savepath, 'wb') )
+        if verbose:
+            print('Done!')
 
 
     def save_alpha_dict(self, savepath, verbose=True):
@@ -1172,7 +1795,7 @@ class AggregateData:
             print('Done!')
 
 
-    def load(self, loadpath):
+    def load(self, loadpath, template_bank=False):
 
         new_p0 = self.p0_bead
 
@@ -1192,6 +1815,118 @@ class AggregateData:
 
             print('Done!')
 
+            bank_path = parts[0] + '.tbank'
+            if template_bank and os.path.exists(bank_path):
+                self.load_template_bank(bank_path)
+
+
+    def load_template_bank(self, loadpath, verbose=True):
+        '''Adds the templates saved in a .tbank file to the template bank.
+           Keys include the theory data directory, so templates for other
+           theory data are just never used.'''
+        if verbose:
+            print('Loading template bank...', end=' ')
+            sys.stdout.flush()
+        if not hasattr(self.gfuncs_class, 'template_bank'):
+            self.gfuncs_class.template_bank = {}
+        self.gfuncs_class.template_bank.update( pickle.load( open(loadpath, 'rb') ) )
+        if verbose:
+            print('Done!')
+
+
+    def get_store_params(self):
+        '''Parameters common to every file, kept in the columnar store.'''
+        params = {'p0_bead': [float(p) for p in self.p0_bead], \
+                  'new_trap': bool(self.new_trap)}
+        for obj in self.file_data_objs:
+            if obj is None:
+                continue
+            for key in ['tfdate', 'plot_tf', 'step_cal_drive_freq', 'tophatf', \
+                        'new_trap', 'suppress_off_diag']:
+                params[key] = getattr(obj, key)
+            break
+        return params
+
+
+
+    def save_store(self, savepath, append=False, verbose=True):
+        '''Saves the extracted data of every file to a columnar store
+           (see agg_store.AggStore) instead of pickling everything. With
+           append=True, only files not yet in the store are added to it,
+           otherwise the store is rewritten.
+
+           INPUTS: savepath, path of the store. A .agg extension is 
+                             swapped for agg_store.store_ext'''
+
+        savepath = agg_store.get_store_path(savepath)
+        store = agg_store.AggStore(savepath)
+        if not append:
+            store.clear()
+
+        done = set(store.get_table(keys=['fname']).get('fname', []))
+        objs = [obj for obj in self.file_data_objs \
+                    if (obj is not None) and (obj.fname not in done)]
+
+        if verbose:
+            print('Saving {:d} files to store... '.format(len(objs)), end=' ')
+            sys.stdout.flush()
+
+        ### Write in blocks of rows to keep the memory footprint small
+        params = self.get_store_params()
+        for start in range(0, len(objs), agg_store.row_chunk):
+            rows = [obj.get_store_row() for obj in objs[start:start+agg_store.row_chunk]]
+            store.append(rows, params=params)
+
+        if verbose:
+            print('Done!')
+            print('Saved to: ', savepath)
+            sys.stdout.flush()
+
+
+
+    def load_store(self, loadpath, time_range=None, positions=(None,None,None), \
+                   pos_tol=0.5, bias=None, bias_tol=1e-3, verbose=True):
+        '''Loads the files of a columnar store, optionally only those in a
+           time range and/or at given attractor positions and bias (see 
+           agg_store.AggStore.select()). Only the selected rows are read.
+           Raises IOError if there's no store for loadpath.'''
+
+        store = agg_store.AggStore(agg_store.get_store_path(loadpath))
+        if not store.exists():
+            raise IOError('No columnar store for {:s} (expected {:s})'\
+                                .format(loadpath, store.path))
+
+        inds = store.select(time_range=time_range, positions=positions, \
+                            pos_tol=pos_tol, bias=bias, bias_tol=bias_tol)
+        if verbose:
+            print('Loading {:d} of {:d} files from store... '\
+                        .format(len(inds), store.nrows()), end=' ')
+            sys.stdout.flush()
+
+        params = store.get_params()
+
+        file_data_objs = []
+        for start in range(0, len(inds), agg_store.row_chunk):
+            for row in store.read_rows(inds[start:start+agg_store.row_chunk]):
+                obj = FileData('', empty=True)
+                obj.load_store_row(row, params=params)
+                file_data_objs.append(obj)
+
+        if 'new_trap' in params:
+            self.new_trap = params['new_trap']
+
+        self.file_data_objs = file_data_objs
+        self.fnames = [obj.fname for obj in file_data_objs]
+        self.times = np.array([obj.time for obj in file_data_objs], dtype=np.float64)
+        if len(self.times):
+            self.times0 = self.times - self.times[0]
+        else:
+            self.times0 = []
+
+        if verbose:
+            print('Done!')
+
+
 
     def load_alpha_dict(self, loadpath, verbose=True):
         if verbose:
@@ -1217,20 +1952,49 @@ class AggregateData:
 
             
     def load_grav_funcs(self, theory_data_dir, verbose=True):
+        bank = getattr(getattr(self, 'gfuncs_class', None), 'template_bank', {})
         self.gfuncs_class = GravFuncs(theory_data_dir, verbose=verbose)
+        self.gfuncs_class.template_bank = bank
 
 
 
 
-    def bin_rough_stage_positions(self, ax_disc=0.5, dim3=False):
+    def bin_rough_stage_positions(self, ax_disc=0.5, dim3=False, use_attrib_index=False):
         '''Loops over the preprocessed file_data_objs and organizes them by rough stage position,
            discretizing the rough stage position by a user-controlled parameter. Unfortunately,
            because the final object is a nested dictionary, it's somewhat cumbersome to put this
            into any subroutines.
+
+           With use_attrib_index, the positions and bias come from the DC stage settings
+           and electrode settings in the attribute index (see attrib_index.py), rather than
+           the mean of the stage monitor, so no sample data is needed. They're only
+           used for binning, the measured values of the FileData objects are left as
+           they are. Files missing from the index (NaN) are binned with their 
+           measured values.
         '''
         
         print('Sorting data by rough stage position...', end=' ')
 
+        ### (bias, ax0pos, ax1pos, ax2pos) used to bin each file
+        bin_vals = [[file_data_obj.cantbias, file_data_obj.ax0pos, \
+                     file_data_obj.ax1pos, file_data_obj.ax2pos] \
+                        for file_data_obj in self.file_data_objs]
+
+        if use_attrib_index:
+            if dim3:
+                ax_inds = [0, 1, 2]
+            else:
+                ax_inds = [0, 2, 1]
+            fnames = [file_data_obj.fname for file_data_obj in self.file_data_objs]
+            index_pos, index_bias = \
+                    attrib_index.get_stage_positions(fnames, new_trap=self.new_trap)
+            for objind in range(len(self.file_data_objs)):
+                index_vals = [index_bias[objind]] \
+                    + [round(index_pos[ax_ind,objind], 1) for ax_ind in ax_inds]
+                for ind, val in enumerate(index_vals):
+                    if not np.isnan(val):
+                        bin_vals[objind][ind] = val
+
         agg_dict = {}
 
         biasvec = []
@@ -1243,15 +2007,11 @@ class AggregateData:
             ax2vec = []
             Nax2 = {}
 
-        for file_data_obj in self.file_data_objs:
+        for file_data_obj, (bias, ax0pos, ax1pos, ax2pos) \
+                in zip(self.file_data_objs, bin_vals):
             if type(self.ginds) == str:
                 self.ginds = file_data_obj.ginds
 
-            bias = file_data_obj.cantbias
-            ax0pos = file_data_obj.ax0pos
-            ax1pos = file_data_obj.ax1pos
-            ax2pos = file_data_obj.ax2pos
-
             if bias not in list(agg_dict.keys()):
                 agg_dict[bias] = {}
                 biasvec.append(bias)
@@ -1703,7 +2463,15 @@ class AggregateData:
     def find_alpha_xyz_from_templates(self, plot=False, plot_basis=False, ncore=1, \
                                         alpha_scale=1e8, add_fake_data=False, \
                                         fake_alpha=1e13, plot_bad_alphas=False, \
-                                        plot_templates=False, n_largest_harms=100):
+                                        plot_templates=False, n_largest_harms=100, \
+                                        use_template_bank=False, drive_tol=0.1):
+        '''Fits the amplitude of the Yukawa templates to the data of every file.
+           With use_template_bank, templates are computed once for all files
+           at a given position with matching drives (see GravFuncs.get_template_key()
+           and drive_tol [um]) and kept in self.gfuncs_class.template_bank,
+           rather than for every file. Files whose drive mean and amplitude
+           differ by less than drive_tol then share templates, which is an
+           approximation, so the bank is off by default.'''
 
         print('Finding alpha for each coordinate via an FFT template fitting algorithm...')
         
@@ -1748,20 +2516,30 @@ class AggregateData:
 
             new_trap = self.new_trap
 
-            gfunc_list = []
-            for i in range(nobjs):
-                gfunc_new = GravFuncs('', load=False)
-                gfunc_new.__dict__.update(self.gfuncs_class.__dict__)
-                gfunc_list.append(gfunc_new)
+            ### Either fill the template bank, then hand each file the entry for
+            ### its key, or give each file its own copy of the gravity funcs
+            if use_template_bank:
+                keys = self.gfuncs_class.fill_template_bank(file_data_objs, ax0, ax1, \
+                                                    n_largest_harms=n_largest_harms, \
+                                                    drive_tol=drive_tol, new_trap=new_trap, \
+                                                    plot=plot_templates, ncore=ncore)
+                template_list = [self.gfuncs_class.template_bank[key] for key in keys]
+            else:
+                template_list = []
+                for i in range(nobjs):
+                    gfunc_new = GravFuncs('', load=False)
+                    gfunc_new.__dict__.update(self.gfuncs_class.__dict__)
+                    gfunc_new.template_bank = {}
+                    template_list.append(gfunc_new)
 
-            arg_list = list(zip(file_data_objs, gfunc_list))
+            arg_list = list(zip(file_data_objs, template_list))
 
             # j = 0
             # totlen_2 = len(file_data_objs) * len(self.lambdas)
             # for objind, obj in enumerate(file_data_objs):
             def process_file_data(arg):  #obj):
                 # file_start = time.time()
-                obj, gfunc = arg
+                obj, gfunc_or_entry = arg
 
                 p0_bead_new = obj.p0_bead
 
@@ -1780,25 +2558,23 @@ class AggregateData:
                 out_arr = np.zeros((nlambda, n_err + 1, 3, ncomponents))
                 out_arr_2 = np.zeros((nlambda, 2, 3))
 
-                ## Loop over lambdas and do the template analysis for each value of lambda
-                for lambind, yuklambda in enumerate(gfunc.lambdas):
-    
-                    out_subarr = np.zeros((n_err + 1, 3, ncomponents))
-                    out_subarr_2 = np.zeros((2, 3))
-                            
-                    # start = time.time()
-                    templates = gfunc.make_templates(posvec, drivevec, ax0, ax1, \
+                ### Stack the template, data and error vectors for every lambda
+                ### and response axis, so they can be projected all at once
+                ncomp = 0
+                template_vecs = []
+                proj_vecs = []
+
+                if use_template_bank:
+                    templates = GravFuncs.rotate_bank_templates(gfunc_or_entry, obj)
+                else:
+                    templates = gfunc_or_entry.make_templates(posvec, drivevec, ax0, ax1, \
                                                         obj.ginds, p0_bead_new, obj.fsamp, \
-                                                        single_lambda=True, \
-                                                        single_lambind=lambind, \
                                                         new_trap=new_trap, \
                                                         plot=plot_templates, \
                                                         n_largest_harms=n_largest_harms)
-                    # stop = time.time()
-                    # print('Template time : {:0.4f}'.format(stop - start))
 
-                    if plot and lambind == 0:
-                        fig, axarr = plt.subplots(3,1,sharex=True,sharey=False,figsize=(10,8))
+                ## Loop over lambdas and stack the templates for each value of lambda
+                for lambind in range(nlambda):
 
                     for resp in [0,1,2]:
 
@@ -1808,7 +2584,6 @@ class AggregateData:
                         erryukbool = yukbool.repeat(n_err, axis=0)
 
                         template_vec = np.concatenate((yukfft.real, yukfft.imag))
-                        # print(template_vec)
 
                         c_datfft = datfft[resp][yukbool] #
                         if add_fake_data:
@@ -1818,96 +2593,45 @@ class AggregateData:
                         c_daterr = daterr[resp][erryukbool]
                         err_vec = np.concatenate((c_daterr.real, c_daterr.imag))
 
-                        alphaguess = np.inner(data_vec, template_vec) / \
-                                                np.inner(template_vec, template_vec)
-                        alphaguess /= alpha_scale
-
-                        # def alphacost(alpha, err_ind=0):
-                        #     ndof = ncomponents - 1
-                        #     num = (data_vec - alpha*alpha_scale*template_vec)**2
-                        #     denom = (err_vec[err_ind::n_err])**2
-                        #     return (1.0 / ndof) * np.sum(num / denom)
-
-                        # vals = []
-                        # for err_ind in range(n_err):
-                        #     fitcost = lambda alpha: alphacost(alpha, err_ind=err_ind)
-
-                        #     m = Minuit(fitcost,
-                        #                alpha = alphaguess, # set start parameter
-                        #                #fix_param = "True", # you can also fix it
-                        #                # limit_param = (0.0, 10000.0),
-                        #                errordef = 1,
-                        #                print_level = 0, 
-                        #                pedantic=False)
-                        #     m.migrad(ncall=500000)
-                        #     # m.draw_mnprofile('alpha')
-                        #     # plt.show()
-                        #     vals.append(m.values['alpha'])
-
-                        # out_subarr_2[0,resp] = np.mean(vals)
-                        # out_subarr_2[1,resp] = np.std(vals)
-                        # out_subarr_2[:,resp] *= alpha_scale
-                        # minos = m.minos()
-
-                        ### Compute an 2*Nharmonic-dimensional basis for the real and 
-                        ### imaginary components of our template signal yukfft, where
-                        ### the template itself will be one of the orthogonal basis vectors
-                        bases = make_basis_from_template_vec(template_vec)
-
-                        ### The SVD decomposition above should produce an orthonormal basis
-                        ### but this function is included to demonstrate that
-                        # ortho_basis = gram_schmidt(bases['real_basis'], plot=plot_basis)['orthogonal']
-                        ortho_basis = bases['real_basis']
-
-                        # if resp == 2:
-                        #     print(gfunc.lambdas[lambind])
-                        #     print('Template : ', template_vec)
-                        #     print('   Ortho : ', ortho_basis[0])
-                        #     print('    Data : ', data_vec)
-                        #     input()
-
-                        ### Loop over our orthogonal basis vectors and compute the inner 
-                        ### product of the data and the basis vector
-                        for k in range(len(ortho_basis)):
-                            out_subarr[0][resp][k] = np.inner( ortho_basis[k], data_vec)
-                            for err_ind in range(n_err):
-                                out_subarr[err_ind+1][resp][k] = \
-                                        np.inner( ortho_basis[k], err_vec[err_ind::n_err])
-
-                        ### Normalize the projection amplitudes to units of alpha
-                        template_norm = np.inner(template_vec, template_vec)
-                        # if resp == 2:
-                        #     projection = out_subarr[0][resp][0] / template_norm
-                        #     print('Projection : ', projection, np.log10(np.abs(projection)))
-                        #     input()
-
-                        out_subarr[:,resp,:] *= (1.0 / template_norm)
-                        alphaz = out_subarr[0,2,0]
-                        if plot_bad_alphas:
-                            if resp == 2 and lambind == 0:
-                                if np.abs(alphaz) > 10.0**10:
-                                    obj.reload_datafile()
-                                    print('bad file: {:s}'.format(obj.fname))
-                                    fig, axarr = plt.subplots(3,1, sharex=True)
-                                    for i in range(3):
-                                        axarr[i].plot(obj.df.pos_data_3[i] - np.mean(obj.df.pos_data_3[i]))
-                                    plt.show()
-
-
-                        if plot and lambind == 0:
-                            axarr[resp].errorbar(list(range(len(out_subarr[0][resp]))), \
-                                                 out_subarr[0][resp], \
-                                                 np.abs(np.mean(out_subarr[1:,resp,:], axis=0)), \
-                                                 fmt='o')
-                            axarr[resp].set_ylabel('Projection [$\\alpha$]')
-                            if resp == 2:
-                                axarr[resp].set_xlabel('Basis Vector Index')
-
-                    if plot and lambind == 0:
+                        ### Rows are the data, then err_vec[err_ind::n_err] 
+                        ### for each of the n_err noise estimates
+                        ncomp = len(template_vec)
+                        template_vecs.append(template_vec)
+                        proj_vecs.append( np.concatenate(([data_vec], \
+                                                err_vec.reshape(ncomp, n_err).T)) )
+
+                ### The template is the first vector of an orthogonal basis 
+                ### (see make_basis_from_template_vec()), so the projection of
+                ### the data onto the first basis vector is the best-fit alpha and
+                ### the rest are noise. All lambdas and axes are projected with a
+                ### single batched computation, normalized to units of alpha
+                template_vecs = np.array(template_vecs).reshape(nlambda, 3, ncomp)
+                proj_vecs = np.array(proj_vecs).reshape(nlambda, 3, n_err+1, ncomp)
+                projections = project_onto_template_basis(template_vecs, proj_vecs)
+
+                out_arr[:,:,:,:ncomp] += projections.transpose(0,2,1,3)
+
+                if plot_bad_alphas:
+                    alphaz = out_arr[0,0,2,0]
+                    if np.abs(alphaz) > 10.0**10:
+                        obj.reload_datafile()
+                        print('bad file: {:s}'.format(obj.fname))
+                        fig, axarr = plt.subplots(3,1, sharex=True)
+                        for i in range(3):
+                            axarr[i].plot(obj.df.pos_data_3[i] - np.mean(obj.df.pos_data_3[i]))
                         plt.show()
 
-                    out_arr[lambind] += out_subarr
-                    out_arr_2[lambind] += out_subarr_2
+                if plot:
+                    fig, axarr = plt.subplots(3,1,sharex=True,sharey=False,figsize=(10,8))
+                    for resp in [0,1,2]:
+                        axarr[resp].errorbar(list(range(len(out_arr[0,0,resp]))), \
+                                             out_arr[0,0,resp], \
+                                             np.abs(np.mean(out_arr[0,1:,resp,:], axis=0)), \
+                                             fmt='o')
+                        axarr[resp].set_ylabel('Projection [$\\alpha$]')
+                        if resp == 2:
+                            axarr[resp].set_xlabel('Basis Vector Index')
+                    plt.show()
 
                 return (out_arr, out_arr_2)
 
@@ -2527,11 +3251,11 @@ class AggregateData:
                     ### corresponding to the requested confidence level
                     popt, pcov = opti.curve_fit(parabola, mu_dat_arr, chi_sq, \
                                                 p0=[np.max(chi_sq)/np.max(mu_dat_arr)**2, 0, 0])
-                    soln = solve_parabola(chi2dist.ppf(confidence_level), popt)
+                    soln = solve_parabola(stats.chi2(1).ppf(confidence_level), popt)
 
                     popt_null, pcov_null = opti.curve_fit(parabola, mu_null_arr, chi_sq_sideband, \
                                                 p0=[np.max(chi_sq_sideband)/np.max(mu_null_arr)**2, 0, 0])
-                    soln_null = solve_parabola(chi2dist.ppf(confidence_level), popt_null)
+                    soln_null = solve_parabola(stats.chi2(1).ppf(confidence_level), popt_null)
 
                     ### "Best fit" is like the sensitivity (should be consistent with 0
                     ### if we understand backgrounds)
@@ -3079,6 +3803,8 @@ class AggregateData:
                           linewidth=2, label='95% CL on $\\hat{\\alpha}_{\\rm ob}$', color='C1')
 
 
+        limitdata = get_limit_data(limitdata_path)
+        limitdata2 = get_limit_data(limitdata_path2)
         ax.loglog(limitdata[:,0], limitdata[:,1], '--', label=limitlab, linewidth=3, color='r')
         ax.loglog(limitdata2[:,0], limitdata2[:,1], '--', label=limitlab2, linewidth=3, color='k')
         ax.grid()
@@ -3,21 +3,22 @@
 #of the picomotors from images.
 ###############################################################################
 import numpy as np
-import matplotlib.pyplot as plt
-from scipy import signal
+import scipy
+from lazy_import import lazy_module, lazy_callable
+plt = lazy_module('matplotlib.pyplot')
+signal = lazy_module('scipy.signal')
 import bead_util as bu
 import bead_util_funcs as buf
 import os
 import configuration
 import glob
 import re
-import peakdetect as pdet
-from scipy.optimize import curve_fit
-import scipy.stats
+pdet = lazy_module('peakdetect')
+curve_fit = lazy_callable('scipy.optimize', 'curve_fit')
 import beam_profile as bf
-import scipy.ndimage.filters as ndf
-import cv2
-from scipy.signal import argrelextrema
+ndf = lazy_module('scipy.ndimage.filters')
+cv2 = lazy_module('cv2')
+argrelextrema = lazy_callable('scipy.signal', 'argrelextrema')
 #Functions for use in the class representing image data.
 
 b, a = signal.butter(4, [.005, .5], btype = 'bandpass')
@@ -0,0 +1,83 @@
+####Script guarding the cold-start cost of the analysis modules
+import os, sys, json, subprocess
+
+#######################################################
+# Every script, and every joblib worker, starts with a
+# fresh interpreter that imports the analysis modules
+# before doing anything. This times that import in a
+# clean subprocess (a few times, keeping the fastest)
+# and checks that the heavy dependencies are still
+# deferred until they're used (see lazy_import).
+#
+# Exits with a non-zero status if a module goes over
+# its budget or pulls in a deferred dependency, so it
+# can be run before committing changes to the imports:
+#
+#     python lib/import_time_check.py
+#######################################################
+
+
+### Budgets [s] for importing each module in a fresh interpreter, excluding
+### the interpreter's own startup. Most of what's left is numpy and h5py
+budgets = {'bead_util': 0.5, \
+           'calib_util': 0.6, \
+           'grav_util_3': 0.6}
+
+### Modules that importing any of the above shouldn't load
+deferred = ['matplotlib', 'scipy.interpolate', 'scipy.optimize', \
+            'scipy.signal', 'scipy.stats', 'scipy.constants', 'sklearn', \
+            'pandas', 'joblib', 'tqdm', 'iminuit', 'cv2', 'obspy']
+
+ntrial = 5
+
+lib_path = os.path.abspath( os.path.dirname(__file__) )
+
+
+child_code = '''
+import sys, time, json
+sys.path.insert(0, {lib_path!r})
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+loaded = [name for name in {deferred!r} if name in sys.modules]
+print(json.dumps({{'time': elapsed, 'loaded': loaded}}))
+'''
+
+
+def time_import(module):
+    '''Imports module in a fresh interpreter and returns the time it took
+       and the list of deferred modules that ended up loaded.'''
+    code = child_code.format(lib_path=lib_path, module=module, deferred=deferred)
+    out = subprocess.run([sys.executable, '-c', code], capture_output=True, \
+                         text=True, check=True)
+    result = json.loads(out.stdout.strip().split('\n')[-1])
+    return result['time'], result['loaded']
+
+
+
+if __name__ == '__main__':
+    failed = False
+    for module, budget in budgets.items():
+        try:
+            results = [time_import(module) for i in range(ntrial)]
+        except subprocess.CalledProcessError as err:
+            print('{:s}: import failed'.format(module))
+            print(err.stderr)
+            failed = True
+            continue
+
+        best = min(result[0] for result in results)
+        loaded = sorted(set(sum([result[1] for result in results], [])))
+
+        status = 'ok'
+        if best > budget:
+            status = 'OVER BUDGET'
+            failed = True
+        if len(loaded):
+            status = 'LOADED ' + ', '.join(loaded)
+            failed = True
+
+        print('{:s}: {:0.3f} s (budget {:0.3f} s)  {:s}'\
+                .format(module, best, budget, status))
+
+    sys.exit(1 if failed else 0)
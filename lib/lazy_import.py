@@ -0,0 +1,201 @@
+import sys, types, importlib, importlib.abc
+
+#######################################################
+# This module defers the import of heavy dependencies
+# (matplotlib, most of scipy, joblib, sklearn, ...)
+# until they're actually used. Importing bead_util and
+# friends used to pull all of them in, so every script
+# and every joblib worker paid a second or more of
+# imports, even when it only needed to load data.
+#
+# A module proxy is a stand-in that imports the real
+# module on first attribute access and forwards to it:
+#
+#     plt = lazy_module('matplotlib.pyplot')
+#     ...
+#     plt.figure()      # matplotlib is imported here
+#
+# and a callable proxy does the same for a single name
+# that's only ever called, like joblib's Parallel.
+#
+# Setup that used to run at import (e.g. plot styles)
+# can be registered with when_imported(), so it runs
+# whenever the module ends up imported, by anyone.
+#######################################################
+
+
+
+class LazyModule(types.ModuleType):
+    '''Proxy for a module that's imported on first attribute access.
+       An optional on_load function is called with the real module
+       right after it's imported by this proxy.'''
+
+    def __init__(self, name, on_load=None):
+        super().__init__(name)
+        self.__dict__['_lazy_name'] = name
+        self.__dict__['_lazy_module'] = None
+        self.__dict__['_lazy_on_load'] = on_load
+
+
+    def _load(self):
+        module = self.__dict__['_lazy_module']
+        if module is None:
+            module = importlib.import_module(self.__dict__['_lazy_name'])
+            self.__dict__['_lazy_module'] = module
+            on_load = self.__dict__['_lazy_on_load']
+            if on_load is not None:
+                on_load(module)
+        return module
+
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+
+    def __setattr__(self, attr, val):
+        setattr(self._load(), attr, val)
+
+
+    def __dir__(self):
+        return dir(self._load())
+
+
+    def __repr__(self):
+        if self.__dict__['_lazy_module'] is None:
+            return "<lazy module '{:s}' (not loaded)>".format(self.__dict__['_lazy_name'])
+        return repr(self.__dict__['_lazy_module'])
+
+
+    def __reduce__(self):
+        return (lazy_module, (self.__dict__['_lazy_name'],))
+
+
+
+
+class LazyCallable:
+    '''Proxy for a function or class that's imported from its module
+       the first time it's called (or one of its attributes is used).'''
+
+    def __init__(self, module_name, name):
+        self._lazy_module_name = module_name
+        self._lazy_name = name
+        self._lazy_obj = None
+
+
+    def _load(self):
+        if self._lazy_obj is None:
+            module = importlib.import_module(self._lazy_module_name)
+            self._lazy_obj = getattr(module, self._lazy_name)
+        return self._lazy_obj
+
+
+    def __call__(self, *args, **kwargs):
+        return self._load()(*args, **kwargs)
+
+
+    def __getattr__(self, attr):
+        if attr.startswith('_lazy_'):
+            raise AttributeError(attr)
+        return getattr(self._load(), attr)
+
+
+    def __reduce__(self):
+        return (lazy_callable, (self._lazy_module_name, self._lazy_name))
+
+
+
+
+def lazy_module(name, on_load=None):
+    '''Returns the module itself if it's already been imported, otherwise
+       a proxy that imports it on first use.
+
+       INPUTS: name, full name of the module, e.g. 'scipy.signal'
+               on_load, optional function called with the module when
+                        the proxy imports it
+
+       OUTPUTS: module, the module or its proxy'''
+
+    if name in sys.modules:
+        module = sys.modules[name]
+        if on_load is not None:
+            on_load(module)
+        return module
+    return LazyModule(name, on_load=on_load)
+
+
+
+def lazy_callable(module_name, name):
+    '''Returns module_name.name if the module has already been imported,
+       otherwise a proxy that imports it on the first call.'''
+    if module_name in sys.modules:
+        return getattr(sys.modules[module_name], name)
+    return LazyCallable(module_name, name)
+
+
+
+
+### Functions to call when a module is imported, keyed by module name
+import_callbacks = {}
+
+
+
+class CallbackLoader(importlib.abc.Loader):
+    '''Wraps the loader of a module to call the functions registered with
+       when_imported() once the module has been executed.'''
+
+    def __init__(self, loader):
+        self.loader = loader
+
+
+    def create_module(self, spec):
+        return self.loader.create_module(spec)
+
+
+    def exec_module(self, module):
+        self.loader.exec_module(module)
+        for func in import_callbacks.pop(module.__name__, []):
+            func(module)
+
+
+    def __getattr__(self, attr):
+        return getattr(self.loader, attr)
+
+
+
+
+class CallbackFinder(importlib.abc.MetaPathFinder):
+    '''Import hook that only acts on modules with registered callbacks,
+       finding them with the other finders and wrapping their loader.'''
+
+    def find_spec(self, fullname, path, target=None):
+        if fullname not in import_callbacks:
+            return None
+        for finder in sys.meta_path:
+            if (finder is self) or not hasattr(finder, 'find_spec'):
+                continue
+            spec = finder.find_spec(fullname, path, target)
+            if spec is not None:
+                if spec.loader is not None:
+                    spec.loader = CallbackLoader(spec.loader)
+                return spec
+        return None
+
+
+callback_finder = CallbackFinder()
+
+
+
+def when_imported(name, func):
+    '''Calls func with the module right away if it's already been 
+       imported, otherwise as soon as it's imported, by any code, without
+       importing it here.
+
+       INPUTS: name, full name of the module, e.g. 'matplotlib.pyplot'
+               func, function called with the module'''
+
+    if name in sys.modules:
+        func(sys.modules[name])
+        return
+    import_callbacks.setdefault(name, []).append(func)
+    if callback_finder not in sys.meta_path:
+        sys.meta_path.insert(0, callback_finder)
@@ -2,14 +2,16 @@ import os, re, time, sys, inspect, traceback
 import numpy as np
 import dill as pickle 
 
-import matplotlib.pyplot as plt
-import matplotlib.cm as cmx
-import matplotlib.colors as colors
-import matplotlib.mlab as mlab
-
-import scipy.interpolate as interp
-import scipy.optimize as optimize
-import scipy.signal as signal
+from lazy_import import lazy_module
+
+plt = lazy_module('matplotlib.pyplot')
+cmx = lazy_module('matplotlib.cm')
+colors = lazy_module('matplotlib.colors')
+mlab = lazy_module('matplotlib.mlab')
+
+interp = lazy_module('scipy.interpolate')
+optimize = lazy_module('scipy.optimize')
+signal = lazy_module('scipy.signal')
 import scipy
 
 
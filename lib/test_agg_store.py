@@ -0,0 +1,120 @@
+####Tests of streaming AggregateData ingest into the columnar store
+import os, sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.abspath( os.path.dirname(__file__) ))
+
+import bead_util as bu
+import grav_util_3 as gu
+import agg_store
+
+#######################################################
+# The raw data loading and the harmonic extraction are
+# replaced by synthetic data, so the tests only cover
+# what AggregateData does with the processed files:
+# building the store rows in the workers, collecting
+# them and appending them to the store.
+#
+#     python -m pytest lib/test_agg_store.py
+#######################################################
+
+
+nsamp = 1000
+fsamp = 5000.0
+ngind = 4
+
+
+def fake_load(self, fname, *args, **kwargs):
+    self.fname = fname
+    self.time = 1000000000 + len(fname)
+    self.fsamp = fsamp
+    self.nsamp = nsamp
+    self.cant_data = np.array([np.full(nsamp, 40.0), \
+                               50.0 * np.sin(np.arange(nsamp)), \
+                               np.full(nsamp, 20.0)])
+    self.electrode_settings = {'dc_settings': [0.5]}
+
+
+def fake_extract_data(self, *args, **kwargs):
+    if self.data_closed:
+        return
+    self.ginds = np.arange(ngind)
+    self.drive_ginds = np.arange(ngind)
+    self.err_ginds = np.arange(2*ngind)
+    self.datfft = np.ones((3, ngind), dtype=np.complex128)
+    self.daterr = np.ones((3, 2*ngind), dtype=np.complex128)
+    self.diagdatfft = 2.0 * self.datfft
+    self.diagdaterr = 2.0 * self.daterr
+    self.noisefft = np.zeros((3, ngind), dtype=np.complex128)
+    self.drivefft = np.ones((3, ngind), dtype=np.complex128)
+    self.drivefft_all = np.ones(ngind, dtype=np.complex128)
+    self.binned = np.zeros((3, 3, 10))
+    self.posvec = np.linspace(-40.0, 40.0, 20)
+    self.fund_ind = 1
+    self.drive_freq = 5.0
+    self.drive_ind = 1
+    self.meandrive = 0.0
+
+
+def setup_fakes(monkeypatch, tmp_path):
+    monkeypatch.setattr(bu.DataFile, 'load', fake_load)
+    monkeypatch.setattr(bu.DataFile, 'calibrate_stage_position', lambda self: None)
+    monkeypatch.setattr(bu, 'diagonalize_many', lambda *args, **kwargs: None)
+    monkeypatch.setattr(gu.FileData, 'extract_data', fake_extract_data)
+
+    ### Nothing should be pickled per file when streaming
+    def fail_save(self, *args, **kwargs):
+        raise RuntimeError('FileData.save() called while streaming')
+    monkeypatch.setattr(gu.FileData, 'save', fail_save)
+
+    fnames = []
+    for ind in range(3):
+        fname = str(tmp_path / 'data_{:d}.h5'.format(ind))
+        open(fname, 'w').close()
+        fnames.append(fname)
+    return fnames
+
+
+
+def test_stream_into_store(monkeypatch, tmp_path):
+    fnames = setup_fakes(monkeypatch, tmp_path)
+    store_path = str(tmp_path / 'test.agg')
+    p0_bead = [10.0, 20.0, 30.0]
+
+    agg = gu.AggregateData(fnames, p0_bead=p0_bead, ncore=1, stream=True, \
+                           store_path=store_path, diag_chunk=2)
+
+    assert agg.failed_files == []
+    assert agg.fnames == fnames
+
+    store = agg_store.AggStore(agg_store.get_store_path(store_path))
+    assert store.nrows() == len(fnames)
+    assert store.get_failures() == []
+
+    rows = store.read_rows()
+    assert sorted(str(row['fname']) for row in rows) == sorted(fnames)
+    for row in rows:
+        assert np.array_equal(row['p0_bead'], p0_bead)
+        assert row['cantbias'] == 0.5
+        assert row['ax0pos'] == 40.0
+        assert np.array_equal(row['diagdatfft'], 2.0 * np.ones((3, ngind)))
+
+    for obj in agg.file_data_objs:
+        assert list(obj.p0_bead) == p0_bead
+        assert obj.nsamp == nsamp
+
+
+
+def test_incremental_reads_store(monkeypatch, tmp_path):
+    fnames = setup_fakes(monkeypatch, tmp_path)
+    store_path = str(tmp_path / 'test.agg')
+
+    gu.AggregateData(fnames[:2], ncore=1, stream=True, store_path=store_path)
+    agg = gu.AggregateData(fnames, ncore=1, stream=True, store_path=store_path, \
+                           incremental=True)
+
+    ### Only the new file is appended
+    store = agg_store.AggStore(agg_store.get_store_path(store_path))
+    assert store.nrows() == len(fnames)
+    assert agg.fnames == fnames
@@ -1,23 +1,27 @@
-import glob, os, sys, copy, time, math
+import glob, os, sys, copy, time, math, hashlib, functools
 
 import numpy as np
-import matplotlib
-import matplotlib.pyplot as plt
-from matplotlib.ticker import LogLocator, NullFormatter
+
+from lazy_import import lazy_module, lazy_callable
+
+plt = lazy_module('matplotlib.pyplot')
+LogLocator = lazy_callable('matplotlib.ticker', 'LogLocator')
+NullFormatter = lazy_callable('matplotlib.ticker', 'NullFormatter')
 
 import scipy
-import scipy.optimize as opti
-import scipy.signal as signal
-import scipy.interpolate as interp
-import scipy.constants as constants
+opti = lazy_module('scipy.optimize')
+signal = lazy_module('scipy.signal')
+interp = lazy_module('scipy.interpolate')
+constants = lazy_module('scipy.constants')
 
 import bead_util as bu
-import image_util as imu
+imu = lazy_module('image_util')
 import configuration as config
 
 import dill as pickle
 
-from iminuit import Minuit, describe
+Minuit = lazy_callable('iminuit', 'Minuit')
+describe = lazy_callable('iminuit', 'describe')
 
 
 
@@ -916,6 +920,119 @@ def make_tf_array(freqs, Hfunc, suppress_off_diag=False):
 
 
 
+#################
+### The inverted TF arrays only depend on the TF file and the FFT parameters
+### of the data, which rarely change within a dataset, so they're cached both
+### in memory (per process) and on disk (shared between processes and runs)
+#################
+
+### Subdirectory of the transfer_funcs directory holding the cached arrays
+tf_cache_subdir = 'inverse_tf_cache'
+
+
+def get_tf_file_hash(tf_path):
+    '''SHA1 hash of the contents of a .trans file.'''
+    with open(tf_path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+
+@functools.lru_cache(maxsize=16)
+def _load_inverse_tf_array(tf_path, tf_mtime, nsamp, fsamp, suppress_off_diag, \
+                           maxfreq, use_disk_cache):
+    '''Cached part of get_inverse_tf_array(). The mtime of the TF file is
+       part of the arguments so the in-memory cache is invalidated if the
+       file changes.'''
+
+    tf_hash = get_tf_file_hash(tf_path)
+    key_str = '{:s}_{:d}_{:0.6f}_{:d}_{:0.6f}'.format(tf_hash, int(nsamp), float(fsamp), \
+                                                    int(suppress_off_diag), float(maxfreq))
+    tf_name = os.path.splitext(os.path.basename(tf_path))[0]
+    cache_path = os.path.join(os.path.dirname(tf_path), tf_cache_subdir, \
+                    tf_name + '_' + hashlib.sha1(key_str.encode()).hexdigest()[:16] + '.npy')
+
+    if use_disk_cache and os.path.isfile(cache_path):
+        try:
+            return np.load(cache_path, mmap_mode='r')
+        except Exception:
+            print("Couldn't load cached inverse TF: ", cache_path)
+
+    Hfunc = pickle.load(open(tf_path, 'rb'))
+
+    freqs = np.fft.rfftfreq(nsamp, d=1.0/fsamp)
+    Harr = make_tf_array(freqs, Hfunc, suppress_off_diag=suppress_off_diag)
+
+    maxfreq_ind = np.argmin( np.abs(freqs - maxfreq) )
+    Harr[maxfreq_ind+1:,:,:] = 0.0+0.0j
+
+    if use_disk_cache:
+        try:
+            bu.make_all_pardirs(cache_path)
+            tmp_path = cache_path + '.{:d}.tmp'.format(os.getpid())
+            with open(tmp_path, 'wb') as f:
+                np.save(f, Harr)
+            os.replace(tmp_path, cache_path)
+        except (IOError, OSError):
+            pass
+
+    Harr.setflags(write=False)
+    return Harr
+
+
+
+def get_inverse_tf_array(tf_path, nsamp, fsamp, suppress_off_diag=False, \
+                         maxfreq=1000, use_disk_cache=True):
+    '''Returns the (Nfreq, 3, 3) array output by make_tf_array() for data
+       with nsamp samples at fsamp, top-hat filtered above maxfreq. Arrays 
+       are cached per process, keyed on the TF file and these parameters, 
+       and on disk next to the TF file, keyed on its SHA1 hash. The output 
+       is read-only since it's shared between calls.
+
+           INPUTS: tf_path, path to the pickled .trans file
+                   nsamp, number of samples of the data
+                   fsamp, sampling frequency of the data
+                   suppress_off_diag, boolean passed to make_tf_array()
+                   maxfreq, frequency above which the inverse TF is zeroed
+                   use_disk_cache, boolean to read/write the .npy cache
+
+           OUTPUTS: Harr, read-only (Nfreq, 3, 3) complex array'''
+
+    tf_path = os.path.abspath(tf_path)
+    tf_mtime = os.stat(tf_path).st_mtime
+
+    return _load_inverse_tf_array(tf_path, tf_mtime, int(nsamp), float(fsamp), \
+                                  bool(suppress_off_diag), float(maxfreq), \
+                                  bool(use_disk_cache))
+
+
+
+
+def apply_inverse_tf(data, Harr, workers=None):
+    '''Diagonalizes one or many files' worth of position data in a single
+       batched pass: one rfft over every axis and file, the inverse TF
+       applied with one broadcasted matrix product, and one irfft.
+
+           INPUTS: data, (3, nsamp) or (Nfile, 3, nsamp) array of
+                         position data, all with the same nsamp
+                   Harr, (Nfreq, 3, 3) array from get_inverse_tf_array()
+                   workers, number of threads for scipy.fft. None uses
+                            scipy's default (single-threaded)
+
+           OUTPUTS: diag_data, array with the same leading shape as data'''
+
+    data_fft = scipy.fft.rfft(data, axis=-1, workers=workers)
+
+    ### Equivalent to np.einsum('ikj,ki->ji', Harr, data_fft) for a single
+    ### file, with the frequency axis moved in front of the 3-vectors so
+    ### that (..., Nfreq, 1, 3) @ (Nfreq, 3, 3) broadcasts over files
+    vecs = np.swapaxes(data_fft, -1, -2)[...,np.newaxis,:]
+    diag_fft = np.swapaxes(np.matmul(vecs, Harr)[...,0,:], -1, -2)
+
+    return scipy.fft.irfft(diag_fft, axis=-1, workers=workers)
+
+
+
+
 def plot_tf_array(freqs, Harr):
     '''Plots a 3x3xNfreq complex-valued array for use in diagonalization
            INPUTS: freqs, array of frequencies
@@ -58,6 +58,9 @@ pcol = 2
 correlation_phase = 0
 plot_correlations = True
 
+### Jobs for loading the discharge files, which are then correlated together
+ncore = 1
+
 # auto_try = 0.25     ### for Z direction in new trap
 # auto_try = 1.5e-8   ### for Y direction in new trap
 # auto_try = 0.1
@@ -252,32 +255,20 @@ if not fake_step_cal:
     time_vec = []
     #for fileind, filname in enumerate(step_cal_files[:max_file]):
     print('Processing discharge files...')
-    for fileind, filname in enumerate(step_cal_files):
-        bu.progress_bar(fileind, nstep_files)
-        df = bu.DataFile()
-        try:
-            if new_trap:
-                df.load_new(filname)
-                if not df.electrode_settings['driven'][elec_channel_select]:
-                    continue
-            else:
-                df.load(filname)
-        except Exception:
-            traceback.print_exc()
-            continue
-
-        if using_tabor and not new_trap:
-            df.load_other_data()
-
-        time_vec.append(df.time * 1e-9) ### ns to seconds
-
-        step_resp_dict = \
-            cal.find_step_cal_response(df, bandwidth=20.0, tabor_ind=tabor_ind,\
-                                       using_tabor=using_tabor, pcol=pcol, \
-                                       new_trap=new_trap, plot=False, \
-                                       userphase=correlation_phase)
-        if fileind == 0:
-            print('Drive freq [Hz]: {:0.1f}'.format(step_resp_dict['drive_freq']))
+
+    ### Loads the files in chunks and correlates them all together
+    step_resp_dicts = \
+        cal.find_step_cal_responses(step_cal_files, bandwidth=20.0, tabor_ind=tabor_ind, \
+                                    using_tabor=using_tabor, pcol=pcol, \
+                                    new_trap=new_trap, userphase=correlation_phase, \
+                                    elec_channel_select=elec_channel_select, \
+                                    ncore=ncore)
+    if not len(step_resp_dicts):
+        raise ValueError('No step calibration files could be processed')
+    print('Drive freq [Hz]: {:0.1f}'.format(step_resp_dicts[0]['drive_freq']))
+
+    for step_resp_dict in step_resp_dicts:
+        time_vec.append(step_resp_dict['time'] * 1e-9) ### ns to seconds
 
         step_cal_vec_inphase.append(step_resp_dict['inphase'])
         step_cal_vec_max.append(step_resp_dict['max'])
@@ -315,7 +306,7 @@ if not fake_step_cal:
         input()
         # time.sleep(5)
 
-    nsec = df.nsamp * (1.0 / df.fsamp)
+    nsec = step_resp_dicts[-1]['nsamp'] * (1.0 / step_resp_dicts[-1]['fsamp'])
 
     vpn, off, err, q0 = cal.step_cal(step_cal_vec_userphase, nsec=nsec, \
                                      new_trap=new_trap, auto_try=auto_try, \
@@ -76,6 +76,7 @@ new_trap = False
 
 tfdate = '20200307'
 tf_plot = False
+diag_chunk = 20    # number of files loaded and diagonalized together
 
 filename_labels = True 
 # filename_labels = False
@@ -196,23 +197,35 @@ def plot_many_spectra(files, data_axes=[0,1,2], cant_axes=[], elec_axes=[], othe
 
     old_per = 0
     print("Processing %i files..." % len(files))
+    dfs = []
     for fil_ind, fil in enumerate(files):
         color = colors[fil_ind]
         
         # Display percent completion
         bu.progress_bar(fil_ind, len(files))
 
-        # Load data
-        df = bu.DataFile()
-        if new_trap:
-            df.load_new(fil)
-        else:
-            df.load(fil)
+        # Load data in chunks of files, which are then diagonalized together
+        if not len(dfs):
+            for chunk_fil in files[fil_ind:fil_ind+diag_chunk]:
+                df = bu.DataFile()
+                if new_trap:
+                    df.load_new(chunk_fil)
+                else:
+                    df.load(chunk_fil)
 
-        if len(other_axes):
-            df.load_other_data()
+                if len(other_axes):
+                    df.load_other_data()
+
+                df.calibrate_stage_position()
+                dfs.append(df)
 
-        df.calibrate_stage_position()
+            if tf_plot:
+                for df in dfs:
+                    df.diagonalize(maxfreq=lpf, date=tfdate, plot=tf_plot)
+            else:
+                bu.diagonalize_many(dfs, date=tfdate, maxfreq=lpf)
+
+        df = dfs.pop(0)
         
         #df.high_pass_filter(fc=1)
         #df.detrend_poly()
@@ -223,8 +236,6 @@ def plot_many_spectra(files, data_axes=[0,1,2], cant_axes=[], elec_axes=[], othe
 
         freqs = np.fft.rfftfreq(len(df.pos_data[0]), d=1.0/df.fsamp)
 
-        df.diagonalize(maxfreq=lpf, date=tfdate, plot=tf_plot)
-
         if fil_ind == 0 and len(cant_axes):
             drivepsd = np.abs(np.fft.rfft(df.cant_data[drive_ax]))
             driveind = np.argmax(drivepsd[1:]) + 1
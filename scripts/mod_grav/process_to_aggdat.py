@@ -11,6 +11,7 @@ plt.rcParams.update({'font.size': 14})
 
 import grav_util_3 as gu
 import bead_util as bu
+import agg_store
 import configuration as config
 
 import warnings
@@ -66,6 +67,18 @@ suppress_off_diag = True
 # save = True
 reprocess = False
 save = False
+
+### Also keep the per-file data in a columnar store next to the .agg 
+### file, and load from that (which is much faster) when not reprocessing
+use_store = True
+
+### When reprocessing, only process files that aren't already up to date
+### in the store (needs use_store)
+incremental = True
+
+### Send back only the compact per-file data from the workers, and write
+### it to the store as files finish (needs use_store to keep it on disk)
+stream = True
 plot_end_result = False
 
 redo_alpha_fit = True
@@ -127,10 +140,16 @@ for ddir in data_dirs:
                                                 substr=substr)
         datafiles = datafiles[:Nfiles]
 
+        ### Only write the store when saving, like the .agg file
+        store_path = agg_path if (use_store and save) else ''
+
         agg_dat = gu.AggregateData(datafiles, p0_bead=p0_bead, harms=harms, reload_dat=True, \
                                    plot_harm_extraction=plot_harms, new_trap=new_trap, \
                                    step_cal_drive_freq=151.0, ncore=ncore, noisebins=10, \
-                                   aux_data=aux_data, suppress_off_diag=suppress_off_diag)
+                                   aux_data=aux_data, suppress_off_diag=suppress_off_diag, \
+                                   store_path=store_path, \
+                                   incremental=(incremental and bool(store_path)), \
+                                   stream=stream)
 
         agg_dat.load_grav_funcs(theory_data_dir)
 
@@ -168,7 +187,12 @@ for ddir in data_dirs:
 
     else:
         agg_dat = gu.AggregateData([], p0_bead=p0_bead, harms=harms, new_trap=new_trap)
-        agg_dat.load(agg_path)
+        ### Fall back to the pickled object if there's no store for it yet
+        if use_store and agg_store.AggStore(agg_store.get_store_path(agg_path)).exists():
+            agg_dat.load_store(agg_path)
+            agg_dat.load_grav_funcs(theory_data_dir)
+        else:
+            agg_dat.load(agg_path)
 
         agg_dat.bin_rough_stage_positions()
         #agg_dat.average_resp_by_coordinate()
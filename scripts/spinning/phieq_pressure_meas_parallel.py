@@ -1,7 +1,6 @@
 import os, time, sys
 import numpy as np
 import matplotlib.pyplot as plt
-from hs_digitizer import *
 from iminuit import Minuit, describe
 
 from obspy.signal.detrend import polynomial
@@ -113,7 +112,7 @@ for pathind, path in enumerate(paths):
 
     fc = 2.0 * f_rot
 
-    fobj = hsDat(files[0])
+    fobj = bu.hsDat(files[0], load=False)
     nsamp = fobj.attribs["nsamp"]
     fsamp = fobj.attribs["fsamp"]
 
@@ -135,7 +134,7 @@ for pathind, path in enumerate(paths):
     b3, a3 = signal.butter(3, (2.0/fsamp)*high_pass, btype='high')
 
     def proc_file(file):
-        fobj = hsDat(file)
+        fobj = bu.hsDat(file, load=True, mmap=True)
 
         vperp = fobj.dat[:,0]
         elec3 = fobj.dat[:,1]
@@ -200,7 +200,7 @@ for meas in itertools.product(gases, inds):
         b3, a3 = signal.butter(3, (2.0/fsamp)*high_pass, btype='high')
 
         def proc_file(file):
-            fobj = bu.hsDat(file, load=True)
+            fobj = bu.hsDat(file, load=True, mmap=True)
 
             vperp = fobj.dat[:,0]
             elec3 = fobj.dat[:,1]
@@ -223,7 +223,7 @@ for meas in itertools.product(gases, inds):
 
             inds = np.abs(freqs - fspin) < 200.0
 
-            elec3_fft = np.fft.rfft(elec3)
+            elec3_fft = fobj.get_rfft(1)
             true_fspin = freqs[np.argmax(np.abs(elec3_fft))]
 
             amp, phase_mod = bu.demod(vperp, true_fspin, fsamp, plot=plot_demod, \
@@ -172,14 +172,13 @@ times -= times[0]
 
 def proc_file(file):
 
-    fobj = bu.hsDat(file, load=True)
+    fobj = bu.hsDat(file, load=True, mmap=True)
 
-    vperp = fobj.dat[:,0]
-    elec3 = fobj.dat[:,1]*tabor_mon_fac
+    vperp = fobj.get_channel(0)
 
     inds = np.abs(full_freqs - fspin) < 200.0
 
-    elec3_fft = np.fft.rfft(elec3)*fac
+    elec3_fft = fobj.get_rfft(1)*tabor_mon_fac*fac
     true_fspin = np.average(full_freqs[inds], weights=np.abs(elec3_fft)[inds])
 
     amp, phase_mod = bu.demod(vperp, true_fspin, fsamp, plot=plot_demod, \
@@ -235,11 +234,10 @@ def proc_file(file):
 results = Parallel(n_jobs=ncore)(delayed(proc_file)(file) for file in tqdm(files))
 
 
-phase_peaks_all = []
-drive_peaks_all = []
-for phase_peaks, drive_peaks in results:
-    phase_peaks_all.append(phase_peaks)
-    drive_peaks_all.append(drive_peaks)
+### Pack the peaks of all integrations into single ragged arrays
+phase_peaks_all = bu.pack_fft_peaks([phase_peaks for phase_peaks, _ in results])
+drive_peaks_all = bu.pack_fft_peaks([drive_peaks for _, drive_peaks in results])
+del results
 
 
 
@@ -0,0 +1,277 @@
+import numpy as np
+
+from numba import jit
+
+#######################################################
+# Compiled stochastic integrator for the rotating
+# dipole model of rot_sim_stochastic.py, replacing
+# sdeint and its python callbacks.
+#
+# The state of a trajectory is the usual
+#     [theta, phi, psi, dtheta/dt, dphi/dt, dpsi/dt]
+# and a whole batch of trajectories (different
+# parameters and/or noise realizations) is advanced
+# as one (Ntraj, 6) array. Each trajectory has its
+# own row of parameters (see the *_col indices below)
+# and its own seeded random number generator, so a
+# trajectory is the same whatever batch it's run in.
+#
+# The noise is drawn in blocks with numpy's
+# generators, then consumed by the compiled stepper,
+# which only saves every decim-th step.
+#######################################################
+
+
+### Columns of the parameter array, one row per trajectory
+Ibead_col = 0
+beta_rot_col = 1
+p0_col = 2
+drive_amp_col = 3
+drive_freq_col = 4
+t_offset_col = 5            ### added to t to get the phase of the drive
+init_angle_col = 6          ### initial phase of the drive
+discretized_phase_col = 7   ### drive phase step, 0 for a continuous phase
+amp_noise_col = 8           ### drive amplitude noise
+phase_noise_col = 9         ### drive phase noise [rad]
+torque_noise_col = 10       ### thermal torque noise [N m / sqrt(Hz)]
+fterm_noise_col = 11        ### 1 to add the drive noise to the drift
+gterm_noise_col = 12        ### 1 to add the drive noise to the diffusion
+nparam = 13
+
+### Normal deviates per step: 3 thermal torques, drive amplitude and
+### phase noise of the drift, then drive phase noise of the diffusion
+nnoise = 6
+
+methods = {'euler': 0, 'heun': 1}
+
+
+
+
+def build_params(Ibead, beta_rot, p0, drive_amp, drive_freq, t_offset=0.0, \
+                 init_angle=0.0, discretized_phase=0.0, amp_noise=0.0, \
+                 phase_noise=0.0, torque_noise=0.0, fterm_noise=False, \
+                 gterm_noise=False):
+    '''Builds the (Ntraj, nparam) parameter array for a batch of
+       trajectories. Every argument is either a scalar, common to all
+       trajectories, or an array with one value per trajectory.'''
+
+    cols = np.broadcast_arrays(Ibead, beta_rot, p0, drive_amp, drive_freq, \
+                               t_offset, init_angle, discretized_phase, \
+                               amp_noise, phase_noise, torque_noise, \
+                               np.asarray(fterm_noise, dtype=float), \
+                               np.asarray(gterm_noise, dtype=float))
+
+    params = np.zeros((np.size(cols[0]), nparam))
+    for col_ind, col in enumerate(cols):
+        params[:,col_ind] = np.ravel(col)
+
+    return params
+
+
+
+@jit(nopython=True, cache=True)
+def drive_phase(t, p):
+    raw_val = 2.0 * np.pi * p[drive_freq_col] * (t + p[t_offset_col]) \
+                + p[init_angle_col]
+    if p[discretized_phase_col]:
+        return np.trunc(raw_val / p[discretized_phase_col]) * p[discretized_phase_col]
+    return raw_val
+
+
+
+@jit(nopython=True, cache=True)
+def drift(x, t, p, n, out):
+    '''Deterministic part of the system, d(xi) = out * dt, with the
+       normal deviates n of the current step for the drive noise.'''
+
+    Ibead = p[Ibead_col]
+    beta_rot = p[beta_rot_col]
+
+    torque_theta = p[drive_amp_col] * p[p0_col] * np.sin(0.5 * np.pi - x[0]) \
+                        - beta_rot * x[3]
+
+    c_amp = p[drive_amp_col]
+    E_phi = drive_phase(t, p)
+    if p[fterm_noise_col]:
+        c_amp += p[amp_noise_col] * n[3]
+        E_phi += p[phase_noise_col] * n[4]
+
+    torque_phi = c_amp * p[p0_col] * np.sin(E_phi - x[1]) * np.sin(x[0]) \
+                        - beta_rot * x[4]
+
+    torque_psi = -1.0 * beta_rot * x[5]
+
+    out[0] = x[3]
+    out[1] = x[4]
+    out[2] = x[5]
+    out[3] = torque_theta / Ibead
+    out[4] = torque_phi / Ibead
+    out[5] = torque_psi / Ibead
+
+
+
+@jit(nopython=True, cache=True)
+def diffusion(x, t, p, n, out):
+    '''Diagonal of the (diagonal) noise matrix, d(xi) = out * dW, which
+       only acts on the angular velocities.'''
+
+    thermal = p[torque_noise_col] / p[Ibead_col]
+
+    out[0] = 0.0
+    out[1] = 0.0
+    out[2] = 0.0
+    out[3] = thermal
+    out[4] = thermal
+    out[5] = thermal
+
+    if p[gterm_noise_col]:
+        E_phi = drive_phase(t, p)
+        amp_noise_term = p[amp_noise_col] * p[p0_col] * np.sin(E_phi - x[1]) \
+                            * np.sin(x[0])
+        phase_noise_term = p[drive_amp_col] * p[p0_col] \
+                            * np.sin(p[phase_noise_col] * n[5]) * np.sin(x[0])
+        out[4] += amp_noise_term + phase_noise_term
+
+
+
+@jit(nopython=True, cache=True)
+def step_block(xi, params, t0, dt, istart, nstep, decim, noise, method, soln):
+    '''Advances every trajectory of the batch by nstep steps, in place.
+
+       INPUTS: xi, (Ntraj, 6) array of states at step istart
+               params, (Ntraj, nparam) array of parameters
+               t0, time of the start of the simulation
+               dt, time step
+               istart, index of the first step since the start of the
+                       simulation
+               nstep, number of steps
+               decim, a state is saved every decim steps
+               noise, (Ntraj, nstep, nnoise) array of standard normal
+                      deviates
+               method, 0 for Euler-Maruyama, 1 for stochastic Heun
+               soln, (Ntraj, 6, Nsave) output array, where the states
+                     saved during this block are written from the
+                     first save after istart'''
+
+    ntraj = xi.shape[0]
+    sqrt_dt = np.sqrt(dt)
+
+    fx = np.zeros(6)
+    gx = np.zeros(6)
+    fy = np.zeros(6)
+    gy = np.zeros(6)
+    x = np.zeros(6)
+    y = np.zeros(6)
+    dW = np.zeros(6)
+
+    first_save = (istart + decim - 1) // decim
+
+    for j in range(ntraj):
+        p = params[j]
+        for k in range(6):
+            x[k] = xi[j,k]
+
+        for i in range(nstep):
+            step = istart + i
+            t = t0 + step * dt
+            n = noise[j,i]
+
+            if not step % decim:
+                saveind = step // decim - first_save
+                for k in range(6):
+                    soln[j,k,saveind] = x[k]
+
+            ### The thermal torques are the Wiener increments of the
+            ### angular velocities
+            dW[3] = sqrt_dt * n[0]
+            dW[4] = sqrt_dt * n[1]
+            dW[5] = sqrt_dt * n[2]
+
+            drift(x, t, p, n, fx)
+            diffusion(x, t, p, n, gx)
+
+            if method == 0:
+                for k in range(6):
+                    x[k] += fx[k] * dt + gx[k] * dW[k]
+
+            else:
+                ### Predictor, then the trapezoidal corrector with the
+                ### same noise for both evaluations
+                for k in range(6):
+                    y[k] = x[k] + fx[k] * dt + gx[k] * dW[k]
+                drift(y, t + dt, p, n, fy)
+                diffusion(y, t + dt, p, n, gy)
+                for k in range(6):
+                    x[k] += 0.5 * (fx[k] + fy[k]) * dt \
+                                + 0.5 * (gx[k] + gy[k]) * dW[k]
+
+        for k in range(6):
+            xi[j,k] = x[k]
+
+
+
+def make_rngs(seeds):
+    '''One independent generator per trajectory, from integer seeds.'''
+    return [np.random.default_rng(seed) for seed in seeds]
+
+
+
+def integrate(xi_0, params, t0, nstep, dt, rngs, decim=1, method='heun', \
+              block_size=2**16):
+    '''Integrates a batch of trajectories of the rotating dipole, saving
+       every decim-th step. The noise is drawn from rngs in blocks of
+       block_size steps, so the memory use doesn't grow with nstep.
+
+       With the noise of the model, which only depends on the angles
+       and only drives the angular velocities, the Ito and Stratonovich
+       interpretations agree, so the Heun method integrates the same
+       Ito system as sdeint.itoint, with a smaller error.
+
+       INPUTS: xi_0, (Ntraj, 6) or (6,) array of initial states
+               params, (Ntraj, nparam) array from build_params()
+               t0, initial time
+               nstep, number of steps
+               dt, time step
+               rngs, list of Ntraj numpy Generators (see make_rngs()),
+                     which are advanced, so another call continues
+                     the same noise realizations
+               decim, a state is saved every decim steps
+               method, 'euler' or 'heun'
+               block_size, number of steps per block of noise
+
+       OUTPUTS: tvec, (Nsave,) array of times of the saved states
+                soln, (Ntraj, 6, Nsave) array of saved states, starting
+                      with the state at t0
+                xi, (Ntraj, 6) array of states after the last step'''
+
+    params = np.atleast_2d(np.asarray(params, dtype=np.float64))
+    ntraj = params.shape[0]
+
+    xi = np.array(np.broadcast_to(xi_0, (ntraj, 6)), dtype=np.float64)
+    if len(rngs) != ntraj:
+        raise ValueError('Need one random number generator per trajectory')
+
+    decim = int(decim)
+    nsave = (nstep + decim - 1) // decim
+    tvec = t0 + np.arange(nsave) * decim * dt
+    soln = np.zeros((ntraj, 6, nsave))
+
+    ### Blocks start on a saved step, so each block writes a contiguous
+    ### slice of the solution
+    block_size = max(decim, (block_size // decim) * decim)
+    noise = np.zeros((ntraj, block_size, nnoise))
+
+    for istart in range(0, nstep, block_size):
+        nblock = min(block_size, nstep - istart)
+        for j, rng in enumerate(rngs):
+            rng.standard_normal(out=noise[j,:nblock])
+
+        save_start = istart // decim
+        save_stop = save_start + (nblock + decim - 1) // decim
+        block_soln = np.zeros((ntraj, 6, save_stop - save_start))
+
+        step_block(xi, params, t0, dt, istart, nblock, decim, \
+                   noise, methods[method], block_soln)
+        soln[:,:,save_start:save_stop] = block_soln
+
+    return tvec, soln, xi
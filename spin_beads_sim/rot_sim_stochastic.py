@@ -8,17 +8,20 @@ import scipy.constants as constants
 import scipy.signal as signal
 
 from joblib import Parallel, delayed
-from numba import jit
 
 import bead_util as bu
-
-import sdeint
+import dipole_sde
 
 TEST = False
 
 ncore = 10
 # ncore = 1
 
+### Parameter points integrated together, as one batch of trajectories,
+### by each job, and the integration method ('heun' or 'euler')
+batch_size = 4
+sde_method = 'heun'
+
 ### Time to thermalize
 # user_t_therm = 0.0
 user_t_therm = 50.0
@@ -130,241 +133,152 @@ for v1, v2, v3, v4, v5, v6, v7 in iterproduct:
     ind += 1
 
 
-def run_mc(params):
-
-    ind = params[0]
-    pressure = params[1]
-    drive_freq = params[2]
-    drive_voltage = params[3]
-    drive_voltage_noise = params[4]
-    drive_phase_noise = params[5]
-    init_angle = params[6]
-    discretized_phase = params[7]
-
-    beta_rot = pressure * np.sqrt(m0) / kappa
-    drive_amp = np.abs(bu.trap_efield([0, 0, 0, drive_voltage, -1.0*drive_voltage, \
-                                       0, 0, 0], nsamp=1)[0])
-    drive_amp_noise = drive_voltage_noise * (drive_amp / drive_voltage)
-
-    seed = seed_init * (ind + 1)
-
-    xi_0 = np.array([np.pi/2.0, 0.0, 0.0, \
-                     0.0, 2.0*np.pi*drive_freq, 0.0])
-
-    time_constant = Ibead / beta_rot
-
-    np.random.seed(seed)
-
-    ### If desired, set a thermalization time equal to 10x the time constant
-    ### for this particular pressure and Ibead combination
+def get_thermalization(pressure):
+    '''Thermalization time and number of thermalization files for a 
+       given pressure. If desired, the thermalization time is 10x the 
+       time constant for this particular pressure and Ibead combination'''
     if variable_thermalization:
+        beta_rot = pressure * np.sqrt(m0) / kappa
+        time_constant = Ibead / beta_rot
         t_therm = np.min([10.0 * time_constant, 300.0])
         nthermfiles = int(t_therm / out_file_length) + 1
     else:
         t_therm = user_t_therm
         nthermfiles = user_nthermfiles
+    return t_therm, nthermfiles
 
-    values_to_save = {}
-    values_to_save['mbead'] = mbead
-    values_to_save['Ibead'] = Ibead
-    values_to_save['kappa'] = kappa
-    values_to_save['beta_rot'] = beta_rot
-    values_to_save['p0'] = p0
-    values_to_save['fsamp'] = fsamp
-    values_to_save['fsim'] = fsim
-    values_to_save['seed'] = seed
-    values_to_save['xi_0'] = xi_0
-    values_to_save['init_angle'] = init_angle
-    values_to_save['pressure'] = pressure
-    values_to_save['m0'] = m0
-    values_to_save['drive_freq'] = drive_freq
-    values_to_save['drive_amp'] = drive_amp
-    values_to_save['drive_amp_noise'] = drive_amp_noise
-    values_to_save['drive_phase_noise'] = drive_phase_noise
-    values_to_save['discretized_phase'] = discretized_phase
-    values_to_save['t_therm'] = t_therm
-
-    if not TEST:
-        base_filename = os.path.join(base, 'mc_{:d}/'.format(ind))
-
-        bu.make_all_pardirs(os.path.join(base_filename, 'derp.txt'))
-
-        param_path = os.path.join(base_filename, 'params.p')
-        pickle.dump(values_to_save, open(param_path, 'wb'))
-
-
-    def E_phi_func(t, t_therm=0.0, init_angle=0.0):
-        raw_val = 2.0 * np.pi * drive_freq * (t + t_therm) + init_angle
-        if discretized_phase:
-            n_disc = int(raw_val / discretized_phase)
-            return n_disc * discretized_phase
-        else:
-            return raw_val
-
-    ### Matrix for the stochastic driving processes
-    torque_noise = np.sqrt(4.0 * kb * T * beta_rot)
-    # B = np.array([[0, 0,   0,   0],
-    #               [0, 0,   0,   0],
-    #               [0, 0, 1.0,   0],
-    #               [0, 0,   0, 1.0]])
-    B = np.array([[0, 0, 0,   0,   0,   0],
-                  [0, 0, 0,   0,   0,   0],
-                  [0, 0, 0,   0,   0,   0],
-                  [0, 0, 0, 1.0,   0,   0],
-                  [0, 0, 0,   0, 1.0,   0],
-                  [0, 0, 0,   0,   0, 1.0]])
-    B *= torque_noise / Ibead
-
-    ### Define the system such that d(xi) = f(xi, t) * dt
-    # @jit()
-    def f(x, t):
-        torque_theta = drive_amp * p0 * np.sin(0.5 * np.pi - x[0]) \
-                            - 1.0 * beta_rot * x[3]
-
-        c_amp = drive_amp
-        E_phi = E_phi_func(t)
-        if fterm_noise:
-            c_amp += drive_amp_noise * np.random.randn()
-            E_phi += drive_phase_noise * np.random.randn()
-
-        torque_phi = c_amp * p0 * np.sin(E_phi - x[1]) * np.sin(x[0]) \
-                            - 1.0 * beta_rot * x[4]
-
-        torque_psi = -1.0 * beta_rot * x[5]
-
-        return np.array([x[3], x[4], x[5], \
-                         torque_theta / Ibead, \
-                         torque_phi / Ibead, \
-                         torque_psi / Ibead])
-
-    ### Define the stochastic portion of the system
-    # @jit()
-    def G(x, t):
-        newB = np.zeros((6,6))
-
-        if gterm_noise:
-            E_phi = E_phi_func(t)
-            amp_noise_term = drive_amp_noise * p0 * np.sin(E_phi - x[1]) * np.sin(x[0])
-
-            E_phi_rand = drive_phase_noise * np.random.randn()
-            phase_noise_term = drive_amp * p0  * np.sin(E_phi_rand) * np.sin(x[0])
-            newB[4,4] += amp_noise_term + phase_noise_term
-
-        return B + newB
-
-
-    ### Thermalize
-    xi_init = np.copy(xi_0)
-    for i in range(nthermfiles):
-        t0 = i*out_file_length
-        tf = (i+1)*out_file_length
-
-        nsim = int(out_file_length * fsim)
-        tvec = np.linspace(t0, tf, nsim+1)
 
-        result = sdeint.itoint(f, G, xi_init, tvec).T
-        xi_init = np.copy(result[:,-1])
+### Parameter points are batched with others that have the same number
+### of thermalization files, so a batch is integrated for the same time
+batches = {}
+for params in param_list:
+    nthermfiles = get_thermalization(params[1])[1]
+    batches.setdefault(nthermfiles, []).append(params)
 
+batch_list = []
+for batch in batches.values():
+    for start in range(0, len(batch), batch_size):
+        batch_list.append(batch[start:start+batch_size])
 
-    ### Redefine the system taking into account the thermalization time
-    ### and the desired phase offset
-    # @jit()
-    def f(x, t):
-        torque_theta = drive_amp * p0 * np.sin(0.5 * np.pi - x[0]) \
-                            - 1.0 * beta_rot * x[3]
 
-        c_amp = drive_amp
-        E_phi = E_phi_func(t, t_therm=t_therm, init_angle=init_angle)
-        if fterm_noise:
-            c_amp += drive_amp_noise * np.random.randn()
-            E_phi += drive_phase_noise * np.random.randn()
+def run_mc(param_batch):
+    '''Simulates a batch of parameter points as one batch of trajectories
+       (see dipole_sde), each with its own seeded noise.'''
 
-        torque_phi = c_amp * p0 * np.sin(E_phi - x[1]) * np.sin(x[0]) \
-                            - 1.0 * beta_rot * x[4]
+    ntraj = len(param_batch)
+    inds = [params[0] for params in param_batch]
+    pressure, drive_freq, drive_voltage, drive_voltage_noise, \
+        drive_phase_noise, init_angle, discretized_phase \
+            = np.array([params[1:] for params in param_batch]).T
 
-        torque_psi = -1.0 * beta_rot * x[5]
+    beta_rot = pressure * np.sqrt(m0) / kappa
+    drive_amp = np.array([np.abs(bu.trap_efield([0, 0, 0, voltage, -1.0*voltage, \
+                                                 0, 0, 0], nsamp=1)[0]) \
+                                for voltage in drive_voltage])
+    drive_amp_noise = drive_voltage_noise * (drive_amp / drive_voltage)
 
-        return np.array([x[3], x[4], x[5], \
-                         torque_theta / Ibead, \
-                         torque_phi / Ibead, \
-                         torque_psi / Ibead])
+    seeds = [seed_init * (ind + 1) for ind in inds]
 
+    xi_0 = np.zeros((ntraj, 6))
+    xi_0[:,0] = np.pi/2.0
+    xi_0[:,4] = 2.0*np.pi*drive_freq
 
-    # @jit()
-    # def f(x, t):
-    #     torque_theta = - 1.0 * beta_rot * x[2]
-    #     torque_phi = - 1.0 * beta_rot * x[3]
+    t_therm, nthermfiles = get_thermalization(pressure[0])
+    if variable_thermalization:
+        t_therm = np.array([get_thermalization(val)[0] for val in pressure])
+    else:
+        t_therm = t_therm * np.ones(ntraj)
+
+    base_filenames = []
+    for traj in range(ntraj):
+        values_to_save = {}
+        values_to_save['mbead'] = mbead
+        values_to_save['Ibead'] = Ibead
+        values_to_save['kappa'] = kappa
+        values_to_save['beta_rot'] = beta_rot[traj]
+        values_to_save['p0'] = p0
+        values_to_save['fsamp'] = fsamp
+        values_to_save['fsim'] = fsim
+        values_to_save['seed'] = seeds[traj]
+        values_to_save['xi_0'] = xi_0[traj]
+        values_to_save['init_angle'] = init_angle[traj]
+        values_to_save['pressure'] = pressure[traj]
+        values_to_save['m0'] = m0
+        values_to_save['drive_freq'] = drive_freq[traj]
+        values_to_save['drive_amp'] = drive_amp[traj]
+        values_to_save['drive_amp_noise'] = drive_amp_noise[traj]
+        values_to_save['drive_phase_noise'] = drive_phase_noise[traj]
+        values_to_save['discretized_phase'] = discretized_phase[traj]
+        values_to_save['t_therm'] = t_therm[traj]
+        values_to_save['sde_method'] = sde_method
+
+        base_filename = os.path.join(base, 'mc_{:d}/'.format(inds[traj]))
+        base_filenames.append(base_filename)
 
-    #     return np.array([x[2], x[3], torque_theta / Ibead, torque_phi / Ibead])
+        if not TEST:
+            bu.make_all_pardirs(os.path.join(base_filename, 'derp.txt'))
 
-    ### Define the stochastic portion of the system
-    def G(x, t):
-        newB = np.zeros((6,6))
-        if gterm_noise:
-            E_phi = E_phi_func(t, t_therm=t_therm, init_angle=init_angle)
-            amp_noise_term = drive_amp_noise * p0 * np.sin(E_phi - x[1]) * np.sin(x[0])
+            param_path = os.path.join(base_filename, 'params.p')
+            pickle.dump(values_to_save, open(param_path, 'wb'))
 
-            E_phi_rand = drive_phase_noise * np.random.randn()
-            phase_noise_term = drive_amp * p0  * np.sin(E_phi_rand) * np.sin(x[0])
+    ### Parameters of the stochastic system for every trajectory. The
+    ### thermal torque drives each of the angular velocities
+    sde_params = dipole_sde.build_params(Ibead, beta_rot, p0, drive_amp, drive_freq, \
+                                         discretized_phase=discretized_phase, \
+                                         amp_noise=drive_amp_noise, \
+                                         phase_noise=drive_phase_noise, \
+                                         torque_noise=np.sqrt(4.0 * kb * T * beta_rot), \
+                                         fterm_noise=fterm_noise, gterm_noise=gterm_noise)
+    rngs = dipole_sde.make_rngs(seeds)
 
-        newB[4,4] += amp_noise_term + phase_noise_term
+    nsim = int(out_file_length * fsim)
 
-        return B + newB
+    ### Thermalize, only keeping the final state
+    xi_init = np.copy(xi_0)
+    for i in range(nthermfiles):
+        t0 = i*out_file_length
+        _, _, xi_init = dipole_sde.integrate(xi_init, sde_params, t0, nsim, dt_sim, \
+                                             rngs, decim=nsim, method=sde_method)
 
 
+    ### Redefine the system taking into account the thermalization time
+    ### and the desired phase offset
+    sde_params[:,dipole_sde.t_offset_col] = t_therm
+    sde_params[:,dipole_sde.init_angle_col] = init_angle
 
 
     ### Run the simulation with the thermalized solution
     for i in range(nfiles):
         # start = time.time()
         t0 = i*out_file_length
-        tf = (i+1)*out_file_length
-
-        nsim = int(out_file_length * fsim)
-        tvec = np.linspace(t0, tf, nsim+1)
-
-        ### Solve!
-        # print('RUNNING SIM')
-        result = sdeint.itoint(f, G, xi_init, tvec).T
-        xi_init = np.copy(result[:,-1])
-
-        tvec = tvec[:-1]
-        soln = result[:,:-1]
-
-        # print('DOWNSAMPLING')
-        nsamp = int(out_file_length * fsamp)
-        # soln_ds, tvec_ds = signal.resample(soln, t=tvec, \
-        #                                    num=nsamp, axis=-1)
-        # soln_ds = signal.decimate(soln, int(upsamp))
-
-        tvec_ds = tvec[::int(upsamp)]
-        soln_ds = soln[:,::int(upsamp)]
-
-        # plt.plot(tvec, soln[1])
-        # plt.plot(tvec_ds, soln_ds[1])
-        # plt.plot(tvec_ds, soln_ds_2[1])
 
-        # plt.show()
+        ### Solve, and downsample to fsamp
+        tvec_ds, soln_ds, xi_init = \
+                dipole_sde.integrate(xi_init, sde_params, t0, nsim, dt_sim, rngs, \
+                                     decim=int(upsamp), method=sde_method)
 
         if not TEST:
-            out_arr = np.concatenate( (tvec_ds.reshape((1, len(tvec_ds))), soln_ds) )
+            for traj in range(ntraj):
+                out_arr = np.concatenate( (tvec_ds.reshape((1, len(tvec_ds))), \
+                                           soln_ds[traj]) )
 
-            filename = os.path.join(base_filename, 'outdat_{:d}.h5'.format(i)) 
+                filename = os.path.join(base_filenames[traj], 'outdat_{:d}.h5'.format(i)) 
 
-            fobj = h5py.File(filename, 'w')
-            fobj.create_dataset('sim_data', data=out_arr, compression='gzip', \
-                                compression_opts=9)
-            fobj.close()
+                fobj = h5py.File(filename, 'w')
+                fobj.create_dataset('sim_data', data=out_arr, compression='gzip', \
+                                    compression_opts=9)
+                fobj.close()
 
         # stop = time.time()
         # print('Time for one file: {:0.1f}'.format(stop-start))
 
-    return seed
+    return seeds
 
 start = time.time()
 print('Starting to process data...')
 
-seeds = Parallel(n_jobs=ncore)(delayed(run_mc)(params) for params in param_list)
+seeds = Parallel(n_jobs=ncore)(delayed(run_mc)(param_batch) for param_batch in batch_list)
+seeds = [seed for batch_seeds in seeds for seed in batch_seeds]
 print(seeds)
 
 stop = time.time()